@@ -0,0 +1,241 @@
+"""
+< WGDashboard > - Benchmark of the dashboard hot paths
+Under Apache-2.0 License
+
+Drive the Flask app through its test client against simulated interfaces and record
+latency, throughput and peak RSS of every endpoint as JSON.
+
+    python3 benchmark.py --sizes 100,1000,10000,50000 --output bench.json
+    python3 benchmark.py --compare bench_old.json bench.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import secrets
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = "100,1000,10000,50000"
+# Peers added and removed by each /add_peer_bulk and /remove_peer iteration
+BULK_AMOUNT = 50
+
+
+def succeeded(response):
+    """
+    @param response: Flask test response
+    @return: Whether the request succeeded, not an error status nor a JSON status false or failed
+    @rtype: bool
+    """
+    if response.status_code >= 400:
+        return False
+    if response.is_json:
+        body = response.get_json(silent=True)
+        # /get_config answers with the status of the interface instead
+        if isinstance(body, dict):
+            return body.get("status") not in (False, "failed")
+    return True
+
+
+def returned_true(response):
+    """
+    @param response: Flask test response of an endpoint answering "true", or an error message
+    @return: Whether the request succeeded
+    @rtype: bool
+    """
+    return response.status_code < 400 and response.get_data() == b"true"
+
+
+def measure(client, name, iterations, request, check=succeeded):
+    """
+    Time an endpoint
+    @param client: Flask test client
+    @param name: Name of the measure
+    @param iterations: Number of requests
+    @param request: Function sending one request with the client, returning the response
+    @param check: Function taking a response and returning whether the request succeeded
+    @return: Dictionary of latency, throughput, peak RSS and failed requests
+    @rtype: dict
+    """
+    latencies = []
+    status = set()
+    failures = 0
+    for i in range(iterations):
+        tic = time.perf_counter()
+        response = request(client, i)
+        latencies.append(time.perf_counter() - tic)
+        status.add(response.status_code)
+        failures += not check(response)
+    latencies.sort()
+    return {
+        "endpoint": name,
+        "iterations": iterations,
+        "status_codes": sorted(status),
+        "failures": failures,
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "throughput_rps": round(iterations / sum(latencies), 3),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def random_keys(amount):
+    """
+    Generate peer keys like the browser does before calling /add_peer_bulk
+    @param amount: Number of key sets
+    @return: list
+    """
+    keys = []
+    for _ in range(amount):
+        keys.append({"privateKey": base64.b64encode(secrets.token_bytes(32)).decode(),
+                     "publicKey": base64.b64encode(secrets.token_bytes(32)).decode(),
+                     "presharedKey": base64.b64encode(secrets.token_bytes(32)).decode()})
+    return keys
+
+
+def run_size(peers, iterations, output):
+    """
+    Benchmark one interface size, in a fresh interpreter so module state and peak RSS are its own
+    @param peers: Number of simulated peers
+    @param iterations: Number of requests per read endpoint
+    @param output: File receiving the JSON result
+    @return: None
+    """
+    work_dir = tempfile.mkdtemp(prefix="wgd-bench-")
+    os.makedirs(os.path.join(work_dir, "conf"))
+    os.environ["CONFIGURATION_PATH"] = work_dir
+    # Flask looks up templates and static files from the working directory
+    os.chdir(SRC_PATH)
+    sys.path.insert(0, SRC_PATH)
+    import dashboard
+
+    dashboard.init_dashboard()
+    config = dashboard.get_dashboard_conf()
+    config.set("Server", "auth_req", "false")
+    config.set("Server", "wg_conf_path", os.path.join(work_dir, "conf"))
+    config.set("Server", "data_source", "simulated")
+    config.set("Server", "simulated_interfaces", "1")
+    config.set("Server", "simulated_peers", str(peers))
+    dashboard.set_dashboard_conf(config)
+    config.clear()
+    dashboard.WG_CONF_PATH = os.path.join(work_dir, "conf")
+    tic = time.perf_counter()
+    dashboard.data_source()
+    setup = time.perf_counter() - tic
+
+    client = dashboard.app.test_client()
+    conf = "wgsim0"
+    # The index page creates the peer tables, like a first visit does
+    results = [measure(client, "/ (index)", iterations, lambda c, i: c.get("/")),
+               measure(client, "/get_config (first refresh)", 1, lambda c, i: c.get(f"/get_config/{conf}?search="))]
+    # Simulated peers only have public keys, give them a private key so they can be exported
+    db = dashboard.connect_db()
+    db.execute(f"UPDATE {conf} SET private_key = id")
+    db.commit()
+    db.close()
+    results.append(measure(client, "/get_config", iterations, lambda c, i: c.get(f"/get_config/{conf}?search=")))
+    results.append(measure(client, "/available_ips", iterations, lambda c, i: c.get(f"/available_ips/{conf}")))
+    results.append(measure(client, "/download_all", iterations, lambda c, i: c.get(f"/download_all/{conf}")))
+
+    batches = [random_keys(BULK_AMOUNT) for _ in range(iterations)]
+    bulk = {"endpoint_allowed_ip": "0.0.0.0/0", "DNS": "1.1.1.1", "enable_preshared_key": True,
+            "amount": str(BULK_AMOUNT), "MTU": "1420", "keep_alive": "21"}
+    results.append(measure(client, f"/add_peer_bulk ({BULK_AMOUNT} peers)", iterations,
+                           lambda c, i: c.post(f"/add_peer_bulk/{conf}", json=dict(bulk, keys=batches[i])),
+                           returned_true))
+    results.append(measure(client, f"/remove_peer ({BULK_AMOUNT} peers)", iterations,
+                           lambda c, i: c.post(f"/remove_peer/{conf}",
+                                               json={"peer_ids": [k["publicKey"] for k in batches[i]]}),
+                           returned_true))
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"peers": peers, "setup_s": round(setup, 3), "endpoints": results}, f)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run(sizes, iterations):
+    """
+    Benchmark every interface size, each in its own process
+    @param sizes: List of peer counts
+    @param iterations: Number of requests per endpoint
+    @return: Dictionary with environment and results
+    @rtype: dict
+    """
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_PATH,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = ""
+    report = {"revision": revision, "python": platform.python_version(), "platform": platform.platform(),
+              "timestamp": int(time.time()), "results": []}
+    for peers in sizes:
+        with tempfile.NamedTemporaryFile(suffix=".json") as result:
+            print(f"Benchmarking {peers} peers...", file=sys.stderr)
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), "--worker", str(peers),
+                                   "--iterations", str(iterations), "--output", result.name],
+                                  stdout=subprocess.DEVNULL)
+            with open(result.name, encoding="utf-8") as f:
+                report["results"].append(json.load(f))
+            # Timings of failed requests do not measure the work of the endpoint
+            for endpoint in report["results"][-1]["endpoints"]:
+                if endpoint["failures"] > 0:
+                    print(f"{peers} peers: {endpoint['failures']} of {endpoint['iterations']} "
+                          f"{endpoint['endpoint']} requests failed", file=sys.stderr)
+    return report
+
+
+def compare(base_file, new_file):
+    """
+    Print the change of mean latency and peak RSS between two reports
+    @param base_file: JSON report of the reference version
+    @param new_file: JSON report of the new version
+    @return: None
+    """
+    with open(base_file, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(new_file, encoding="utf-8") as f:
+        new = json.load(f)
+    base_index = {(r["peers"], e["endpoint"]): e for r in base["results"] for e in r["endpoints"]}
+    print(f"{'peers':>7}  {'endpoint':<34} {'base ms':>10} {'new ms':>10} {'speedup':>8} {'rss MB':>8}")
+    for result in new["results"]:
+        for endpoint in result["endpoints"]:
+            old = base_index.get((result["peers"], endpoint["endpoint"]))
+            if old is None:
+                continue
+            speedup = old["mean_ms"] / endpoint["mean_ms"] if endpoint["mean_ms"] > 0 else 0
+            print(f"{result['peers']:>7}  {endpoint['endpoint']:<34} {old['mean_ms']:>10.2f} "
+                  f"{endpoint['mean_ms']:>10.2f} {speedup:>7.2f}x {endpoint['peak_rss_kb'] / 1024:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark WGDashboard against simulated interfaces")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated numbers of peers")
+    parser.add_argument("--iterations", type=int, default=5, help="Requests per endpoint")
+    parser.add_argument("--output", default="-", help="JSON report file, - for stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two JSON reports")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    elif args.worker:
+        run_size(args.worker, args.iterations, args.output)
+    else:
+        report = run([int(i) for i in args.sizes.split(",")], args.iterations)
+        if args.output == "-":
+            print(json.dumps(report, indent=2))
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
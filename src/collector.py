@@ -0,0 +1,300 @@
+"""
+< WGDashboard > - Background collection of WireGuard interfaces
+Under Apache-2.0 License
+"""
+
+import fcntl
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Number of interfaces collected in parallel
+COLLECTOR_WORKERS = 8
+# Seconds between two collections of an interface nobody is looking at
+COLLECTOR_IDLE_INTERVAL = 60
+# Seconds an interface counts as viewed after the last time its page asked for peers
+COLLECTOR_VIEW_TTL = 120
+# Seconds between two passes of the scheduler
+COLLECTOR_TICK = 0.5
+
+
+class Snapshot:
+    """
+    Result of one collection of an interface
+    """
+
+    __slots__ = ("config_name", "time", "duration", "dump", "rates")
+
+    def __init__(self, config_name, collected_at, duration, dump, rates=None):
+        """
+        @param config_name: Configuration name
+        @param collected_at: Epoch of the end of the collection
+        @param duration: Seconds the collection took
+        @param dump: datasource.InterfaceDump, None when the interface is stopped
+        @param rates: rates.InterfaceRates of the peers, None when not measured
+        """
+        self.config_name = config_name
+        self.time = collected_at
+        self.duration = duration
+        self.dump = dump
+        self.rates = rates
+
+
+class Collector:
+    """
+    Refresh every interface on a bounded thread pool, each at its own cadence: interfaces
+    being viewed follow the page refresh interval and go first, the others are refreshed
+    every idle interval. Requests can also ask for a fresh snapshot, which runs the
+    collection in the request thread, or waits for the one already in flight.
+    """
+
+    def __init__(self, collect, list_interfaces, workers=COLLECTOR_WORKERS, idle_interval=COLLECTOR_IDLE_INTERVAL,
+                 lock_path=None, store=None, measure=None):
+        """
+        @param collect: Function collecting a configuration, returning its datasource.InterfaceDump or None
+        @param list_interfaces: Function returning the names of all configurations
+        @param workers: Number of interfaces collected in parallel
+        @param idle_interval: Seconds between two collections of an interface nobody is viewing
+        @param lock_path: File locked by the process running the background loop, so only one
+                          worker of a multi-process server sweeps the interfaces
+        @param store: snapshot_store.SnapshotStore sharing snapshots and views with the other workers
+        @param measure: Function taking the previous snapshot of an interface, None for its first,
+                        and a new one, returning the rates published with the new one
+        """
+        self.collect = collect
+        self.list_interfaces = list_interfaces
+        self.workers = workers
+        self.idle_interval = idle_interval
+        self.lock_path = lock_path
+        self.store = store
+        self.measure = measure
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.snapshots = {}
+        self.viewed = {}
+        self.running = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock_file = None
+
+    def view(self, config_name, interval):
+        """
+        Mark an interface as being viewed
+        @param config_name: Configuration name
+        @param interval: Seconds between two refreshes of the page
+        @return: None
+        """
+        with self.lock:
+            self.viewed[config_name] = (time.time(), interval)
+        if self.store is not None:
+            self.store.mark_viewed(config_name, interval)
+
+    def interval(self, config_name, now):
+        """
+        @param config_name: Configuration name
+        @param now: Current epoch
+        @return: Seconds between two collections of the interface, and whether it is being viewed
+        @rtype: tuple
+        """
+        with self.lock:
+            viewed = self.viewed.get(config_name)
+        if self.store is not None:
+            shared = self.store.viewed(config_name)
+            if shared is not None and (viewed is None or shared[0] > viewed[0]):
+                viewed = shared
+        if viewed is not None and now - viewed[0] < max(COLLECTOR_VIEW_TTL, viewed[1] * 2):
+            return min(viewed[1], self.idle_interval), True
+        return self.idle_interval, False
+
+    def run(self, config_name, future):
+        """
+        Collect an interface and publish its snapshot
+        @param config_name: Configuration name
+        @param future: Future receiving the snapshot
+        @return: None
+        """
+        tic = time.time()
+        try:
+            dump = self.collect(config_name)
+            snapshot = Snapshot(config_name, time.time(), time.time() - tic, dump)
+            snapshot.rates = self.rates(snapshot)
+            with self.lock:
+                self.snapshots[config_name] = snapshot
+            if self.store is not None:
+                try:
+                    self.store.write(snapshot)
+                except OSError as exc:
+                    print(f"Failed to share the {config_name} snapshot: {exc}")
+            future.set_result(snapshot)
+        except Exception as exc:
+            print(f"Failed to collect {config_name}: {exc}")
+            future.set_exception(exc)
+        finally:
+            with self.lock:
+                if self.running.get(config_name) is future:
+                    del self.running[config_name]
+
+    def refresh(self, config_name, max_age=0):
+        """
+        Get a snapshot of an interface no older than max_age, collecting it in this thread
+        if needed, or waiting for the collection already running
+        @param config_name: Configuration name
+        @param max_age: Seconds a snapshot is still fresh enough
+        @return: Snapshot
+        """
+        snapshot = self.get(config_name)
+        if snapshot is not None and time.time() - snapshot.time <= max_age:
+            return snapshot
+        with self.lock:
+            future = self.running.get(config_name)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.running[config_name] = future
+        if owner:
+            self.run(config_name, future)
+        return future.result()
+
+    def get(self, config_name):
+        """
+        Get the last snapshot of an interface without collecting it, from this process or
+        the shared store, whichever is newer
+        @param config_name: Configuration name
+        @return: Snapshot, None if the interface was never collected
+        """
+        with self.lock:
+            snapshot = self.snapshots.get(config_name)
+        if self.store is not None:
+            shared = self.store.read(config_name)
+            if shared is not None and (snapshot is None or shared.time > snapshot.time):
+                return shared
+        return snapshot
+
+    def collected_elsewhere(self, config_name):
+        """
+        @param config_name: Configuration name
+        @return: Whether another worker process collected the interface after this one did
+        @rtype: bool
+        """
+        if self.store is None:
+            return False
+        with self.lock:
+            own = self.snapshots.get(config_name)
+        shared = self.store.read(config_name)
+        return own is not None and shared is not None and shared.time > own.time
+
+    def rates(self, snapshot):
+        """
+        Measure the rates of a new snapshot from the last one of the interface, whichever
+        process collected it, so they carry on when another worker collects
+        @param snapshot: Snapshot
+        @return: rates.InterfaceRates, None if not measured
+        """
+        if self.measure is None:
+            return None
+        try:
+            return self.measure(self.get(snapshot.config_name), snapshot)
+        except Exception as exc:
+            print(f"Failed to measure the {snapshot.config_name} rates: {exc}")
+            return None
+
+    def sweep(self):
+        """
+        Start the collection of the interfaces that are due, viewed and most overdue first,
+        never more than the pool can run at once
+        @return: Number of collections started
+        @rtype: int
+        """
+        now = time.time()
+        due = []
+        for config_name in self.list_interfaces():
+            interval, viewed = self.interval(config_name, now)
+            snapshot = self.get(config_name)
+            overdue = now - (snapshot.time if snapshot is not None else 0) - interval
+            if overdue >= 0:
+                due.append((not viewed, -overdue, config_name))
+        due.sort()
+        with self.lock:
+            due = [i for i in due if i[2] not in self.running]
+            started = due[:max(0, self.workers - len(self.running))]
+            for _, _, config_name in started:
+                future = Future()
+                self.running[config_name] = future
+                self.executor.submit(self.run, config_name, future)
+        return len(started)
+
+    def leader(self):
+        """
+        Try to become the process running the background loop
+        @return: True if this process holds the collector lock
+        @rtype: bool
+        """
+        if self.lock_path is None or self.lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def loop(self):
+        """
+        Background loop of the scheduler
+        @return: None
+        """
+        while not self.stopping.wait(COLLECTOR_TICK):
+            try:
+                if self.leader():
+                    self.sweep()
+            except Exception as exc:
+                print(f"Collector failed to schedule: {exc}")
+
+    def start(self):
+        """
+        Start the background loop, once per process
+        @return: None
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.loop, name="wgd-collector", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background loop and release the collector lock
+        @return: None
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def map(self, function, items):
+        """
+        Run a short per-interface task over many interfaces in parallel
+        @param function: Function receiving one item
+        @param items: Iterable of items
+        @return: list of results, in the order of items
+        """
+        items = list(items)
+        if len(items) < 2:
+            return [function(i) for i in items]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as pool:
+            return list(pool.map(function, items))
+
+
+def conf_names(conf_path):
+    """
+    List the configuration names of a WireGuard configuration directory
+    @param conf_path: Directory of the configuration files
+    @return: list
+    """
+    return [i[:-len(".conf")] for i in sorted(os.listdir(conf_path)) if i.endswith(".conf") and len(i) > 5]
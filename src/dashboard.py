@@ -5,13 +5,17 @@ Under Apache-2.0 License
 
 import sqlite3
 import configparser
+import csv
 import hashlib
+import io
 import ipaddress
 import json
 # Python Built-in Library
+import math
 import os
 import secrets
 import subprocess
+import threading
 import time
 import re
 import urllib.parse
@@ -21,14 +25,32 @@ from datetime import datetime, timedelta
 from operator import itemgetter
 # PIP installed library
 import ifcfg
-import psutil
-from flask import Flask, request, render_template, redirect, url_for, session, jsonify, g
+from flask import Flask, request, render_template, redirect, url_for, session, jsonify, g, \
+    before_render_template, template_rendered
+from flask.json.provider import DefaultJSONProvider
 from flask_qrcode import QRcode
-from icmplib import ping, traceroute
+from icmplib import ping
 
 # Import other python files
-from util import regex_match, check_DNS, check_Allowed_IPs, check_remote_endpoint, \
-    check_IP_with_range, clean_IP_with_range
+from util import regex_match, check_DNS, check_Allowed_IPs, check_remote_endpoint, clean_IP_with_range
+from jobs import TracerouteJobs
+from peer_index import PeerTargetIndex, PeerSearchIndex, AllowedIPIndex
+from peer_control import PeerChange, PeerControlError
+from datasource import get_data_source
+from reconcile import Reconciler
+import metrics
+import tracing
+from collector import Collector, Snapshot, conf_names, COLLECTOR_WORKERS, COLLECTOR_IDLE_INTERVAL
+from snapshot_store import SnapshotStore
+from peer_model import PEER_SELECT, PEER_INSERT, COLUMN_INDEX, sort_rows
+from peer_import import import_peers, read_records, detect_format, IMPORT_FORMATS, IMPORT_BATCH_SIZE
+from validation import validate_peers, parse_allowed_ips, is_allowed_ips, is_dns, is_key, is_number
+import serializer
+from singleflight import SingleFlight, COALESCE_WINDOW
+from policy import PolicyEngine
+import rates
+from rates import RATE_WINDOWS, TOP_PEERS
+from events import SessionTracker, EVENT_TYPES, EVENT_RETENTION_DAYS, ONLINE_HANDSHAKE
 
 # Dashboard Version
 DASHBOARD_VERSION = 'v3.0.6.2'
@@ -46,6 +68,16 @@ DASHBOARD_CONF = os.path.join(configuration_path, 'wg-dashboard.ini')
 # Upgrade Required
 UPDATE = None
 
+# WireGuard data source, created on first use
+DATA_SOURCE = None
+
+# Background collection of all configurations, created on first use
+COLLECTOR = None
+# Held while DATA_SOURCE or COLLECTOR is created, so concurrent first requests share one
+INIT_LOCK = threading.Lock()
+# Whether collections suspend the peers breaking their policies, read with the collector settings
+ENFORCE_PEER_POLICIES = True
+
 # Flask App Configuration
 app = Flask("WGDashboard")
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 5206928
@@ -56,14 +88,94 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 QRcode(app)
 
 
+class TracedJSONProvider(DefaultJSONProvider):
+    """
+    JSON encoding timed as the "render" phase of the request
+    """
+
+    def dumps(self, obj, **kwargs):
+        with tracing.span("render"):
+            if len(kwargs) > 0:
+                return super().dumps(obj, **kwargs)
+            return serializer.dumps(obj, self.default).decode("utf-8")
+
+
+app.json_provider_class = TracedJSONProvider
+app.json = TracedJSONProvider(app)
+
+
 # TODO: use class and object oriented programming
 
+# Seconds a connection waits for the write of another connection or worker before failing
+# with "database is locked"
+DB_BUSY_TIMEOUT = 30
+
+
 def connect_db():
     """
-    Connect to the database
+    Connect to the database. It is in WAL mode, so requests keep reading while a
+    collection writes, and writers wait for each other up to DB_BUSY_TIMEOUT.
     @return: sqlite3.Connection
     """
-    return sqlite3.connect(os.path.join(configuration_path, 'db', 'wgdashboard.db'))
+    db = sqlite3.connect(os.path.join(configuration_path, 'db', 'wgdashboard.db'), timeout=DB_BUSY_TIMEOUT,
+                         factory=tracing.TracedConnection)
+    # Stored in the database file, this only changes it on the first connection
+    db.execute("PRAGMA journal_mode = WAL")
+    return db
+
+
+# Background traceroute jobs
+traceroute_jobs = TracerouteJobs(connect_db)
+
+# Network test targets of every configuration
+peer_target_index = PeerTargetIndex()
+peer_search_index = PeerSearchIndex()
+allowed_ip_index = AllowedIPIndex()
+reconciler = Reconciler()
+# Peer tables known to store latest handshakes as epochs
+migrated_tables = set()
+
+# Encoded configuration responses, per version of their data
+conf_responses = serializer.ResponseCache()
+# Identical configuration refreshes running at the same time
+conf_flights = SingleFlight()
+# Data quotas and expiry times, checked on every collection
+peer_policies = PolicyEngine(lambda config_name: load_policies(config_name),
+                             lambda config_name, ids: suspend_peers(config_name, ids),
+                             lambda config_name: policy_version(config_name))
+
+# Online state and endpoint of the peers after the last collection, to log their sessions
+session_tracker = SessionTracker()
+
+# Seconds between two collections of an interface while its heaviest peers are watched
+TOP_REFRESH_INTERVAL = 5
+
+# Rendered peer metrics of the last snapshot of every configuration
+snapshot_metrics = metrics.SnapshotMetrics()
+# Request and command metrics added up over the worker processes
+metrics.share(os.path.join(DB_PATH, "metrics"))
+
+# Rolling request timings of this process, and the opt-in sampling profiler
+endpoint_stats = tracing.EndpointStats()
+profiler = tracing.SamplingProfiler()
+
+
+def data_source():
+    """
+    Get the source of all WireGuard state and changes
+    @return: datasource.DataSource
+    """
+    global DATA_SOURCE
+    if DATA_SOURCE is None:
+        with INIT_LOCK:
+            if DATA_SOURCE is None:
+                config = get_dashboard_conf()
+                DATA_SOURCE = get_data_source(config.get("Server", "data_source", fallback="kernel"), WG_CONF_PATH,
+                                              config.get("Server", "peer_control", fallback="auto"),
+                                              config.getint("Server", "simulated_interfaces", fallback=1),
+                                              config.getint("Server", "simulated_peers", fallback=1000))
+                config.clear()
+    return DATA_SOURCE
 
 
 def get_dashboard_conf():
@@ -95,13 +207,10 @@ def get_conf_peer_key(config_name):
     @rtype: list, str
     """
 
-    try:
-        peers_keys = subprocess.check_output(f"wg show {config_name} peers",
-                                             shell=True, stderr=subprocess.STDOUT)
-        peers_keys = peers_keys.decode("UTF-8").split()
-        return peers_keys
-    except subprocess.CalledProcessError:
+    dump = data_source().dump(config_name)
+    if dump is None:
         return config_name + " is not running."
+    return [peer.public_key for peer in dump.peers]
 
 
 def get_conf_running_peer_number(config_name):
@@ -113,25 +222,25 @@ def get_conf_running_peer_number(config_name):
     @rtype: int, str
     """
 
-    running = 0
-    # Get latest handshakes
-    try:
-        data_usage = subprocess.check_output(f"wg show {config_name} latest-handshakes",
-                                             shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
+    if get_conf_status(config_name) == "stopped":
         return "stopped"
-    data_usage = data_usage.decode("UTF-8").split()
-    count = 0
-    now = datetime.now()
-    time_delta = timedelta(minutes=2)
-    for _ in range(int(len(data_usage) / 2)):
-        minus = now - datetime.fromtimestamp(int(data_usage[count + 1]))
-        if minus < time_delta:
-            running += 1
-        count += 2
-    return running
+    return count_online_peers(config_name, ONLINE_HANDSHAKE)
 
 
+def count_online_peers(config_name, seconds):
+    """
+    Count the peers with a handshake in the last seconds, from the last collection, with the
+    latest handshake index
+    @param config_name: Name of WG interface
+    @param seconds: Seconds since the latest handshake
+    @return: Number of peers
+    @rtype: int
+    """
+    return g.cur.execute("SELECT COUNT(*) FROM " + config_name + " WHERE latest_handshake >= ?",
+                         (int(time.time() - seconds),)).fetchone()[0]
+
+
+@tracing.traced("parse")
 def read_conf_file_interface(config_name):
     """
     Get interface settings.
@@ -155,6 +264,7 @@ def read_conf_file_interface(config_name):
     return data
 
 
+@tracing.traced("parse")
 def read_conf_file(config_name):
     """
     Get configurations from file of wireguard interface.
@@ -201,64 +311,57 @@ def read_conf_file(config_name):
     return conf_peer_data
 
 
-def get_latest_handshake(config_name):
+def get_latest_handshake(config_name, dump):
     """
     Get the latest handshake from all peers of a configuration
     @param config_name: Configuration name
+    @param dump: datasource.InterfaceDump of the configuration
     @return: str
     """
 
-    # Get latest handshakes
-    try:
-        data_usage = subprocess.check_output(f"wg show {config_name} latest-handshakes",
-                                             shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
+    # Get latest handshakes, stored as epochs (0 if never) and humanized when rendered
+    if dump is None:
         return "stopped"
-    data_usage = data_usage.decode("UTF-8").split()
-    count = 0
-    now = datetime.now()
-    time_delta = timedelta(minutes=2)
-    for _ in range(int(len(data_usage) / 2)):
-        minus = now - datetime.fromtimestamp(int(data_usage[count + 1]))
-        if minus < time_delta:
-            status = "running"
-        else:
-            status = "stopped"
-        if int(data_usage[count + 1]) > 0:
-            g.cur.execute("UPDATE %s SET latest_handshake = '%s', status = '%s' WHERE id='%s'"
-            % (config_name, str(minus).split(".", maxsplit=1)[0], status, data_usage[count]))
-        else:
-            g.cur.execute("UPDATE %s SET latest_handshake = '(None)', status = '%s' WHERE id='%s'"
-            % (config_name, status, data_usage[count]))
-        count += 2
+    now = time.time()
+    g.cur.executemany("UPDATE " + config_name + " SET latest_handshake = ?, status = ? WHERE id = ?",
+                      [(int(peer.latest_handshake),
+                        "running" if now - peer.latest_handshake < ONLINE_HANDSHAKE else "stopped",
+                        peer.public_key) for peer in dump.peers])
+
+
+@app.template_filter("handshake")
+def humanize_handshake(epoch, now=None):
+    """
+    Render a latest handshake
+    @param epoch: Epoch of the latest handshake, 0 if the peer never connected
+    @param now: Epoch the time since the handshake is counted to
+    @return: Time since the handshake, e.g. "0:01:23", or "(None)"
+    @rtype: str
+    """
+    if not epoch:
+        return "(None)"
+    return str(timedelta(seconds=max(0, int((time.time() if now is None else now) - epoch))))
 
 
-def get_transfer(config_name):
+def get_transfer(config_name, dump):
     """
     Get transfer from all peers of a configuration
     @param config_name: Configuration name
+    @param dump: datasource.InterfaceDump of the configuration
     @return: str
     """
     # Get transfer
-    try:
-        data_usage = subprocess.check_output(f"wg show {config_name} transfer",
-                                             shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
+    if dump is None:
         return "stopped"
-    data_usage = data_usage.decode("UTF-8").split("\n")
-    final = []
-    for i in data_usage:
-        final.append(i.split("\t"))
-    data_usage = final
-    for i in range(len(data_usage)):
+    for peer in dump.peers:
         cur_i = g.cur.execute(
-            "SELECT total_receive, total_sent, cumu_receive, cumu_sent, status FROM %s WHERE id='%s'"
-            % (config_name, data_usage[i][0])).fetchall()
+            "SELECT total_receive, total_sent, cumu_receive, cumu_sent, status FROM " + config_name + " WHERE id = ?",
+            (peer.public_key,)).fetchall()
         if len(cur_i) > 0:
             total_sent = cur_i[0][1]
             total_receive = cur_i[0][0]
-            cur_total_sent = round(int(data_usage[i][2]) / (1024 ** 3), 4)
-            cur_total_receive = round(int(data_usage[i][1]) / (1024 ** 3), 4)
+            cur_total_sent = round(peer.transfer_tx / (1024 ** 3), 4)
+            cur_total_receive = round(peer.transfer_rx / (1024 ** 3), 4)
             if cur_i[0][4] == "running":
                 if total_sent <= cur_total_sent and total_receive <= cur_total_receive:
                     total_sent = cur_total_sent
@@ -268,108 +371,318 @@ def get_transfer(config_name):
                     cumulative_sent = cur_i[0][3] + total_sent
                     g.cur.execute("UPDATE %s SET cumu_receive = %f, cumu_sent = %f, cumu_data = %f WHERE id = '%s'" %
                                   (config_name, round(cumulative_receive, 4), round(cumulative_sent, 4),
-                                   round(cumulative_sent + cumulative_receive, 4), data_usage[i][0]))
+                                   round(cumulative_sent + cumulative_receive, 4), peer.public_key))
                     total_sent = 0
                     total_receive = 0
                 g.cur.execute("UPDATE %s SET total_receive = %f, total_sent = %f, total_data = %f WHERE id = '%s'" %
                               (config_name, round(total_receive, 4), round(total_sent, 4),
-                               round(total_receive + total_sent, 4), data_usage[i][0]))
+                               round(total_receive + total_sent, 4), peer.public_key))
 
 
-def get_endpoint(config_name):
+def get_endpoint(config_name, dump):
     """
     Get endpoint from all peers of a configuration
     @param config_name: Configuration name
+    @param dump: datasource.InterfaceDump of the configuration
     @return: str
     """
     # Get endpoint
-    try:
-        data_usage = subprocess.check_output(f"wg show {config_name} endpoints",
-                                             shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
+    if dump is None:
         return "stopped"
-    data_usage = data_usage.decode("UTF-8").split()
-    count = 0
-    for _ in range(int(len(data_usage) / 2)):
-        g.cur.execute("UPDATE " + config_name + " SET endpoint = '%s' WHERE id = '%s'"
-                      % (data_usage[count + 1], data_usage[count]))
-        count += 2
+    for peer in dump.peers:
+        g.cur.execute("UPDATE " + config_name + " SET endpoint = ? WHERE id = ?", (peer.endpoint, peer.public_key))
+
+
+
+def sync_peers(config_name, dump=None):
+    """
+    Add and remove database rows of a configuration after its configuration file changed
+    @param config_name: Configuration name
+    @param dump: datasource.InterfaceDump of the configuration if already fetched, to report the
+                 peers WireGuard and the configuration file disagree on
+    @return: reconcile.ReconcilePlan applied, None if the configuration file did not change
+    """
+    config = get_dashboard_conf()
+    defaults = {
+        "private_key": "",
+        "DNS": config.get("Peers", "peer_global_DNS"),
+        "endpoint_allowed_ip": config.get("Peers", "peer_endpoint_allowed_ip"),
+        "name": "",
+        "total_receive": 0,
+        "total_sent": 0,
+        "total_data": 0,
+        "endpoint": "N/A",
+        "status": "stopped",
+        "latest_handshake": 0,
+        "cumu_receive": 0,
+        "cumu_sent": 0,
+        "cumu_data": 0,
+        "mtu": config.get("Peers", "peer_mtu"),
+        "keepalive": config.get("Peers", "peer_keep_alive"),
+        "remote_endpoint": config.get("Peers", "remote_endpoint")
+    }
+    config.clear()
+
+    def kernel_keys():
+        # The kernel difference is only a diagnostic, not worth another dump when none was fetched
+        return None if dump is None else [peer.public_key for peer in dump.peers]
+
+    return reconciler.reconcile(g.cur, config_name, os.path.join(WG_CONF_PATH, config_name + ".conf"),
+                                lambda: read_conf_file(config_name), kernel_keys, defaults)
+
+
+def save_peer_changes(config_name, changes):
+    """
+    Apply peer changes to WireGuard, save the configuration file and update the allowed IP index
+    @param config_name: Configuration name
+    @param changes: List of peer_control.PeerChange
+    @return: None
+    @raise PeerControlError: When WireGuard rejected the changes
+    """
+    version = conf_version(config_name)
+    data_source().apply(config_name, changes)
+    data_source().save(config_name)
+    # Changes leaving the allowed IPs untouched leave the index as it is
+    allowed_ip_index.update(config_name, version, conf_version(config_name),
+                            [(c.public_key, None if c.remove else ",".join(c.allowed_ips))
+                             for c in changes if c.remove or c.allowed_ips is not None])
 
 
+def run_import(config_name, records, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+    """
+    Import peer records into a running configuration, each batch with one kernel update,
+    one configuration save and one database transaction
+    @param config_name: Configuration name
+    @param records: Iterable of records, see peer_import
+    @param batch_size: Number of peers applied together
+    @param dry_run: Only validate the records
+    @return: Report of peer_import.import_peers
+    @rtype: dict
+    """
+    if get_conf_status(config_name) != "running":
+        return {"status": False, "msg": config_name + " is not running."}
+
+    # Public keys of the interface, read once and extended with every applied batch
+    keys = set()
+
+    def validate(batch, first_row):
+        if first_row == 0:
+            keys.update(i[0] for i in g.cur.execute("SELECT id FROM " + config_name))
+        return validate_peers(batch, keys, lambda networks: allowed_ip_conflict(config_name, networks), first_row)
+
+    def apply(batch):
+        save_peer_changes(config_name, [PeerChange(r["public_key"], r["allowed_ips"], r.get("preshared_key") or None)
+                                        for r in batch])
+        sync_peers(config_name)
+        # Settings left empty keep the defaults the new rows were created with
+        g.cur.executemany(
+            "UPDATE " + config_name + " SET name = COALESCE(NULLIF(?, ''), name), "
+            "private_key = COALESCE(NULLIF(?, ''), private_key), DNS = COALESCE(NULLIF(?, ''), DNS), "
+            "endpoint_allowed_ip = COALESCE(NULLIF(?, ''), endpoint_allowed_ip), "
+            "mtu = COALESCE(NULLIF(?, ''), mtu), keepalive = COALESCE(NULLIF(?, ''), keepalive) WHERE id = ?",
+            [(r.get("name", ""), r.get("private_key", ""), r.get("DNS", ""), r.get("endpoint_allowed_ip", ""),
+              r.get("MTU", ""), r.get("keep_alive", ""), r["public_key"]) for r in batch])
+        g.db.commit()
+        keys.update(str(r["public_key"]).strip() for r in batch)
+
+    try:
+        return import_peers(records, validate, apply, data_source().public_key, batch_size, dry_run)
+    finally:
+        peers_changed(config_name)
+
 
-def get_allowed_ip(conf_peer_data, config_name):
+def peers_changed(config_name):
     """
-    Get allowed ips from all peers of a configuration
-    @param conf_peer_data: Configuration peer data
+    Drop the indexes and responses of a configuration after changing its peers
     @param config_name: Configuration name
     @return: None
     """
-    # Get allowed ip
-    for i in conf_peer_data["Peers"]:
-        g.cur.execute("UPDATE " + config_name + " SET allowed_ip = '%s' WHERE id = '%s'"
-                      % (i.get('AllowedIPs', '(None)'), i["PublicKey"]))
+    peer_search_index.invalidate(config_name)
+    peer_target_index.invalidate(config_name)
+    conf_responses.invalidate(config_name)
+    conf_flights.invalidate(config_name)
 
 
 def get_all_peers_data(config_name):
     """
     Look for new peers from WireGuard
     @param config_name: Configuration name
-    @return: None
+    @return: datasource.InterfaceDump of the configuration, None if it is stopped
     """
-    conf_peer_data = read_conf_file(config_name)
-    config = get_dashboard_conf()
-    failed_index = []
-    for i in range(len(conf_peer_data['Peers'])):
-        if "PublicKey" in conf_peer_data['Peers'][i].keys():
-            result = g.cur.execute(
-                "SELECT * FROM %s WHERE id='%s'" % (config_name, conf_peer_data['Peers'][i]["PublicKey"])).fetchall()
-            if len(result) == 0:
-                new_data = {
-                    "id": conf_peer_data['Peers'][i]['PublicKey'],
-                    "private_key": "",
-                    "DNS": config.get("Peers", "peer_global_DNS"),
-                    "endpoint_allowed_ip": config.get("Peers", "peer_endpoint_allowed_ip"),
-                    "name": "",
-                    "total_receive": 0,
-                    "total_sent": 0,
-                    "total_data": 0,
-                    "endpoint": "N/A",
-                    "status": "stopped",
-                    "latest_handshake": "N/A",
-                    "allowed_ip": "N/A",
-                    "cumu_receive": 0,
-                    "cumu_sent": 0,
-                    "cumu_data": 0,
-                    "traffic": [],
-                    "mtu": config.get("Peers", "peer_mtu"),
-                    "keepalive": config.get("Peers", "peer_keep_alive"),
-                    "remote_endpoint": config.get("Peers", "remote_endpoint"),
-                    "preshared_key": ""
-                }
-                if "PresharedKey" in conf_peer_data['Peers'][i].keys():
-                    new_data["preshared_key"] = conf_peer_data['Peers'][i]["PresharedKey"]
-                sql = f"""
-                INSERT INTO {config_name} 
-                    VALUES (:id, :private_key, :DNS, :endpoint_allowed_ip, :name, :total_receive, :total_sent, 
-                    :total_data, :endpoint, :status, :latest_handshake, :allowed_ip, :cumu_receive, :cumu_sent, 
-                    :cumu_data, :mtu, :keepalive, :remote_endpoint, :preshared_key);
-                """
-                g.cur.execute(sql, new_data)
-        else:
-            print("Trying to parse a peer doesn't have public key...")
-            failed_index.append(i)
-    for i in failed_index:
-        conf_peer_data['Peers'].pop(i)
-    # Remove peers no longer exist in WireGuard configuration file
-    db_key = list(map(lambda a: a[0], g.cur.execute("SELECT id FROM %s" % config_name)))
-    wg_key = list(map(lambda a: a['PublicKey'], conf_peer_data['Peers']))
-    for i in db_key:
-        if i not in wg_key:
-            g.cur.execute("DELETE FROM %s WHERE id = '%s'" % (config_name, i))
-    get_latest_handshake(config_name)
-    get_transfer(config_name)
-    get_endpoint(config_name)
-    get_allowed_ip(conf_peer_data, config_name)
+    dump = data_source().dump(config_name)
+    sync_peers(config_name, dump)
+    record_session_events(config_name, dump)
+    get_latest_handshake(config_name, dump)
+    get_transfer(config_name, dump)
+    get_endpoint(config_name, dump)
+    return dump
+
+
+def record_session_events(config_name, dump):
+    """
+    Log the connections, disconnections and endpoint changes since the previous collection,
+    before the peer table is updated
+    @param config_name: Configuration name
+    @param dump: datasource.InterfaceDump of the configuration
+    @return: Number of events logged
+    @rtype: int
+    """
+    if dump is None:
+        return 0
+    events = session_tracker.observe(
+        config_name, dump, lambda: g.cur.execute("SELECT id, status, endpoint FROM " + config_name).fetchall(),
+        collector().collected_elsewhere(config_name))
+    g.cur.executemany(f"INSERT OR IGNORE INTO {event_table(config_name)} (id, time, event, endpoint) "
+                      f"VALUES (?, ?, ?, ?)", events)
+    if session_tracker.prune_due(config_name):
+        days = get_dashboard_conf().getint("Server", "event_retention_days", fallback=EVENT_RETENTION_DAYS)
+        g.cur.execute(f"DELETE FROM {event_table(config_name)} WHERE time < ?",
+                      (int(time.time()) - days * 86400,))
+    return len(events)
+
+
+def collect_interface(config_name):
+    """
+    Collect one configuration outside of a request, with its own database connection
+    @param config_name: Configuration name
+    @return: datasource.InterfaceDump of the configuration, None if it is stopped
+    """
+    with app.app_context():
+        g.db = connect_db()
+        g.cur = g.db.cursor()
+        try:
+            create_peer_table(g.cur, config_name)
+            dump = get_all_peers_data(config_name)
+            if ENFORCE_PEER_POLICIES:
+                peer_policies.evaluate(config_name, dump)
+            g.db.commit()
+        finally:
+            g.db.close()
+    return dump
+
+
+def collector():
+    """
+    Get the scheduler refreshing every configuration in the background
+    @return: collector.Collector
+    """
+    global COLLECTOR, ENFORCE_PEER_POLICIES
+    if COLLECTOR is None:
+        with INIT_LOCK:
+            if COLLECTOR is None:
+                config = get_dashboard_conf()
+                ENFORCE_PEER_POLICIES = config.getboolean("Server", "enforce_peer_policies", fallback=True)
+                COLLECTOR = Collector(collect_interface, lambda: conf_names(WG_CONF_PATH),
+                                      config.getint("Server", "collector_workers", fallback=COLLECTOR_WORKERS),
+                                      config.getint("Server", "collector_idle_interval",
+                                                    fallback=COLLECTOR_IDLE_INTERVAL),
+                                      os.path.join(DB_PATH, "collector.lock"),
+                                      SnapshotStore(os.path.join(DB_PATH, "snapshots")), rates.measure)
+                config.clear()
+    return COLLECTOR
+
+
+def search_peer_ids(config_name, search, limit=None):
+    """
+    Search peers by name, public key, tunnel IP or endpoint with the in-memory index.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @param search: Search string
+    @type search: str
+    @param limit: Maximum number of peers, None for all
+    @return: IDs of the matching peers
+    @rtype: list
+    """
+    return peer_search_index.search(config_name, conf_version(config_name), lambda: load_index_rows(config_name),
+                                    search, limit)
+
+
+def load_index_rows(config_name):
+    """
+    @param config_name: Name of WG interface
+    @return: Rows of (id, name, allowed_ip, endpoint) the peer indexes are built from
+    @rtype: list
+    """
+    # The configuration file may have changed since the last collection, the index is cached
+    # against its new version
+    sync_peers(config_name)
+    return g.cur.execute("SELECT id, name, allowed_ip, endpoint FROM " + config_name).fetchall()
+
+
+def allowed_ip_conflict(config_name, allowed_ip, public_key=None):
+    """
+    Check allowed IPs against the allowed IPs of the other peers
+    @param config_name: Name of WG interface
+    @param allowed_ip: Comma separated allowed IPs, or a list of ipaddress networks
+    @param public_key: Peer the allowed IPs are for, its own ones are not conflicts
+    @return: Error message, None without conflict
+    @rtype: str, None
+    """
+    if isinstance(allowed_ip, str):
+        if allowed_ip.strip() in ("", "(None)"):
+            return None
+        # Checked before the index, which skips entries it cannot parse
+        allowed_ip = parse_allowed_ips(allowed_ip)
+        if allowed_ip is None:
+            return "Allowed IPs format is incorrect."
+    found = allowed_ip_index.conflicts(config_name, conf_version(config_name), lambda: load_index_rows(config_name),
+                                       allowed_ip, public_key)
+    if len(found) == 0:
+        return None
+    network, other, _ = found[0]
+    if network == other:
+        return f"Allowed IP {network} already taken by another peer."
+    return f"Allowed IP {network} overlaps {other} of another peer."
+
+
+def refresh_peers(config_name):
+    """
+    Get a recent snapshot of a configuration being viewed. Viewed configurations are kept
+    fresh by the collector, this only collects if it fell behind.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: collector.Snapshot
+    """
+    interval = int(get_dashboard_conf().get("Server", "dashboard_refresh_interval")) / 1000
+    collector().view(config_name, interval)
+    with tracing.span("collect"):
+        return collector().refresh(config_name, interval / 2)
+
+
+def conf_version(config_name):
+    """
+    @param config_name: Name of WG interface
+    @return: Version of the configuration file, changing whenever peers are saved
+    @rtype: int
+    """
+    return file_version(os.path.join(WG_CONF_PATH, config_name + ".conf"))
+
+
+def file_version(path):
+    """
+    @param path: Path of a file
+    @return: Modification time of the file in nanoseconds, 0 if it does not exist
+    @rtype: int
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def json_response(cached):
+    """
+    Send a cached JSON body, gzip encoded when the client accepts it
+    @param cached: serializer.CachedResponse
+    @return: Flask response
+    """
+    if len(cached.body) >= serializer.GZIP_MIN_SIZE and request.accept_encodings["gzip"] > 0:
+        response = app.response_class(cached.gzip(), mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = app.response_class(cached.body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    return response
 
 
 def get_peers(config_name, search, sort_t):
@@ -381,24 +694,16 @@ def get_peers(config_name, search, sort_t):
     @type search: str
     @param sort_t: Sorting tag
     @type sort_t: str
-    @return: list
+    @return: Rows with the columns of peer_model.PEER_COLUMNS
+    @rtype: list
     """
     tic = time.perf_counter()
-    col = g.cur.execute("PRAGMA table_info(" + config_name + ")").fetchall()
-    col = [a[1] for a in col]
-    get_all_peers_data(config_name)
-    if len(search) == 0:
-        data = g.cur.execute("SELECT * FROM " + config_name).fetchall()
-        result = [{col[i]: data[k][i] for i in range(len(col))} for k in range(len(data))]
-    else:
-        sql = "SELECT * FROM " + config_name + " WHERE name LIKE '%" + search + "%'"
-        data = g.cur.execute(sql).fetchall()
-        result = [{col[i]: data[k][i] for i in range(len(col))} for k in range(len(data))]
-    if sort_t == "allowed_ip":
-        result = sorted(result, key=lambda d: ipaddress.ip_network(
-            "0.0.0.0/0" if d[sort_t].split(",")[0] == "(None)" else d[sort_t].split(",")[0]))
-    else:
-        result = sorted(result, key=lambda d: d[sort_t])
+    refresh_peers(config_name)
+    data = g.cur.execute("SELECT " + PEER_SELECT + " FROM " + config_name).fetchall()
+    if len(search) > 0:
+        found = set(search_peer_ids(config_name, search))
+        data = [row for row in data if row[0] in found]
+    result = sort_rows(data, sort_t)
     toc = time.perf_counter()
     print(f"Finish fetching peers in {toc - tic:0.4f} seconds")
     return result
@@ -417,10 +722,9 @@ def get_conf_pub_key(config_name):
         conf = configparser.ConfigParser(strict=False)
         conf.read(WG_CONF_PATH + "/" + config_name + ".conf")
         pri = conf.get("Interface", "PrivateKey")
-        pub = subprocess.check_output(f"echo '{pri}' | wg pubkey", shell=True, stderr=subprocess.STDOUT)
         conf.clear()
-        return pub.decode().strip("\n")
-    except configparser.NoSectionError:
+        return data_source().public_key(pri)
+    except (configparser.NoSectionError, configparser.NoOptionError, PeerControlError):
         return ""
 
 
@@ -439,10 +743,9 @@ def get_conf_listen_port(config_name):
     try:
         port = conf.get("Interface", "ListenPort")
     except (configparser.NoSectionError, configparser.NoOptionError):
-        if get_conf_status(config_name) == "running":
-            port = subprocess.check_output(f"wg show {config_name} listen-port",
-                                           shell=True, stderr=subprocess.STDOUT)
-            port = port.decode("UTF-8")
+        dump = data_source().dump(config_name)
+        if dump is not None:
+            port = dump.listen_port
     conf.clear()
     return port
 
@@ -473,8 +776,135 @@ def get_conf_status(config_name):
     @param config_name:
     @return: Return a string indicate the running status
     """
-    addrs = psutil.net_if_addrs()
-    return "running" if config_name in addrs else "stopped"
+    return data_source().status(config_name)
+
+
+def create_peer_table(cur, config_name):
+    """
+    Create the peer table of a configuration if it does not exist
+    @param cur: sqlite3.Cursor
+    @param config_name: Configuration name
+    @return: None
+    """
+    create_table = f"""
+        CREATE TABLE IF NOT EXISTS {config_name} (
+            id VARCHAR NOT NULL, private_key VARCHAR NULL, DNS VARCHAR NULL, 
+            endpoint_allowed_ip VARCHAR NULL, name VARCHAR NULL, total_receive FLOAT NULL, 
+            total_sent FLOAT NULL, total_data FLOAT NULL, endpoint VARCHAR NULL, 
+            status VARCHAR NULL, latest_handshake INTEGER NULL, allowed_ip VARCHAR NULL, 
+            cumu_receive FLOAT NULL, cumu_sent FLOAT NULL, cumu_data FLOAT NULL, mtu INT NULL, 
+            keepalive INT NULL, remote_endpoint VARCHAR NULL, preshared_key VARCHAR NULL, 
+            PRIMARY KEY (id)
+        )
+    """
+    cur.execute(create_table)
+    # Suspended peers, same columns, removed from WireGuard and the configuration file
+    cur.execute(create_table.replace(f"EXISTS {config_name} (", f"EXISTS {restrict_table(config_name)} ("))
+    for table in (config_name, restrict_table(config_name)):
+        # Checked once per process; a table just rebuilt is checked again in case its transaction did not commit
+        if table not in migrated_tables and not migrate_handshake_column(
+                cur, table, create_table.replace(f"EXISTS {config_name} (", f"EXISTS {table}_migrate (")):
+            migrated_tables.add(table)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {config_name}_latest_handshake ON {config_name} (latest_handshake)")
+    # Connections, disconnections and endpoint changes of the peers, clustered by peer
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {event_table(config_name)} (
+            id VARCHAR NOT NULL, time INTEGER NOT NULL, event INTEGER NOT NULL, endpoint VARCHAR NULL,
+            PRIMARY KEY (id, time, event)
+        ) WITHOUT ROWID
+    """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {event_table(config_name)}_time ON {event_table(config_name)} (time)")
+    # Version of the policies of every configuration, increased in the transaction changing them
+    cur.execute("CREATE TABLE IF NOT EXISTS policy_versions (config_name VARCHAR NOT NULL, "
+                "version INTEGER NOT NULL, PRIMARY KEY (config_name))")
+    # Data quota in GB and expiry epoch of the peers, kept while a peer is suspended
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {policy_table(config_name)} (
+            id VARCHAR NOT NULL, data_limit REAL NULL, expire_at INTEGER NULL, PRIMARY KEY (id)
+        )
+    """)
+
+
+def migrate_handshake_column(cur, table, create_table):
+    """
+    Rebuild a peer table from before latest handshakes were stored as epochs. The text they
+    held, e.g. "0:01:23", has no date, so it becomes 0 until the next collection.
+    @param cur: sqlite3.Cursor
+    @param table: Peer table
+    @param create_table: Statement creating the peer table under the name {table}_migrate
+    @return: Whether the table was rebuilt
+    @rtype: bool
+    """
+    columns = {row[1]: row[2] for row in cur.execute(f"PRAGMA table_info({table})")}
+    if columns.get("latest_handshake", "INTEGER").upper() == "INTEGER":
+        return False
+    select = ", ".join("CASE WHEN latest_handshake GLOB '[0-9]*' AND latest_handshake NOT GLOB '*[^0-9]*' "
+                       "THEN CAST(latest_handshake AS INTEGER) ELSE 0 END" if c == "latest_handshake" else c
+                       for c in PEER_SELECT.split(", "))
+    cur.execute(f"DROP TABLE IF EXISTS {table}_migrate")
+    cur.execute(create_table)
+    cur.execute(f"INSERT INTO {table}_migrate ({PEER_SELECT}) SELECT {select} FROM {table}")
+    cur.execute(f"DROP TABLE {table}")
+    cur.execute(f"ALTER TABLE {table}_migrate RENAME TO {table}")
+    return True
+
+
+def restrict_table(config_name):
+    """
+    @param config_name: Configuration name
+    @return: Name of the table of the suspended peers of the configuration
+    @rtype: str
+    """
+    return config_name + "_restrict_access"
+
+
+def policy_table(config_name):
+    """
+    @param config_name: Configuration name
+    @return: Name of the table of the data quotas and expiry times of the configuration
+    @rtype: str
+    """
+    return config_name + "_policy"
+
+
+def event_table(config_name):
+    """
+    @param config_name: Configuration name
+    @return: Name of the table of the session events of the configuration
+    @rtype: str
+    """
+    return config_name + "_events"
+
+
+def policy_version(config_name):
+    """
+    @param config_name: Configuration name
+    @return: Version of the policies of the configuration, 0 if they never changed
+    @rtype: int
+    """
+    row = g.cur.execute("SELECT version FROM policy_versions WHERE config_name = ?", (config_name,)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def bump_policy_version(config_name):
+    """
+    Make every worker process reload the policies of a configuration, after they or the
+    peers they apply to changed, once the transaction is committed
+    @param config_name: Configuration name
+    @return: None
+    """
+    g.cur.execute("INSERT OR IGNORE INTO policy_versions (config_name, version) VALUES (?, 0)", (config_name,))
+    g.cur.execute("UPDATE policy_versions SET version = version + 1 WHERE config_name = ?", (config_name,))
+
+
+def load_policies(config_name):
+    """
+    @param config_name: Configuration name
+    @return: Rows of (id, data_limit, expire_at, cumu_data) of the active peers with a policy
+    @rtype: list
+    """
+    return g.cur.execute(f"SELECT q.id, q.data_limit, q.expire_at, p.cumu_data FROM {policy_table(config_name)} q "
+                         f"JOIN {config_name} p ON p.id = q.id").fetchall()
 
 
 def get_conf_list():
@@ -485,27 +915,21 @@ def get_conf_list():
     """
 
     conf = []
+    names = []
     for i in os.listdir(WG_CONF_PATH):
         if regex_match("^(.{1,}).(conf)$", i):
             i = i.replace('.conf', '')
-            create_table = f"""
-                CREATE TABLE IF NOT EXISTS {i} (
-                    id VARCHAR NOT NULL, private_key VARCHAR NULL, DNS VARCHAR NULL, 
-                    endpoint_allowed_ip VARCHAR NULL, name VARCHAR NULL, total_receive FLOAT NULL, 
-                    total_sent FLOAT NULL, total_data FLOAT NULL, endpoint VARCHAR NULL, 
-                    status VARCHAR NULL, latest_handshake VARCHAR NULL, allowed_ip VARCHAR NULL, 
-                    cumu_receive FLOAT NULL, cumu_sent FLOAT NULL, cumu_data FLOAT NULL, mtu INT NULL, 
-                    keepalive INT NULL, remote_endpoint VARCHAR NULL, preshared_key VARCHAR NULL, 
-                    PRIMARY KEY (id)
-                )
-            """
-            g.cur.execute(create_table)
-            temp = {"conf": i, "status": get_conf_status(i), "public_key": get_conf_pub_key(i)}
-            if temp['status'] == "running":
-                temp['checked'] = 'checked'
-            else:
-                temp['checked'] = ""
-            conf.append(temp)
+            create_peer_table(g.cur, i)
+            names.append(i)
+    # Status and public key of each interface are independent subprocess and file reads
+    for i, status, public_key in collector().map(
+            lambda name: (name, get_conf_status(name), get_conf_pub_key(name)), names):
+        temp = {"conf": i, "status": status, "public_key": public_key}
+        if temp['status'] == "running":
+            temp['checked'] = 'checked'
+        else:
+            temp['checked'] = ""
+        conf.append(temp)
     if len(conf) > 0:
         conf = sorted(conf, key=itemgetter('conf'))
     return conf
@@ -520,17 +944,10 @@ def gen_public_key(private_key):
     @rtype: dict
     """
 
-    with open('private_key.txt', 'w', encoding='utf-8') as file_object:
-        file_object.write(private_key)
     try:
-        subprocess.check_output("wg pubkey < private_key.txt > public_key.txt", shell=True)
-        with open('public_key.txt', encoding='utf-8') as file_object:
-            public_key = file_object.readline().strip()
-        os.remove('private_key.txt')
-        os.remove('public_key.txt')
+        public_key = data_source().public_key(private_key)
         return {"status": 'success', "msg": "", "data": public_key}
-    except subprocess.CalledProcessError:
-        os.remove('private_key.txt')
+    except PeerControlError:
         return {"status": 'failed', "msg": "Key is not the correct length or format", "data": ""}
 
 
@@ -571,11 +988,9 @@ def check_repeat_allowed_ip(public_key, ip, config_name):
     if peer[0] != 1:
         return {'status': 'failed', 'msg': 'Peer does not exist'}
     else:
-        existed_ip = g.cur.execute("SELECT COUNT(*) FROM " +
-                                   config_name + " WHERE id != ? AND allowed_ip LIKE '" + ip + "/%'", (public_key,)) \
-            .fetchone()
-        if existed_ip[0] != 0:
-            return {'status': 'failed', 'msg': "Allowed IP already taken by another peer."}
+        conflict = allowed_ip_conflict(config_name, ip, public_key)
+        if conflict is not None:
+            return {'status': 'failed', 'msg': conflict}
         else:
             return {'status': 'success'}
 
@@ -624,11 +1039,62 @@ def close_DB(exception):
     @param exception: Exception
     @return: None
     """
+    end_render_span(None, None, None)
     if hasattr(g, 'db'):
         g.db.commit()
         g.db.close()
 
 
+@app.before_request
+def start_request_timer():
+    """
+    Remember when the request started, for the latency metrics
+    @return: None
+    """
+    g.request_start = time.perf_counter()
+    tracing.begin()
+
+
+@app.after_request
+def record_request_latency(response):
+    """
+    Record the latency of every request
+    @param response: Flask response
+    @return: Flask response
+    """
+    if hasattr(g, 'request_start'):
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - g.request_start, str(request.endpoint),
+                                        request.method)
+    # A template that raised never sent template_rendered
+    end_render_span(None, None, None)
+    trace = tracing.end()
+    if trace is not None:
+        response.headers["Server-Timing"] = tracing.server_timing(*trace)
+        if request.endpoint != "static":
+            endpoint_stats.record(str(request.endpoint), *trace)
+    return response
+
+
+@before_render_template.connect_via(app)
+def start_render_span(sender, template, context, **extra):
+    """
+    Time template rendering as the "render" phase of the request
+    """
+    render_span = tracing.span("render")
+    render_span.__enter__()
+    g.render_span = render_span
+
+
+@template_rendered.connect_via(app)
+def end_render_span(sender, template, context, **extra):
+    """
+    End the "render" phase started by start_render_span, if still open
+    """
+    render_span = g.pop('render_span', None)
+    if render_span is not None:
+        render_span.__exit__(None, None, None)
+
+
 @app.before_request
 def auth_req():
     """
@@ -642,6 +1108,9 @@ def auth_req():
     req = conf.get("Server", "auth_req")
     session['update'] = UPDATE
     session['dashboard_version'] = DASHBOARD_VERSION
+    if request.endpoint == "metrics_endpoint" and metrics_authorized(conf):
+        conf.clear()
+        return None
     if req == "true":
         if '/static/' not in request.path and \
                 request.endpoint != "signin" and \
@@ -667,6 +1136,18 @@ def auth_req():
     return None
 
 
+def metrics_authorized(conf):
+    """
+    Check the bearer token of a metrics scrape, scrapers can not sign in
+    @param conf: Dashboard configuration
+    @return: True if a metrics token is set and the request carries it
+    @rtype: bool
+    """
+    token = conf.get("Server", "metrics_token", fallback="")
+    authorization = request.headers.get("Authorization", "")
+    return len(token) > 0 and secrets.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+
+
 """
 Sign In / Sign Out
 """
@@ -761,6 +1242,48 @@ def settings():
                            peer_remote_endpoint=config.get("Peers", "remote_endpoint"))
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Rolling request timings per endpoint, and the sampling profiler
+    @return: Template
+    """
+    config = get_dashboard_conf()
+    profiler_enabled = config.getboolean("Server", "profiler", fallback=False)
+    config.clear()
+    return render_template('stats.html', conf=get_conf_list(), stats=endpoint_stats.summary(),
+                           window=endpoint_stats.window, pid=os.getpid(), profiler_enabled=profiler_enabled,
+                           profiler_running=profiler.running(), profiler_samples=profiler.samples,
+                           profiler_interval=profiler.interval)
+
+
+@app.route('/stats/profiler', methods=['POST'])
+def stats_profiler():
+    """
+    Start or stop the sampling profiler of this process
+    @return: Redirect
+    """
+    config = get_dashboard_conf()
+    if config.getboolean("Server", "profiler", fallback=False):
+        if request.form.get('action') == "start":
+            profiler.interval = config.getfloat("Server", "profiler_interval", fallback=tracing.PROFILER_INTERVAL)
+            profiler.start()
+        else:
+            profiler.stop()
+    config.clear()
+    return redirect(url_for("stats"))
+
+
+@app.route('/stats/profile', methods=['GET'])
+def stats_profile():
+    """
+    Download the sampled stacks in the collapsed format of flamegraph.pl
+    @return: Text file
+    """
+    return app.response_class(profiler.collapsed(), mimetype="text/plain", headers={
+        "Content-Disposition": f"attachment; filename=wgdashboard-{os.getpid()}.folded"})
+
+
 @app.route('/update_acct', methods=['POST'])
 def update_acct():
     """
@@ -1015,7 +1538,6 @@ def get_conf(config_name):
     @return: TODO
     """
 
-    config_interface = read_conf_file_interface(config_name)
     search = request.args.get('search')
     if len(search) == 0:
         search = ""
@@ -1024,30 +1546,144 @@ def get_conf(config_name):
     sort = config.get("Server", "dashboard_sort")
     peer_display_mode = config.get("Peers", "peer_display_mode")
     wg_ip = config.get("Peers", "remote_endpoint")
+    refresh_interval = int(config.get("Server", "dashboard_refresh_interval"))
+    window = config.getfloat("Server", "coalesce_window", fallback=COALESCE_WINDOW)
+    config.clear()
+    # Viewers polling the same page at the same time share one refresh
+    key = (config_name, search, sort, peer_display_mode, wg_ip, refresh_interval)
+    return json_response(conf_flights.do(key, lambda: conf_response(key), window))
+
+
+def conf_response(key):
+    """
+    Build the configuration page data, or take it from the cache if nothing changed since
+    @param key: Tuple of configuration name, search, sort, peer display mode, remote endpoint
+                and refresh interval
+    @return: serializer.CachedResponse
+    """
+    config_name, search, sort, peer_display_mode, wg_ip, refresh_interval = key
+    # The response only changes with the snapshot, the configuration file or the database
+    snapshot = refresh_peers(config_name)
+    version = (snapshot.time, conf_version(config_name), file_version(os.path.join(DB_PATH, 'wgdashboard.db')))
+    cached = conf_responses.get(key, version)
+    if cached is not None:
+        return cached
+    config_interface = read_conf_file_interface(config_name)
     if "Address" not in config_interface:
         conf_address = "N/A"
     else:
         conf_address = config_interface['Address']
+    peer_data = get_peers(config_name, search, sort)
     conf_data = {
-        "peer_data": get_peers(config_name, search, sort),
         "name": config_name,
         "status": get_conf_status(config_name),
         "total_data_usage": get_conf_total_data(config_name),
         "public_key": get_conf_pub_key(config_name),
         "listen_port": get_conf_listen_port(config_name),
         "running_peer": get_conf_running_peer_number(config_name),
+        "time": int(snapshot.time),
         "conf_address": conf_address,
         "wg_ip": wg_ip,
         "sort_tag": sort,
-        "dashboard_refresh_interval": int(config.get("Server", "dashboard_refresh_interval")),
+        "dashboard_refresh_interval": refresh_interval,
         "peer_display_mode": peer_display_mode
     }
     if conf_data['status'] == "stopped":
         conf_data['checked'] = "nope"
     else:
         conf_data['checked'] = "checked"
-    config.clear()
-    return jsonify(conf_data)
+    # Peers are encoded straight from their rows, then the rest of the object is appended
+    with tracing.span("render"):
+        body = b'{"peer_data":' + serializer.peers_json(peer_data) + b"," + serializer.dumps(conf_data)[1:]
+    return conf_responses.put(key, version, body)
+
+
+# Search peers without refreshing them from WireGuard
+@app.route('/search_peers/<config_name>', methods=['GET'])
+def search_peers(config_name):
+    """
+    Type-ahead search of peers by name, public key, tunnel IP or endpoint.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON object with the matching peers
+    @rtype: str
+    """
+
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', '')
+    limit = int(limit) if limit.isdigit() else 50
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist.", "peers": []})
+    ids = search_peer_ids(config_name, query, limit)
+    rows = {}
+    # Stay under SQLite's default limit of 999 variables per statement
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        for row in g.cur.execute("SELECT id, name, allowed_ip, endpoint, status FROM " + config_name +
+                                 " WHERE id IN (" + ",".join("?" * len(chunk)) + ")", chunk):
+            rows[row[0]] = row
+    peers = [{"id": row[0], "name": row[1], "allowed_ip": row[2], "endpoint": row[3], "status": row[4]}
+             for row in (rows.get(i) for i in ids) if row is not None]
+    return jsonify({"status": True, "msg": "", "peers": peers})
+
+
+# Overlap, containment and owner of an allowed IP
+@app.route('/lookup_allowed_ip/<config_name>', methods=['GET'])
+def lookup_allowed_ip(config_name):
+    """
+    Find the peer owning an address, the peers' allowed IPs containing a network and the ones inside it.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON object with the owner, containing and contained allowed IPs
+    @rtype: str
+    """
+
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist."})
+    try:
+        network = ipaddress.ip_network(request.args.get('ip', '').strip(), strict=False)
+    except ValueError:
+        return jsonify({"status": False, "msg": "Please provide an IP address or a network, e.g. 10.0.0.0/24."})
+    owner, containing, contained = allowed_ip_index.lookup(config_name, conf_version(config_name),
+                                                           lambda: load_index_rows(config_name), network)
+    return jsonify({"status": True, "msg": "", "network": str(network),
+                    "owner": None if owner is None else {"network": str(owner[0]), "id": owner[1]},
+                    "containing": [{"network": str(n), "id": i} for n, i in containing],
+                    "contained": [{"network": str(n), "id": i} for n, i in contained]})
+
+
+# Import peers from a file
+@app.route('/import_peers/<config_name>', methods=['POST'])
+def import_peers_file(config_name):
+    """
+    Import peers from an uploaded CSV, JSON Lines or JSON file, or a client configuration.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON report of the import
+    @rtype: str
+    """
+
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist."})
+    upload = request.files.get('file')
+    name = upload.filename if upload is not None else request.args.get('filename', '')
+    file_format = request.args.get('format') or detect_format(name or "")
+    if file_format not in IMPORT_FORMATS:
+        return jsonify({"status": False, "msg": "Unknown file format, use csv, jsonl, json or conf."})
+    batch_size = request.args.get('batch_size', '')
+    batch_size = int(batch_size) if batch_size.isdigit() and int(batch_size) > 0 else IMPORT_BATCH_SIZE
+    # The file is read as it is validated, not loaded whole
+    stream = io.TextIOWrapper(upload.stream if upload is not None else request.stream, encoding="utf-8-sig",
+                              newline="")
+    try:
+        records = read_records(stream, file_format, os.path.splitext(name or config_name)[0])
+        report = run_import(config_name, records, batch_size, request.args.get('dry_run') == "true")
+    except (ValueError, csv.Error, configparser.Error) as exc:
+        return jsonify({"status": False, "msg": f"Unable to read the file: {exc}"})
+    return jsonify(report)
 
 
 # Turn on / off a configuration
@@ -1061,20 +1697,15 @@ def switch(config_name):
     """
 
     status = get_conf_status(config_name)
-    if status == "running":
-        try:
-            check = subprocess.check_output("wg-quick down " + config_name,
-                                            shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as exc:
-            session["switch_msg"] = exc.output.strip().decode("utf-8")
-            return redirect('/')
-    elif status == "stopped":
-        try:
-            subprocess.check_output("wg-quick up " + config_name,
-                                    shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as exc:
-            session["switch_msg"] = exc.output.strip().decode("utf-8")
-            return redirect('/')
+    try:
+        if status == "running":
+            data_source().down(config_name)
+        elif status == "stopped":
+            data_source().up(config_name)
+    except PeerControlError as exc:
+        session["switch_msg"] = str(exc)
+        return redirect('/')
+    peers_changed(config_name)
     return redirect(request.referrer)
 
 
@@ -1108,41 +1739,27 @@ def add_peer_bulk(config_name):
     ips = f_available_ips(config_name)
     if amount > len(ips):
         return f"Cannot create more than {len(ips)} peers."
-    wg_command = ["wg", "set", config_name]
+    changes = []
     sql_command = []
     for i in range(amount):
         keys[i]['name'] = f"{config_name}_{datetime.now().strftime('%m%d%Y%H%M%S')}_Peer_#_{(i + 1)}"
-        wg_command.append("peer")
-        wg_command.append(keys[i]['publicKey'])
         keys[i]['allowed_ips'] = ips.pop(0)
-        if enable_preshared_key:
-            keys[i]['psk_file'] = f"{keys[i]['name']}.txt"
-            f = open(keys[i]['psk_file'], "w+")
-            f.write(keys[i]['presharedKey'])
-            f.close()
-            wg_command.append("preshared-key")
-            wg_command.append(keys[i]['psk_file'])
-        else:
-            keys[i]['psk_file'] = ""
-        wg_command.append("allowed-ips")
-        wg_command.append(keys[i]['allowed_ips'])
+        changes.append(PeerChange(keys[i]['publicKey'], keys[i]['allowed_ips'],
+                                  keys[i]['presharedKey'] if enable_preshared_key else None))
         update = ["UPDATE ", config_name, " SET name = '", keys[i]['name'],
                   "', private_key = '", keys[i]['privateKey'], "', DNS = '", dns_addresses,
                   "', endpoint_allowed_ip = '", endpoint_allowed_ip, "' WHERE id = '", keys[i]['publicKey'], "'"]
         sql_command.append(update)
     try:
-        status = subprocess.check_output(" ".join(wg_command), shell=True, stderr=subprocess.STDOUT)
-        status = subprocess.check_output("wg-quick save " + config_name, shell=True, stderr=subprocess.STDOUT)
-        get_all_peers_data(config_name)
-        if enable_preshared_key:
-            for i in keys:
-                os.remove(i['psk_file'])
+        save_peer_changes(config_name, changes)
+        sync_peers(config_name)
         for i in range(len(sql_command)):
             sql_command[i] = "".join(sql_command[i])
         g.cur.executescript("; ".join(sql_command))
+        peers_changed(config_name)
         return "true"
-    except subprocess.CalledProcessError as exc:
-        return exc.output.strip()
+    except PeerControlError as exc:
+        return str(exc)
 
 
 @app.route('/add_peer/<config_name>', methods=['POST'])
@@ -1166,11 +1783,9 @@ def add_peer(config_name):
         return config_name + " is not running."
     if public_key in keys:
         return "Public key already exist."
-    check_dup_ip = g.cur.execute(
-        "SELECT COUNT(*) FROM " + config_name + " WHERE allowed_ip LIKE '" + allowed_ips + "/%'", ) \
-        .fetchone()
-    if check_dup_ip[0] != 0:
-        return "Allowed IP already taken by another peer."
+    conflict = allowed_ip_conflict(config_name, allowed_ips)
+    if conflict is not None:
+        return conflict
     if len(dns_addresses) > 0 and not check_DNS(dns_addresses):
         return "DNS formate is incorrect. Example: 1.1.1.1"
     if not check_Allowed_IPs(endpoint_allowed_ip):
@@ -1180,26 +1795,15 @@ def add_peer(config_name):
     if len(data['keep_alive']) == 0 or not data['keep_alive'].isdigit():
         return "Persistent Keepalive format is not correct."
     try:
-        if enable_preshared_key:
-            now = str(datetime.now().strftime("%m%d%Y%H%M%S"))
-            f_name = now + "_tmp_psk.txt"
-            f = open(f_name, "w+")
-            f.write(preshared_key)
-            f.close()
-            status = subprocess.check_output(
-                f"wg set {config_name} peer {public_key} allowed-ips {allowed_ips} preshared-key {f_name}",
-                shell=True, stderr=subprocess.STDOUT)
-            os.remove(f_name)
-        elif not enable_preshared_key:
-            status = subprocess.check_output(f"wg set {config_name} peer {public_key} allowed-ips {allowed_ips}",
-                                             shell=True, stderr=subprocess.STDOUT)
-        status = subprocess.check_output("wg-quick save " + config_name, shell=True, stderr=subprocess.STDOUT)
-        get_all_peers_data(config_name)
+        save_peer_changes(config_name, [
+            PeerChange(public_key, allowed_ips, preshared_key if enable_preshared_key else None)])
+        sync_peers(config_name)
         sql = "UPDATE " + config_name + " SET name = ?, private_key = ?, DNS = ?, endpoint_allowed_ip = ? WHERE id = ?"
         g.cur.execute(sql, (data['name'], data['private_key'], data['DNS'], endpoint_allowed_ip, public_key))
+        peers_changed(config_name)
         return "true"
-    except subprocess.CalledProcessError as exc:
-        return exc.output.strip()
+    except PeerControlError as exc:
+        return str(exc)
 
 
 @app.route('/remove_peer/<config_name>', methods=['POST'])
@@ -1221,22 +1825,21 @@ def remove_peer(config_name):
         return config_name + " is not running."
     else:
         sql_command = []
-        wg_command = ["wg", "set", config_name]
+        changes = []
         for delete_key in delete_keys:
             if delete_key not in keys:
                 return "This key does not exist"
             sql_command.append("DELETE FROM " + config_name + " WHERE id = '" + delete_key + "';")
-            wg_command.append("peer")
-            wg_command.append(delete_key)
-            wg_command.append("remove")
+            sql_command.append("DELETE FROM " + policy_table(config_name) + " WHERE id = '" + delete_key + "';")
+            changes.append(PeerChange(delete_key, remove=True))
         try:
-            remove_wg = subprocess.check_output(" ".join(wg_command),
-                                                shell=True, stderr=subprocess.STDOUT)
-            save_wg = subprocess.check_output(f"wg-quick save {config_name}", shell=True, stderr=subprocess.STDOUT)
+            save_peer_changes(config_name, changes)
             g.cur.executescript(' '.join(sql_command))
+            bump_policy_version(config_name)
             g.db.commit()
-        except subprocess.CalledProcessError as exc:
-            return exc.output.strip()
+            peers_changed(config_name)
+        except PeerControlError as exc:
+            return str(exc)
         return "true"
 
 
@@ -1261,7 +1864,7 @@ def save_peer_setting(config_name):
     check_peer_exist = g.cur.execute("SELECT COUNT(*) FROM " + config_name + " WHERE id = ?", (id,)).fetchone()
     if check_peer_exist[0] == 1:
         check_ip = check_repeat_allowed_ip(id, allowed_ip, config_name)
-        if not check_IP_with_range(endpoint_allowed_ip):
+        if not check_Allowed_IPs(endpoint_allowed_ip):
             return jsonify({"status": "failed", "msg": "Endpoint Allowed IPs format is incorrect."})
         if len(dns_addresses) > 0 and not check_DNS(dns_addresses):
             return jsonify({"status": "failed", "msg": "DNS format is incorrect."})
@@ -1276,32 +1879,451 @@ def save_peer_setting(config_name):
         if check_ip['status'] == "failed":
             return jsonify(check_ip)
         try:
-            tmp_psk = open("tmp_edit_psk.txt", "w+")
-            tmp_psk.write(preshared_key)
-            tmp_psk.close()
-            change_psk = subprocess.check_output(f"wg set {config_name} peer {id} preshared-key tmp_edit_psk.txt",
-                                                 shell=True, stderr=subprocess.STDOUT)
-            if change_psk.decode("UTF-8") != "":
-                return jsonify({"status": "failed", "msg": change_psk.decode("UTF-8")})
-            if allowed_ip == "":
-                allowed_ip = '""'
-            allowed_ip = allowed_ip.replace(" ", "")
-            change_ip = subprocess.check_output(f"wg set {config_name} peer {id} allowed-ips {allowed_ip}",
-                                                shell=True, stderr=subprocess.STDOUT)
-            subprocess.check_output(f'wg-quick save {config_name}', shell=True, stderr=subprocess.STDOUT)
-            if change_ip.decode("UTF-8") != "":
-                return jsonify({"status": "failed", "msg": change_ip.decode("UTF-8")})
+            save_peer_changes(config_name, [PeerChange(id, allowed_ip.replace(" ", ""), preshared_key)])
             sql = "UPDATE " + config_name + " SET name = ?, private_key = ?, DNS = ?, endpoint_allowed_ip = ?, mtu = ?, keepalive = ?, preshared_key = ? WHERE id = ?"
             g.cur.execute(sql, (name, private_key, dns_addresses, endpoint_allowed_ip, data["MTU"],
                                 data["keep_alive"], preshared_key, id))
+            peers_changed(config_name)
             return jsonify({"status": "success", "msg": ""})
-        except subprocess.CalledProcessError as exc:
-            return jsonify({"status": "failed", "msg": str(exc.output.decode("UTF-8").strip())})
+        except PeerControlError as exc:
+            return jsonify({"status": "failed", "msg": str(exc)})
     else:
         return jsonify({"status": "failed", "msg": "This peer does not exist."})
 
 
-# Get peer settings
+def select_peer_ids(config_name, data, table=None):
+    """
+    Get the peers a bulk action applies to
+    @param config_name: Name of WG interface
+    @param data: Request with peer_ids, a list of IDs, search, a search string, or all set to true
+    @param table: Table the peers are selected from, the peer table of the configuration by default
+    @return: IDs of the selected peers, None if the request selects nothing
+    @rtype: list, None
+    """
+    table = table or config_name
+    if isinstance(data.get('peer_ids'), list):
+        existing = set(i[0] for i in g.cur.execute("SELECT id FROM " + table))
+        # IDs are public keys, other JSON values can not be one
+        return [i for i in data['peer_ids'] if isinstance(i, str) and i in existing]
+    if isinstance(data.get('search'), str) and len(data['search']) > 0 and table == config_name:
+        return search_peer_ids(config_name, data['search'])
+    if data.get('all') is True:
+        return [i[0] for i in g.cur.execute("SELECT id FROM " + table)]
+    return None
+
+
+def fetch_peer_rows(table, ids):
+    """
+    @param table: Peer table
+    @param ids: Peer IDs
+    @return: Rows with the columns of peer_model.PEER_COLUMNS, in table order
+    @rtype: list
+    """
+    rows = []
+    # Stay under SQLite's default limit of 999 variables per statement
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows += g.cur.execute("SELECT " + PEER_SELECT + " FROM " + table + " WHERE id IN (" +
+                              ",".join("?" * len(chunk)) + ")", chunk).fetchall()
+    return rows
+
+
+def suspend_peers(config_name, ids):
+    """
+    Remove peers from WireGuard and the configuration file with one update, keeping their
+    settings in the table of suspended peers
+    @param config_name: Configuration name
+    @param ids: IDs of the peers to suspend
+    @return: Number of peers suspended
+    @rtype: int
+    @raise PeerControlError: When WireGuard rejected the changes
+    """
+    rows = fetch_peer_rows(config_name, ids)
+    if len(rows) == 0:
+        return 0
+    save_peer_changes(config_name, [PeerChange(row[0], remove=True) for row in rows])
+    g.cur.executemany(f"INSERT OR REPLACE INTO {restrict_table(config_name)} ({PEER_SELECT}) VALUES ({PEER_INSERT})",
+                      rows)
+    g.cur.executemany(f"DELETE FROM {config_name} WHERE id = ?", [(row[0],) for row in rows])
+    peers_changed(config_name)
+    return len(rows)
+
+
+def restore_peers(config_name, ids):
+    """
+    Add suspended peers back to WireGuard and the configuration file with one update,
+    unless another peer took their allowed IPs meanwhile
+    @param config_name: Configuration name
+    @param ids: IDs of the suspended peers to restore
+    @return: Tuple of (number of peers restored, list of {"id", "msg"} of the ones kept suspended)
+    @rtype: tuple
+    @raise PeerControlError: When WireGuard rejected the changes
+    """
+    allowed_ip = COLUMN_INDEX["allowed_ip"]
+    preshared_key = COLUMN_INDEX["preshared_key"]
+    rows = []
+    conflicts = []
+    for row in fetch_peer_rows(restrict_table(config_name), ids):
+        conflict = allowed_ip_conflict(config_name, row[allowed_ip])
+        if conflict is None:
+            rows.append(row)
+        else:
+            conflicts.append({"id": row[0], "msg": conflict})
+    if len(rows) == 0:
+        return 0, conflicts
+    save_peer_changes(config_name, [
+        PeerChange(row[0], [] if row[allowed_ip] == "(None)" else row[allowed_ip], row[preshared_key] or None)
+        for row in rows])
+    # Replaces the rows a concurrent refresh may have created for the restored peers
+    g.cur.executemany(f"INSERT OR REPLACE INTO {config_name} ({PEER_SELECT}) VALUES ({PEER_INSERT})", rows)
+    g.cur.executemany(f"DELETE FROM {restrict_table(config_name)} WHERE id = ?", [(row[0],) for row in rows])
+    peers_changed(config_name)
+    bump_policy_version(config_name)
+    return len(rows), conflicts
+
+
+# Columns a bulk edit can change, with their validation and error message
+BULK_EDIT_FIELDS = {
+    "DNS": ("DNS", is_dns, "DNS format is incorrect."),
+    "endpoint_allowed_ip": ("endpoint_allowed_ip", is_allowed_ips, "Endpoint Allowed IPs format is incorrect."),
+    "MTU": ("mtu", is_number, "MTU format is not correct."),
+    "keep_alive": ("keepalive", is_number, "Persistent Keepalive format is not correct.")
+}
+
+
+# Edit many peers at once
+@app.route('/bulk_edit_peers/<config_name>', methods=['POST'])
+def bulk_edit_peers(config_name):
+    """
+    Apply the same settings to a set of peers: the ones listed in peer_ids, the ones matching
+    search, or all of them with all set to true. Database settings are changed in one
+    transaction, a pre-shared key in one WireGuard update and one configuration save.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return status of action and number of peers changed
+    @rtype: str
+    """
+
+    data = request.get_json()
+    patch = data.get('patch', {})
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": "failed", "msg": "Configuration does not exist."})
+    if not isinstance(patch, dict):
+        return jsonify({"status": "failed", "msg": "Patch must map fields to values."})
+    columns = []
+    values = []
+    for field, value in patch.items():
+        value = str(value).strip()
+        if field == "preshared_key":
+            if len(value) > 0 and not is_key(value):
+                return jsonify({"status": "failed", "msg": "Pre-shared key is not a WireGuard key."})
+            continue
+        if field not in BULK_EDIT_FIELDS:
+            return jsonify({"status": "failed", "msg": f"{field} can not be edited in bulk."})
+        column, check, message = BULK_EDIT_FIELDS[field]
+        if not check(value):
+            return jsonify({"status": "failed", "msg": message})
+        columns.append(column)
+        values.append(value)
+    if len(columns) == 0 and "preshared_key" not in patch:
+        return jsonify({"status": "failed", "msg": "Nothing to change."})
+    ids = select_peer_ids(config_name, data)
+    if ids is None:
+        return jsonify({"status": "failed", "msg": "Select the peers with peer_ids, search or all."})
+    if len(ids) == 0:
+        return jsonify({"status": "success", "msg": "", "updated": 0})
+    if "preshared_key" in patch:
+        preshared_key = str(patch['preshared_key']).strip()
+        try:
+            save_peer_changes(config_name, [PeerChange(i, preshared_key=preshared_key) for i in ids])
+        except PeerControlError as exc:
+            return jsonify({"status": "failed", "msg": str(exc)})
+        columns.append("preshared_key")
+        values.append(preshared_key)
+    g.cur.executemany("UPDATE " + config_name + " SET " + ", ".join(c + " = ?" for c in columns) + " WHERE id = ?",
+                      [values + [i] for i in ids])
+    peers_changed(config_name)
+    return jsonify({"status": "success", "msg": "", "updated": len(ids)})
+
+
+# Suspend peers
+@app.route('/suspend_peers/<config_name>', methods=['POST'])
+def suspend_peers_request(config_name):
+    """
+    Suspend the peers listed in peer_ids, the ones matching search, or all of them with all set to true.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return status of action and number of peers suspended
+    @rtype: str
+    """
+
+    data = request.get_json()
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": "failed", "msg": "Configuration does not exist."})
+    if get_conf_status(config_name) == "stopped":
+        return jsonify({"status": "failed", "msg": "Your need to turn on " + config_name + " first."})
+    ids = select_peer_ids(config_name, data)
+    if ids is None:
+        return jsonify({"status": "failed", "msg": "Select the peers with peer_ids, search or all."})
+    try:
+        suspended = suspend_peers(config_name, ids)
+    except PeerControlError as exc:
+        return jsonify({"status": "failed", "msg": str(exc)})
+    return jsonify({"status": "success", "msg": "", "suspended": suspended})
+
+
+# Restore suspended peers
+@app.route('/restore_peers/<config_name>', methods=['POST'])
+def restore_peers_request(config_name):
+    """
+    Restore the suspended peers listed in peer_ids, or all of them with all set to true.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return status of action, number of peers restored and the ones left suspended
+    @rtype: str
+    """
+
+    data = request.get_json()
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": "failed", "msg": "Configuration does not exist."})
+    if get_conf_status(config_name) == "stopped":
+        return jsonify({"status": "failed", "msg": "Your need to turn on " + config_name + " first."})
+    create_peer_table(g.cur, config_name)
+    ids = select_peer_ids(config_name, data, restrict_table(config_name))
+    if ids is None:
+        return jsonify({"status": "failed", "msg": "Select the peers with peer_ids or all."})
+    try:
+        restored, conflicts = restore_peers(config_name, ids)
+    except PeerControlError as exc:
+        return jsonify({"status": "failed", "msg": str(exc)})
+    return jsonify({"status": "success", "msg": "", "restored": restored, "conflicts": conflicts})
+
+
+# List suspended peers
+@app.route('/suspended_peers/<config_name>', methods=['GET'])
+def suspended_peers(config_name):
+    """
+    Get the suspended peers of a configuration.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON object with the suspended peers
+    @rtype: str
+    """
+
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist.", "peers": []})
+    create_peer_table(g.cur, config_name)
+    rows = g.cur.execute("SELECT id, name, allowed_ip, total_data, cumu_data FROM " +
+                         restrict_table(config_name)).fetchall()
+    return jsonify({"status": True, "msg": "", "peers": [
+        {"id": row[0], "name": row[1], "allowed_ip": row[2], "total_data": row[3], "cumu_data": row[4]}
+        for row in rows]})
+
+
+def parse_epoch(value):
+    """
+    @param value: Epoch, date and time in ISO format, e.g. "2026-12-31 23:59", or None
+    @return: Epoch, None if value is None or empty
+    @rtype: int, None
+    @raise ValueError: When value is neither
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if not math.isfinite(value):
+            raise ValueError(value)
+        return int(value)
+    if isinstance(value, str):
+        if value.isdigit():
+            return int(value)
+        return int(datetime.fromisoformat(value).timestamp())
+    raise ValueError(value)
+
+
+# Set data quotas and expiry times
+@app.route('/peer_policy/<config_name>', methods=['POST'])
+def set_peer_policy(config_name):
+    """
+    Set the data quota, in GB of total and cumulative data, and the expiry time of the peers
+    listed in peer_ids, matching search, or of all of them with all set to true. Both set
+    to null remove the policy.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return status of action and number of peers changed
+    @rtype: str
+    """
+
+    data = request.get_json()
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": "failed", "msg": "Configuration does not exist."})
+    data_limit = data.get('data_limit')
+    if data_limit == "":
+        data_limit = None
+    if data_limit is not None:
+        try:
+            data_limit = float(data_limit)
+        except (TypeError, ValueError):
+            data_limit = -1
+        # NaN compares false with every threshold, a peer would never reach it
+        if not math.isfinite(data_limit) or data_limit < 0:
+            return jsonify({"status": "failed", "msg": "Data limit must be a number of GB."})
+    try:
+        expire_at = parse_epoch(data.get('expire_at'))
+    except ValueError:
+        return jsonify({"status": "failed", "msg": "Expiry time must be an epoch or a date like 2026-12-31 23:59."})
+    ids = select_peer_ids(config_name, data)
+    if ids is None:
+        return jsonify({"status": "failed", "msg": "Select the peers with peer_ids, search or all."})
+    if data_limit is None and expire_at is None:
+        g.cur.executemany(f"DELETE FROM {policy_table(config_name)} WHERE id = ?", [(i,) for i in ids])
+    else:
+        g.cur.executemany(f"INSERT OR REPLACE INTO {policy_table(config_name)} (id, data_limit, expire_at) "
+                          f"VALUES (?, ?, ?)", [(i, data_limit, expire_at) for i in ids])
+    bump_policy_version(config_name)
+    return jsonify({"status": "success", "msg": "", "changed": len(ids)})
+
+
+# List data quotas and expiry times
+@app.route('/peer_policy/<config_name>', methods=['GET'])
+def get_peer_policy(config_name):
+    """
+    Get the policies of a configuration, with the data used by each peer.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON object with the policies
+    @rtype: str
+    """
+
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist.", "policies": []})
+    create_peer_table(g.cur, config_name)
+    rows = g.cur.execute(f"SELECT q.id, q.data_limit, q.expire_at, p.name, p.total_data + p.cumu_data, "
+                         f"r.name, r.total_data + r.cumu_data FROM {policy_table(config_name)} q "
+                         f"LEFT JOIN {config_name} p ON p.id = q.id "
+                         f"LEFT JOIN {restrict_table(config_name)} r ON r.id = q.id "
+                         f"WHERE p.id IS NOT NULL OR r.id IS NOT NULL").fetchall()
+    return jsonify({"status": True, "msg": "", "policies": [
+        {"id": row[0], "data_limit": row[1], "expire_at": row[2], "name": row[3] if row[3] is not None else row[5],
+         "data_used": round(row[4] if row[4] is not None else (row[6] or 0), 4), "suspended": row[3] is None}
+        for row in rows]})
+
+
+# Online peers
+@app.route('/online_peers/<config_name>', methods=['GET'])
+def online_peers(config_name):
+    """
+    Get the peers with a handshake in the last minutes (2 by default), as of the last collection.
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON object with the number of online peers, and the peers unless count_only is set
+    @rtype: str
+    """
+
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist.", "peers": []})
+    try:
+        seconds = float(request.args.get('minutes', ONLINE_HANDSHAKE / 60)) * 60
+    except ValueError:
+        return jsonify({"status": False, "msg": "Minutes must be a number.", "peers": []})
+    if not math.isfinite(seconds) or seconds < 0:
+        return jsonify({"status": False, "msg": "Minutes must be a finite number, 0 or more.", "peers": []})
+    create_peer_table(g.cur, config_name)
+    if request.args.get('count_only', 'false') == 'true':
+        return jsonify({"status": True, "msg": "", "count": count_online_peers(config_name, seconds), "peers": []})
+    rows = g.cur.execute("SELECT id, name, allowed_ip, endpoint, latest_handshake FROM " + config_name +
+                         " WHERE latest_handshake >= ? ORDER BY latest_handshake DESC",
+                         (int(time.time() - seconds),)).fetchall()
+    return jsonify({"status": True, "msg": "", "count": len(rows), "peers": [
+        {"id": row[0], "name": row[1], "allowed_ip": row[2], "endpoint": row[3], "latest_handshake": row[4]}
+        for row in rows]})
+
+
+# Session events
+@app.route('/peer_events/<config_name>', methods=['GET'])
+def peer_events(config_name):
+    """
+    Get the connections, disconnections and endpoint changes of a configuration, newest first,
+    optionally of one peer (id) and between since and until (epoch or date).
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON object with the events
+    @rtype: str
+    """
+
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist.", "events": []})
+    try:
+        since = parse_epoch(request.args.get('since'))
+        until = parse_epoch(request.args.get('until'))
+        limit = min(max(int(request.args.get('limit', 100)), 1), 10000)
+    except ValueError:
+        return jsonify({"status": False, "msg": "Time must be an epoch or a date like 2026-12-31 23:59, "
+                                                "limit a number.", "events": []})
+    conditions = []
+    params = []
+    if len(request.args.get('id', '')) > 0:
+        conditions.append("id = ?")
+        params.append(request.args['id'])
+    if since is not None:
+        conditions.append("time >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("time <= ?")
+        params.append(until)
+    create_peer_table(g.cur, config_name)
+    rows = g.cur.execute(f"SELECT id, time, event, endpoint FROM {event_table(config_name)} " +
+                         ("WHERE " + " AND ".join(conditions) + " " if len(conditions) > 0 else "") +
+                         "ORDER BY time DESC LIMIT ?", params + [limit]).fetchall()
+    return jsonify({"status": True, "msg": "", "events": [
+        {"id": row[0], "time": row[1], "event": EVENT_TYPES[row[2]], "endpoint": row[3]} for row in rows]})
+
+
+# Heaviest peers
+@app.route('/top/<config_name>', methods=['GET'])
+def top_peers(config_name):
+    """
+    Get the peers with the highest throughput, averaged over window (10s, 1m or 5m).
+    @param config_name: Name of WG interface
+    @type config_name: str
+    @return: Return JSON object with the peers and their receive and sent rates in bytes per second
+    @rtype: str
+    """
+
+    window = request.args.get('window', '1m')
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or \
+            not os.path.isfile(os.path.join(WG_CONF_PATH, config_name + ".conf")):
+        return jsonify({"status": False, "msg": "Configuration does not exist.", "peers": []})
+    if window not in RATE_WINDOWS:
+        return jsonify({"status": False, "msg": "Window must be one of " + ", ".join(RATE_WINDOWS) + ".",
+                        "peers": []})
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), TOP_PEERS)
+    except ValueError:
+        return jsonify({"status": False, "msg": "Limit must be a number.", "peers": []})
+    # Keep the interface collected often enough for the shortest window while it is watched
+    collector().view(config_name, TOP_REFRESH_INTERVAL)
+    with tracing.span("collect"):
+        snapshot = collector().refresh(config_name, TOP_REFRESH_INTERVAL)
+    collected_at, top = None, []
+    if snapshot.rates is not None:
+        collected_at, top = snapshot.time, snapshot.rates.heaviest(window, limit)
+    names = {}
+    if len(top) > 0:
+        names = dict(g.cur.execute("SELECT id, name FROM " + config_name + " WHERE id IN (" +
+                                   ",".join("?" * len(top)) + ")", [i[0] for i in top]).fetchall())
+    return jsonify({"status": True, "msg": "", "window": window, "time": collected_at, "peers": [
+        {"id": key, "name": names.get(key, ""), "receive": round(rx, 1), "sent": round(tx, 1),
+         "total": round(rx + tx, 1)} for key, rx, tx in top]})
+
+
 @app.route('/get_peer_data/<config_name>', methods=['POST'])
 def get_peer_name(config_name):
     """
@@ -1548,30 +2570,53 @@ Dashboard Tools Related
 
 
 # Get all IP for ping
-@app.route('/get_ping_ip', methods=['POST'])
+@app.route('/get_ping_ip', methods=['GET', 'POST'])
 def get_ping_ip():
-    # TODO: convert return to json object
-
     """
     Get ips for network testing.
-    @return: HTML containing a list of IPs
-    """
-
-    config = request.form['config']
-    peers = g.cur.execute("SELECT id, name, allowed_ip, endpoint FROM " + config).fetchall()
-    html = ""
-    for i in peers:
-        html += '<optgroup label="' + i[1] + ' - ' + i[0] + '">'
-        allowed_ip = str(i[2]).split(",")
-        for k in allowed_ip:
-            k = k.split("/")
-            if len(k) == 2:
-                html += "<option value=" + k[0] + ">" + k[0] + "</option>"
-        endpoint = str(i[3]).split(":")
-        if len(endpoint) == 2:
-            html += "<option value=" + endpoint[0] + ">" + endpoint[0] + "</option>"
-        html += "</optgroup>"
-    return html
+    @return: Return JSON object with a list of peers and their IPs
+    """
+
+    config_name = request.values.get('config', '')
+    search = request.values.get('search', '')
+    limit = request.values.get('limit', '')
+    limit = int(limit) if limit.isdigit() else None
+    conf_location = os.path.join(WG_CONF_PATH, config_name + ".conf")
+    if not regex_match("^[A-Za-z0-9_=+.-]{1,15}$", config_name) or not os.path.isfile(conf_location):
+        return jsonify({"status": False, "msg": "Configuration does not exist.", "targets": []})
+    targets = peer_target_index.search(
+        config_name, os.stat(conf_location).st_mtime_ns,
+        lambda: g.cur.execute("SELECT id, name, allowed_ip, endpoint FROM " + config_name).fetchall(),
+        search, limit)
+    return jsonify({"status": True, "msg": "", "targets": targets})
+
+
+# Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Peer and interface metrics from the collector snapshots, and the dashboard's own metrics.
+    @return: Prometheus text format
+    @rtype: str
+    """
+
+    config = get_dashboard_conf()
+    idle_interval = config.getint("Server", "collector_idle_interval", fallback=COLLECTOR_IDLE_INTERVAL)
+    config.clear()
+    snapshots = []
+    for config_name in conf_names(WG_CONF_PATH):
+        # Only collect here when no background collection happened in this process lately
+        try:
+            snapshots.append(collector().refresh(config_name, idle_interval))
+        except Exception as exc:
+            # One failing interface is reported as down instead of failing the whole scrape
+            print(f"Failed to collect {config_name} for metrics: {exc}")
+            metrics.COLLECT_FAILURES.inc(config_name)
+            snapshots.append(Snapshot(config_name, time.time(), 0, None))
+    lines = snapshot_metrics.render(snapshots)
+    lines.extend(metrics.render_registry())
+    lines.append("")
+    return app.response_class("\n".join(lines), mimetype="text/plain; version=0.0.4")
 
 
 # Ping IP
@@ -1606,25 +2651,33 @@ def ping_ip():
 @app.route('/traceroute_ip', methods=['POST'])
 def traceroute_ip():
     """
-    Execute ping traceroute command.
+    Start a traceroute job, or reuse a recent one for the same IP.
 
-    @return: Return text with result
+    @return: Return JSON object with the job ID
     @rtype: str
     """
 
-    try:
-        result = traceroute('' + request.form['ip'] + '', first_hop=1, max_hops=30, count=1, fast=True)
-        returnjson = []
-        last_distance = 0
-        for hop in result:
-            if last_distance + 1 != hop.distance:
-                returnjson.append({"hop": "*", "ip": "*", "avg_rtt": "", "min_rtt": "", "max_rtt": ""})
-            returnjson.append({"hop": hop.distance, "ip": hop.address, "avg_rtt": hop.avg_rtt, "min_rtt": hop.min_rtt,
-                               "max_rtt": hop.max_rtt})
-            last_distance = hop.distance
-        return jsonify(returnjson)
-    except Exception:
-        return "Error"
+    ip = request.form.get('ip', '')
+    if len(ip) == 0 or ip == "none":
+        return jsonify({"status": False, "msg": "Please choose an IP."})
+    return jsonify({"status": True, "job_id": traceroute_jobs.submit(g.cur, ip)})
+
+
+@app.route('/traceroute_ip/<job_id>', methods=['GET'])
+def traceroute_job(job_id):
+    """
+    Get the hops of a traceroute job collected so far.
+
+    @param job_id: Job ID returned by /traceroute_ip
+    @type job_id: str
+    @return: Return JSON object with job status and hops
+    @rtype: str
+    """
+
+    job = traceroute_jobs.get(g.cur, job_id)
+    if job is None:
+        return jsonify({"status": "failed", "msg": "This job does not exist.", "hops": []})
+    return jsonify(job)
 
 
 """
@@ -1665,6 +2718,28 @@ def init_dashboard():
         config['Server']['dashboard_refresh_interval'] = '60000'
     if 'dashboard_sort' not in config['Server']:
         config['Server']['dashboard_sort'] = 'status'
+    if 'data_source' not in config['Server']:
+        config['Server']['data_source'] = 'kernel'
+    if 'peer_control' not in config['Server']:
+        config['Server']['peer_control'] = 'auto'
+    if 'collector_workers' not in config['Server']:
+        config['Server']['collector_workers'] = str(COLLECTOR_WORKERS)
+    if 'collector_idle_interval' not in config['Server']:
+        config['Server']['collector_idle_interval'] = str(COLLECTOR_IDLE_INTERVAL)
+    if 'metrics_token' not in config['Server']:
+        config['Server']['metrics_token'] = ''
+    if 'worker_class' not in config['Server']:
+        config['Server']['worker_class'] = 'gthread'
+    if 'profiler' not in config['Server']:
+        config['Server']['profiler'] = 'false'
+    if 'profiler_interval' not in config['Server']:
+        config['Server']['profiler_interval'] = str(tracing.PROFILER_INTERVAL)
+    if 'coalesce_window' not in config['Server']:
+        config['Server']['coalesce_window'] = str(COALESCE_WINDOW)
+    if 'enforce_peer_policies' not in config['Server']:
+        config['Server']['enforce_peer_policies'] = 'true'
+    if 'event_retention_days' not in config['Server']:
+        config['Server']['event_retention_days'] = str(EVENT_RETENTION_DAYS)
     # Default dashboard peers setting
     if "Peers" not in config:
         config['Peers'] = {}
@@ -1705,7 +2780,7 @@ def check_update():
             result = "true"
 
         return result
-    except urllib.error.HTTPError:
+    except urllib.error.URLError:
         return "false"
 
 
@@ -1719,7 +2794,7 @@ def run_dashboard():
     global UPDATE
     UPDATE = check_update()
     config = configparser.ConfigParser(strict=False)
-    config.read('wg-dashboard.ini')
+    config.read(DASHBOARD_CONF)
     # global app_ip
     app_ip = config.get("Server", "app_ip")
     # global app_port
@@ -1727,6 +2802,9 @@ def run_dashboard():
     global WG_CONF_PATH
     WG_CONF_PATH = config.get("Server", "wg_conf_path")
     config.clear()
+    # Simulated interfaces must exist before configurations are listed
+    data_source()
+    collector().start()
     return app
 
 
@@ -1735,10 +2813,23 @@ Get host and port for web-server
 """
 
 
+def load_settings():
+    """
+    Create the default settings if missing and read the WireGuard configuration path,
+    for tools using the dashboard without serving it
+    @return: None
+    """
+    init_dashboard()
+    global WG_CONF_PATH
+    config = get_dashboard_conf()
+    WG_CONF_PATH = config.get("Server", "wg_conf_path")
+    config.clear()
+
+
 def get_host_bind():
     init_dashboard()
     config = configparser.ConfigParser(strict=False)
-    config.read('wg-dashboard.ini')
+    config.read(DASHBOARD_CONF)
     app_ip = config.get("Server", "app_ip")
     app_port = config.get("Server", "app_port")
     return app_ip, app_port
@@ -1746,13 +2837,16 @@ def get_host_bind():
 
 if __name__ == "__main__":
     init_dashboard()
+    metrics.VALUES.clear()
     UPDATE = check_update()
     config = configparser.ConfigParser(strict=False)
-    config.read('wg-dashboard.ini')
+    config.read(DASHBOARD_CONF)
     # global app_ip
     app_ip = config.get("Server", "app_ip")
     # global app_port
     app_port = config.get("Server", "app_port")
     WG_CONF_PATH = config.get("Server", "wg_conf_path")
     config.clear()
+    data_source()
+    collector().start()
     app.run(host=app_ip, debug=False, port=app_port)
@@ -0,0 +1,385 @@
+"""
+< WGDashboard > - WireGuard data sources
+Under Apache-2.0 License
+
+Everything the dashboard reads from or writes to WireGuard goes through a data source,
+either the running kernel interfaces or a simulation for benchmarks and soak tests.
+"""
+
+import base64
+import hashlib
+import ipaddress
+import math
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+# PIP installed library
+import psutil
+
+import tracing
+from metrics import check_output
+from peer_control import PeerChange, PeerControlError, FakeControl, get_peer_control
+
+
+class PeerDump:
+    """
+    Runtime state of one peer, one line of `wg show <interface> dump`
+    """
+    __slots__ = ("public_key", "preshared_key", "endpoint", "allowed_ips", "latest_handshake",
+                 "transfer_rx", "transfer_tx", "keepalive")
+
+    def __init__(self, public_key, preshared_key, endpoint, allowed_ips, latest_handshake,
+                 transfer_rx, transfer_tx, keepalive):
+        self.public_key = public_key
+        self.preshared_key = preshared_key
+        self.endpoint = endpoint
+        self.allowed_ips = allowed_ips
+        self.latest_handshake = latest_handshake
+        self.transfer_rx = transfer_rx
+        self.transfer_tx = transfer_tx
+        self.keepalive = keepalive
+
+
+class InterfaceDump:
+    """
+    Runtime state of one interface and its peers
+    """
+    __slots__ = ("public_key", "listen_port", "peers")
+
+    def __init__(self, public_key, listen_port, peers):
+        self.public_key = public_key
+        self.listen_port = listen_port
+        self.peers = peers
+
+
+class DataSource:
+    """
+    Base class of WireGuard data sources
+    """
+    name = ""
+
+    def status(self, config_name):
+        """
+        Check if an interface is up
+        @param config_name: Name of WG interface
+        @return: "running" or "stopped"
+        @rtype: str
+        """
+        raise NotImplementedError
+
+    def dump(self, config_name):
+        """
+        Get the runtime state of an interface and all its peers
+        @param config_name: Name of WG interface
+        @return: InterfaceDump, None if the interface is not running
+        """
+        raise NotImplementedError
+
+    def apply(self, config_name, changes):
+        """
+        Add, change or remove peers
+        @param config_name: Name of WG interface
+        @param changes: List of peer_control.PeerChange
+        @return: None
+        """
+        raise NotImplementedError
+
+    def save(self, config_name):
+        """
+        Write the running interface state back to its configuration file
+        @param config_name: Name of WG interface
+        @return: None
+        """
+        raise NotImplementedError
+
+    def up(self, config_name):
+        """
+        Bring an interface up from its configuration file
+        @param config_name: Name of WG interface
+        @return: None
+        """
+        raise NotImplementedError
+
+    def down(self, config_name):
+        """
+        Bring an interface down
+        @param config_name: Name of WG interface
+        @return: None
+        """
+        raise NotImplementedError
+
+    def public_key(self, private_key):
+        """
+        Derive the public key of a private key
+        @param private_key: Private key
+        @return: Public key
+        @rtype: str
+        """
+        raise NotImplementedError
+
+
+def parse_dump(output):
+    """
+    Parse the output of `wg show <interface> dump`
+    @param output: Output of wg
+    @return: InterfaceDump
+    """
+    lines = output.splitlines()
+    interface = lines[0].split("\t") if len(lines) > 0 else ["", "", "", ""]
+    peers = []
+    for line in lines[1:]:
+        i = line.split("\t")
+        if len(i) < 8:
+            continue
+        peers.append(PeerDump(i[0], "" if i[1] == "(none)" else i[1], i[2], i[3], int(i[4]), int(i[5]), int(i[6]),
+                              0 if i[7] == "off" else int(i[7])))
+    return InterfaceDump(interface[1], interface[2], peers)
+
+
+class KernelSource(DataSource):
+    """
+    Read the kernel state with a single `wg show dump` per interface, changes go through
+    a peer control backend
+    """
+    name = "kernel"
+
+    def __init__(self, control):
+        """
+        @param control: peer_control.PeerControl applying the changes
+        """
+        self.control = control
+
+    def status(self, config_name):
+        with tracing.span("psutil"):
+            return "running" if config_name in psutil.net_if_addrs() else "stopped"
+
+    def dump(self, config_name):
+        try:
+            output = check_output(["wg", "show", config_name, "dump"], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return None
+        return parse_dump(output.decode("UTF-8"))
+
+    def apply(self, config_name, changes):
+        self.control.apply(config_name, changes)
+
+    def save(self, config_name):
+        self.control.save(config_name)
+
+    def up(self, config_name):
+        self.wg_quick("up", config_name)
+
+    def down(self, config_name):
+        self.wg_quick("down", config_name)
+
+    @staticmethod
+    def wg_quick(action, config_name):
+        try:
+            check_output(["wg-quick", action, config_name], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as exc:
+            raise PeerControlError(exc.output.decode("UTF-8").strip())
+
+    def public_key(self, private_key):
+        try:
+            return check_output(["wg", "pubkey"], input=private_key.strip().encode(),
+                                stderr=subprocess.STDOUT).decode("UTF-8").strip()
+        except subprocess.CalledProcessError as exc:
+            raise PeerControlError(exc.output.decode("UTF-8").strip())
+
+
+# Simulated peers rekey like WireGuard, every 2 minutes while they have traffic
+SIMULATED_REKEY = 120
+# Mean number of seconds a simulated peer stays online or offline
+SIMULATED_SESSION = 600
+# Share of the simulated peers online at start
+SIMULATED_ONLINE = 0.6
+
+
+class SimulatedSource(DataSource):
+    """
+    Synthesize interfaces with many peers, handshakes and transfer churn, without touching
+    the kernel. Configuration files are written to the WireGuard configuration path like
+    `wg-quick save` would, so the rest of the dashboard reads them as usual.
+    """
+    name = "simulated"
+
+    def __init__(self, conf_path, interfaces=1, peers=1000, seed=0):
+        """
+        @param conf_path: Directory of the configuration files, should be dedicated to the simulation
+        @param interfaces: Number of interfaces, named wgsim0, wgsim1...
+        @param peers: Number of peers of each interface
+        @param seed: Seed of the random generator, for reproducible runs
+        """
+        self.conf_path = conf_path
+        self.random = random.Random(seed)
+        self.control = FakeControl()
+        self.lock = threading.Lock()
+        self.interfaces = {}
+        for n in range(interfaces):
+            self.create(f"wgsim{n}", peers)
+
+    def random_key(self):
+        return base64.b64encode(self.random.getrandbits(256).to_bytes(32, "little")).decode()
+
+    def create(self, config_name, peers):
+        """
+        Load a simulated interface from its configuration file, or synthesize it
+        @param config_name: Name of the interface
+        @param peers: Number of peers to synthesize
+        @return: None
+        """
+        conf_location = os.path.join(self.conf_path, config_name + ".conf")
+        size = 2 ** max(2, math.ceil(math.log2(peers * 2 + 2)))
+        network = ipaddress.ip_network(f"10.0.0.0/{32 - int(math.log2(size))}")
+        interface = {"private_key": self.random_key(), "listen_port": 51820 + len(self.interfaces),
+                     "address": f"{network.network_address + 1}/{network.prefixlen}", "running": True,
+                     "ticked": time.time(), "peers": {}}
+        self.interfaces[config_name] = interface
+        self.control.interfaces[config_name] = {}
+        if os.path.isfile(conf_location):
+            self.load(config_name, conf_location)
+        else:
+            changes = []
+            for i in range(peers):
+                changes.append(PeerChange(self.random_key(), [f"{network.network_address + i + 2}/32"]))
+            self.apply(config_name, changes)
+            self.save(config_name)
+
+    def load(self, config_name, conf_location):
+        """
+        Restore the peers of a simulated interface from its configuration file
+        @return: None
+        """
+        interface = self.interfaces[config_name]
+        changes = []
+        with open(conf_location, encoding="utf-8") as f:
+            for line in f:
+                key, _, value = (i.strip() for i in line.partition("="))
+                if key == "PrivateKey":
+                    interface["private_key"] = line.split("=", 1)[1].strip()
+                elif key == "ListenPort":
+                    interface["listen_port"] = int(value)
+                elif key == "Address":
+                    interface["address"] = value
+                elif key == "PublicKey":
+                    changes.append(PeerChange(line.split("=", 1)[1].strip(), []))
+                elif key == "PresharedKey" and len(changes) > 0:
+                    changes[-1].preshared_key = line.split("=", 1)[1].strip()
+                elif key == "AllowedIPs" and len(changes) > 0:
+                    changes[-1].allowed_ips = [i.strip() for i in value.split(",")]
+        self.apply(config_name, changes)
+
+    def new_peer_state(self, now):
+        online = self.random.random() < SIMULATED_ONLINE
+        return {"online": online, "latest_handshake": int(now - self.random.uniform(0, SIMULATED_REKEY)) if online else 0,
+                "transfer_rx": 0, "transfer_tx": 0, "endpoint": self.random_endpoint() if online else "(none)",
+                "rate_rx": self.random.lognormvariate(8, 2), "rate_tx": self.random.lognormvariate(7, 2)}
+
+    def random_endpoint(self):
+        return f"{self.random.randint(1, 223)}.{self.random.randint(0, 255)}.{self.random.randint(0, 255)}." \
+               f"{self.random.randint(1, 254)}:{self.random.randint(1024, 65535)}"
+
+    def tick(self, config_name):
+        """
+        Advance the simulation of an interface to the current time
+        @param config_name: Name of the interface
+        @return: None
+        """
+        interface = self.interfaces[config_name]
+        now = time.time()
+        elapsed = now - interface["ticked"]
+        interface["ticked"] = now
+        flip = min(1.0, elapsed / SIMULATED_SESSION)
+        rand = self.random.random
+        for peer in interface["peers"].values():
+            if rand() < flip:
+                peer["online"] = not peer["online"]
+                if peer["online"] and (peer["endpoint"] == "(none)" or rand() < 0.3):
+                    peer["endpoint"] = self.random_endpoint()
+            if peer["online"]:
+                if now - peer["latest_handshake"] >= SIMULATED_REKEY:
+                    peer["latest_handshake"] = int(now - rand() * 5)
+                peer["transfer_rx"] += int(peer["rate_rx"] * elapsed * (0.5 + rand()))
+                peer["transfer_tx"] += int(peer["rate_tx"] * elapsed * (0.5 + rand()))
+
+    def status(self, config_name):
+        interface = self.interfaces.get(config_name)
+        return "running" if interface is not None and interface["running"] else "stopped"
+
+    def dump(self, config_name):
+        with self.lock:
+            if self.status(config_name) != "running":
+                return None
+            self.tick(config_name)
+            interface = self.interfaces[config_name]
+            peers = []
+            configured = self.control.interfaces[config_name]
+            for public_key, peer in interface["peers"].items():
+                setting = configured[public_key]
+                peers.append(PeerDump(public_key, setting["preshared_key"], peer["endpoint"],
+                                      ",".join(setting["allowed_ips"]) or "(none)", peer["latest_handshake"],
+                                      peer["transfer_rx"], peer["transfer_tx"], 0))
+            return InterfaceDump(self.public_key(interface["private_key"]), str(interface["listen_port"]), peers)
+
+    def apply(self, config_name, changes):
+        if config_name not in self.interfaces:
+            raise PeerControlError("Unable to access interface: No such device")
+        with self.lock:
+            self.control.apply(config_name, changes)
+            now = time.time()
+            peers = self.interfaces[config_name]["peers"]
+            for change in changes:
+                if change.remove:
+                    peers.pop(change.public_key, None)
+                elif change.public_key not in peers:
+                    peers[change.public_key] = self.new_peer_state(now)
+
+    def save(self, config_name):
+        with self.lock:
+            interface = self.interfaces[config_name]
+            lines = ["[Interface]", f"Address = {interface['address']}", f"ListenPort = {interface['listen_port']}",
+                     f"PrivateKey = {interface['private_key']}", ""]
+            for public_key, setting in self.control.interfaces[config_name].items():
+                lines += ["[Peer]", f"PublicKey = {public_key}"]
+                if len(setting["preshared_key"]) > 0:
+                    lines.append(f"PresharedKey = {setting['preshared_key']}")
+                lines += [f"AllowedIPs = {', '.join(setting['allowed_ips'])}", ""]
+            with open(os.path.join(self.conf_path, config_name + ".conf"), "w", encoding="utf-8") as f:
+                f.write("\n".join(lines))
+
+    def up(self, config_name):
+        if config_name not in self.interfaces:
+            raise PeerControlError(f"wg-quick: `{config_name}' does not exist")
+        self.interfaces[config_name]["running"] = True
+        self.interfaces[config_name]["ticked"] = time.time()
+
+    def down(self, config_name):
+        if config_name not in self.interfaces:
+            raise PeerControlError(f"wg-quick: `{config_name}' is not a WireGuard interface")
+        with self.lock:
+            self.interfaces[config_name]["running"] = False
+            for peer in self.interfaces[config_name]["peers"].values():
+                peer["transfer_rx"] = peer["transfer_tx"] = 0
+
+    def public_key(self, private_key):
+        if not re.match(r"^[A-Za-z0-9+/]{42}[AEIMQUYcgkosw480]=$", private_key.strip()):
+            raise PeerControlError("Key is not the correct length or format")
+        return base64.b64encode(hashlib.sha256(private_key.strip().encode()).digest()).decode()
+
+
+def get_data_source(name, conf_path, peer_control="auto", interfaces=1, peers=1000):
+    """
+    Create a data source
+    @param name: "kernel" or "simulated"
+    @param conf_path: WireGuard configuration path
+    @param peer_control: Peer control backend of the kernel data source
+    @param interfaces: Number of simulated interfaces
+    @param peers: Number of peers of each simulated interface
+    @return: DataSource
+    """
+    if name == "simulated":
+        return SimulatedSource(conf_path, interfaces, peers)
+    return KernelSource(get_peer_control(peer_control))
@@ -0,0 +1,104 @@
+"""
+< WGDashboard > - Peer session events
+Under Apache-2.0 License
+
+Connections, disconnections and endpoint changes are found by comparing each collection
+of an interface with the state of its peers after the previous one, kept in memory, and
+stored in a per-interface table keyed by peer and time.
+"""
+
+import threading
+import time
+
+# Stored event codes, by index
+EVENT_TYPES = ("connect", "disconnect", "endpoint")
+CONNECT, DISCONNECT, ENDPOINT = range(len(EVENT_TYPES))
+# Seconds after its latest handshake a peer still counts as online, as for the peer status
+ONLINE_HANDSHAKE = 120
+# Days events are kept
+EVENT_RETENTION_DAYS = 30
+# Seconds between two deletions of the expired events of an interface
+PRUNE_INTERVAL = 3600
+# Endpoints WireGuard and the peer table use for a peer that never connected
+NO_ENDPOINT = ("(none)", "N/A", "")
+
+
+class SessionTracker:
+    """
+    Online state and endpoint of the peers of every interface after its last collection
+    """
+
+    def __init__(self):
+        # Configuration name to {public key: (online, endpoint)}
+        self.states = {}
+        self.pruned = {}
+        # Configuration name to the lock comparing its collections one at a time
+        self.interface_locks = {}
+        self.lock = threading.Lock()
+
+    def interface_lock(self, config_name):
+        """
+        @param config_name: Configuration name
+        @return: threading.Lock of the interface
+        """
+        with self.lock:
+            return self.interface_locks.setdefault(config_name, threading.Lock())
+
+    def observe(self, config_name, dump, load, reload=False, now=None):
+        """
+        Compare a collection with the previous state of the interface. Collections of the
+        same interface are compared one at a time, so a change is reported once.
+        @param config_name: Configuration name
+        @param dump: datasource.InterfaceDump, None when the interface is stopped
+        @param load: Function returning the rows of (id, status, endpoint) of the peer table,
+                     the state stored by the previous collection, used when the state is not
+                     known in this process, e.g. after a restart
+        @param reload: Start from the rows of load anyway, e.g. after a collection by another
+                       worker process
+        @param now: Epoch of the collection
+        @return: Events, each (id, time, event code, endpoint). A connection is dated by its
+                 handshake, the other events by the collection.
+        @rtype: list
+        """
+        if dump is None:
+            return []
+        now = int(time.time() if now is None else now)
+        with self.interface_lock(config_name):
+            with self.lock:
+                previous = self.states.get(config_name)
+            if previous is None or reload:
+                previous = {peer_id: (status == "running", endpoint) for peer_id, status, endpoint in load()}
+            state = {}
+            events = []
+            for peer in dump.peers:
+                online = peer.latest_handshake > 0 and now - peer.latest_handshake < ONLINE_HANDSHAKE
+                endpoint = peer.endpoint
+                state[peer.public_key] = (online, endpoint)
+                was_online, last_endpoint = previous.get(peer.public_key, (False, endpoint))
+                if online and not was_online:
+                    events.append((peer.public_key, int(peer.latest_handshake), CONNECT, endpoint))
+                elif was_online and not online:
+                    events.append((peer.public_key, now, DISCONNECT, last_endpoint))
+                elif online and endpoint != last_endpoint and endpoint not in NO_ENDPOINT \
+                        and last_endpoint not in NO_ENDPOINT:
+                    events.append((peer.public_key, now, ENDPOINT, endpoint))
+            # Peers removed or suspended while online
+            events += [(key, now, DISCONNECT, last_endpoint) for key, (was_online, last_endpoint) in previous.items()
+                       if was_online and key not in state]
+            with self.lock:
+                self.states[config_name] = state
+        return events
+
+    def prune_due(self, config_name, now=None):
+        """
+        @param config_name: Configuration name
+        @param now: Current epoch
+        @return: Whether the expired events of the interface should be deleted, at most once per PRUNE_INTERVAL
+        @rtype: bool
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if now - self.pruned.get(config_name, 0) < PRUNE_INTERVAL:
+                return False
+            self.pruned[config_name] = now
+            return True
@@ -1,11 +1,43 @@
+import configparser
 import multiprocessing
+import os
+
+# The worker model is chosen before importing the dashboard, gevent has to patch the standard
+# library first. gthread unless WGD_WORKER_CLASS or worker_class in wg-dashboard.ini asks for gevent.
+dashboard_config = configparser.ConfigParser(strict=False)
+dashboard_config.read(os.path.join(os.getenv('CONFIGURATION_PATH', '.'), 'wg-dashboard.ini'))
+worker_class = os.getenv('WGD_WORKER_CLASS') or dashboard_config.get("Server", "worker_class", fallback="gthread")
+del dashboard_config
+if worker_class not in ("gthread", "gevent"):
+    raise RuntimeError(f"Unknown worker class {worker_class}, use gthread or gevent")
+if worker_class == "gevent":
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError("worker_class is gevent but gevent is not installed, "
+                           "install it with: pip install -r requirements-gevent.txt")
+    monkey.patch_all()
+
 import dashboard
 
 app_host, app_port = dashboard.get_host_bind()
 
-worker_class = 'gthread'
-workers = multiprocessing.cpu_count() * 2 + 1
-threads = 4
+if worker_class == "gevent":
+    # Requests, commands and ICMP yield to each other, a few processes serve many viewers
+    workers = multiprocessing.cpu_count() + 1
+    worker_connections = 1000
+else:
+    workers = multiprocessing.cpu_count() * 2 + 1
+    threads = 4
 bind = f"{app_host}:{app_port}"
 daemon = True
 pidfile = './gunicorn.pid'
+
+
+def on_starting(server):
+    # The metrics of the workers of the previous run start again from zero
+    dashboard.metrics.VALUES.clear()
+
+
+def when_ready(server):
+    server.log.info(f"Dashboard running {workers} {worker_class} workers")
@@ -0,0 +1,172 @@
+"""
+< WGDashboard > - Background jobs for dashboard tools
+Under Apache-2.0 License
+"""
+
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+# PIP installed library
+from icmplib import ICMPv4Socket, ICMPv6Socket, ICMPRequest, Hop, ICMPLibError, TimeExceeded, \
+    is_hostname, is_ipv6_address, resolve
+
+# Traceroute defaults, same as the previous synchronous call (fast=True, count=1)
+TRACEROUTE_MAX_HOPS = 30
+TRACEROUTE_TIMEOUT = 2
+TRACEROUTE_INTERVAL = 0.05
+# Number of traces allowed to run in parallel per dashboard process
+TRACEROUTE_WORKERS = 4
+# Seconds a finished trace is reused for the same destination
+TRACEROUTE_CACHE_TTL = 60
+# Seconds before finished jobs are purged from the database
+TRACEROUTE_RETENTION = 3600
+# A job still "running" after this long belongs to a dead worker
+TRACEROUTE_STALE = TRACEROUTE_MAX_HOPS * (TRACEROUTE_TIMEOUT + 1)
+
+
+def trace_hops(address, on_hop, max_hops=TRACEROUTE_MAX_HOPS, timeout=TRACEROUTE_TIMEOUT,
+               interval=TRACEROUTE_INTERVAL):
+    """
+    Traceroute that reports every hop as soon as it is probed
+    @param address: IP address or hostname of the destination
+    @param on_hop: Callback receiving a dict for each hop, "*" for hops without reply
+    @param max_hops: Maximum TTL to probe
+    @param timeout: Seconds to wait for each reply
+    @param interval: Seconds to wait between probes
+    @return: None
+    """
+    if is_hostname(address):
+        address = resolve(address)[0]
+    socket_class = ICMPv6Socket if is_ipv6_address(address) else ICMPv4Socket
+    request_id = uuid.uuid4().int & 0xffff
+    with socket_class() as sock:
+        for ttl in range(1, max_hops + 1):
+            request = ICMPRequest(destination=address, id=request_id, sequence=ttl, ttl=ttl)
+            reply = None
+            rtts = []
+            host_reached = False
+            try:
+                sock.send(request)
+                reply = sock.receive(request, timeout)
+                rtts.append((reply.time - request.time) * 1000)
+                reply.raise_for_status()
+                host_reached = True
+            except TimeExceeded:
+                time.sleep(interval)
+            except ICMPLibError:
+                pass
+            if reply:
+                hop = Hop(address=reply.source, packets_sent=1, rtts=rtts, distance=ttl)
+                on_hop({"hop": hop.distance, "ip": hop.address, "avg_rtt": hop.avg_rtt, "min_rtt": hop.min_rtt,
+                        "max_rtt": hop.max_rtt})
+            else:
+                on_hop({"hop": ttl, "ip": "*", "avg_rtt": "", "min_rtt": "", "max_rtt": ""})
+            if host_reached:
+                break
+
+
+class TracerouteJobs:
+    """
+    Run traceroute in a background thread pool and keep the hops in SQLite, so any
+    worker process can answer the polling requests of a job started by another one.
+    """
+
+    def __init__(self, connect, workers=TRACEROUTE_WORKERS, cache_ttl=TRACEROUTE_CACHE_TTL):
+        """
+        @param connect: Function returning a new sqlite3.Connection
+        @param workers: Number of traces allowed to run in parallel
+        @param cache_ttl: Seconds a finished trace is reused for the same destination
+        """
+        self.connect = connect
+        self.cache_ttl = cache_ttl
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.table_ready = False
+
+    def init_table(self, cur):
+        """
+        Create the job table on first use
+        @param cur: sqlite3.Cursor
+        @return: None
+        """
+        if self.table_ready:
+            return
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS traceroute_jobs (
+                id VARCHAR NOT NULL, destination VARCHAR NOT NULL, status VARCHAR NOT NULL,
+                hops VARCHAR NOT NULL, msg VARCHAR NULL, created_at FLOAT NOT NULL, finished_at FLOAT NULL,
+                PRIMARY KEY (id)
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS traceroute_jobs_destination ON traceroute_jobs (destination)")
+        self.table_ready = True
+
+    def submit(self, cur, destination):
+        """
+        Start a traceroute, or reuse a running or recently finished one for the same destination
+        @param cur: sqlite3.Cursor of the current request
+        @param destination: IP address or hostname
+        @return: Job ID
+        @rtype: str
+        """
+        self.init_table(cur)
+        now = time.time()
+        cur.execute("DELETE FROM traceroute_jobs WHERE created_at < ?", (now - TRACEROUTE_RETENTION,))
+        cached = cur.execute(
+            "SELECT id FROM traceroute_jobs WHERE destination = ? AND "
+            "((status = 'running' AND created_at > ?) OR (status = 'done' AND finished_at > ?)) "
+            "ORDER BY created_at DESC LIMIT 1",
+            (destination, now - TRACEROUTE_STALE, now - self.cache_ttl)).fetchone()
+        if cached is not None:
+            return cached[0]
+        job_id = uuid.uuid4().hex
+        cur.execute("INSERT INTO traceroute_jobs VALUES (?, ?, 'running', '[]', '', ?, NULL)",
+                    (job_id, destination, now))
+        # The worker thread uses its own connection, so the row must be visible first
+        cur.connection.commit()
+        self.executor.submit(self.run, job_id, destination)
+        return job_id
+
+    def run(self, job_id, destination):
+        """
+        Execute one job, writing every hop as it arrives
+        @param job_id: Job ID
+        @param destination: IP address or hostname
+        @return: None
+        """
+        db = self.connect()
+        hops = []
+
+        def on_hop(hop):
+            hops.append(hop)
+            db.execute("UPDATE traceroute_jobs SET hops = ? WHERE id = ?", (json.dumps(hops), job_id))
+            db.commit()
+
+        try:
+            trace_hops(destination, on_hop)
+            db.execute("UPDATE traceroute_jobs SET status = 'done', finished_at = ? WHERE id = ?",
+                       (time.time(), job_id))
+        except Exception as exc:
+            db.execute("UPDATE traceroute_jobs SET status = 'failed', msg = ?, finished_at = ? WHERE id = ?",
+                       (str(exc), time.time(), job_id))
+        finally:
+            db.commit()
+            db.close()
+
+    def get(self, cur, job_id):
+        """
+        Get the state of a job
+        @param cur: sqlite3.Cursor of the current request
+        @param job_id: Job ID
+        @return: Dictionary with status and hops, None if the job does not exist
+        @rtype: dict, None
+        """
+        self.init_table(cur)
+        job = cur.execute("SELECT id, destination, status, hops, msg, created_at FROM traceroute_jobs WHERE id = ?",
+                          (job_id,)).fetchone()
+        if job is None:
+            return None
+        status = job[2]
+        if status == "running" and job[5] < time.time() - TRACEROUTE_STALE:
+            status = "failed"
+        return {"job_id": job[0], "ip": job[1], "status": status, "hops": json.loads(job[3]), "msg": job[4]}
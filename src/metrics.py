@@ -0,0 +1,449 @@
+"""
+< WGDashboard > - Prometheus metrics
+Under Apache-2.0 License
+
+Counters and histograms of the dashboard itself, plus the rendering of WireGuard
+peer and interface metrics from collector snapshots, in the Prometheus text format.
+
+Once shared, every worker process adds to its own memory-mapped file of a common directory,
+and a scrape adds up the files of all workers, so any worker serves the totals of the server.
+File layout, little endian: bytes used, then one record per sample, the length of its key,
+the key as JSON, padded to 8 bytes, and its value as a double.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import subprocess
+import threading
+import time
+
+import tracing
+from events import ONLINE_HANDSHAKE
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Initial size of the file of a worker process, doubled when full
+SHARED_FILE_SIZE = 64 * 1024
+USED = struct.Struct("<Q")
+KEY_LENGTH = struct.Struct("<I")
+VALUE = struct.Struct("<d")
+
+
+def escape_label(value):
+    """
+    Escape a label value of the text format
+    @param value: Label value
+    @return: str
+    """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    """
+    @param names: Tuple of label names
+    @param values: Tuple of label values
+    @return: Label set, e.g. {interface="wg0"}, empty without labels
+    @rtype: str
+    """
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f'{n}="{escape_label(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def format_value(value):
+    """
+    @param value: Sample value
+    @return: Value of the text format, counts without a decimal point
+    @rtype: str
+    """
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+class LocalValues:
+    """
+    Samples of the metrics of this process only
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, amount):
+        """
+        @param key: Tuple of (sample name, tuple of label values)
+        @param amount: Amount to add
+        @return: None
+        """
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def totals(self):
+        """
+        @return: Dictionary of key to value
+        @rtype: dict
+        """
+        with self.lock:
+            return dict(self.values)
+
+
+class SharedValues:
+    """
+    Samples of the metrics of every worker process, each process writing to its own file of
+    the directory. The files of exited workers are kept, so the totals never go backwards
+    while the server runs.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Directory of the files
+        """
+        self.path = path
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.pid = None
+        self.map = None
+        self.offsets = {}
+        self.used = USED.size
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Map the file of this process, again after a fork
+        @return: None
+        """
+        fd = os.open(os.path.join(self.path, f"{os.getpid()}.metrics"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = os.fstat(fd).st_size
+            if size < SHARED_FILE_SIZE:
+                os.ftruncate(fd, SHARED_FILE_SIZE)
+                size = SHARED_FILE_SIZE
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        # A file left by an exited process with the same PID is carried on
+        self.offsets = {key: offset for key, offset, _ in read_samples(self.map)}
+        self.used = max(USED.size, USED.unpack_from(self.map, 0)[0])
+        self.pid = os.getpid()
+
+    def add(self, key, amount):
+        """
+        @param key: Tuple of (sample name, tuple of label values)
+        @param amount: Amount to add
+        @return: None
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.open()
+            offset = self.offsets.get(key)
+            if offset is None:
+                offset = self.allocate(key)
+            VALUE.pack_into(self.map, offset, VALUE.unpack_from(self.map, offset)[0] + amount)
+
+    def allocate(self, key):
+        """
+        Append the record of a new sample
+        @param key: Tuple of (sample name, tuple of label values)
+        @return: Offset of its value
+        @rtype: int
+        """
+        data = json.dumps([key[0], list(key[1])]).encode("utf-8")
+        length = KEY_LENGTH.size + len(data)
+        length += -length % 8
+        if self.used + length + VALUE.size > len(self.map):
+            self.map.resize(max(len(self.map) * 2, self.used + length + VALUE.size))
+        KEY_LENGTH.pack_into(self.map, self.used, len(data))
+        self.map[self.used + KEY_LENGTH.size:self.used + KEY_LENGTH.size + len(data)] = data
+        offset = self.used + length
+        VALUE.pack_into(self.map, offset, 0.0)
+        # Readers only look at complete records
+        self.used = offset + VALUE.size
+        USED.pack_into(self.map, 0, self.used)
+        self.offsets[key] = offset
+        return offset
+
+    def totals(self):
+        """
+        @return: Dictionary of key to value, added up over all the files
+        @rtype: dict
+        """
+        totals = {}
+        for name in os.listdir(self.path):
+            if not name.endswith(".metrics"):
+                continue
+            try:
+                with open(os.path.join(self.path, name), "rb") as f:
+                    buffer = f.read()
+            except OSError:
+                continue
+            for key, offset, value in read_samples(buffer):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def clear(self):
+        """
+        Delete the files of all processes, when the server starts
+        @return: None
+        """
+        for name in os.listdir(self.path):
+            if name.endswith(".metrics"):
+                os.remove(os.path.join(self.path, name))
+
+
+def read_samples(buffer):
+    """
+    @param buffer: Content of a file of SharedValues
+    @return: Iterator of (key, offset of the value, value)
+    """
+    if len(buffer) < USED.size:
+        return
+    used = min(USED.unpack_from(buffer, 0)[0], len(buffer))
+    position = USED.size
+    while position + KEY_LENGTH.size <= used:
+        length = KEY_LENGTH.unpack_from(buffer, position)[0]
+        start = position + KEY_LENGTH.size
+        offset = start + length + (-(KEY_LENGTH.size + length) % 8)
+        if offset + VALUE.size > used:
+            return
+        name, values = json.loads(bytes(buffer[start:start + length]).decode("utf-8"))
+        yield (name, tuple(values)), offset, VALUE.unpack_from(buffer, offset)[0]
+        position = offset + VALUE.size
+
+
+# Samples of the dashboard's own metrics, of this process until share is called
+VALUES = LocalValues()
+
+
+def share(path):
+    """
+    Add up the dashboard's own metrics of every worker process
+    @param path: Directory shared by the workers
+    @return: None
+    """
+    global VALUES
+    VALUES = SharedValues(path)
+
+
+class Counter:
+    """
+    Counter with labels
+    """
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def inc(self, *values, amount=1):
+        """
+        @param values: Label values, in the order of the label names
+        @param amount: Amount to add
+        @return: None
+        """
+        VALUES.add((self.name, values), amount)
+
+    def render(self, totals):
+        """
+        @param totals: Samples of every metric, from VALUES.totals
+        @return: Lines of the text format
+        @rtype: list
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for values, value in sorted((key[1], value) for key, value in totals.items() if key[0] == self.name):
+            lines.append(f"{self.name}{format_labels(self.labels, values)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    Histogram with labels and fixed buckets
+    """
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+
+    def observe(self, value, *values):
+        """
+        @param value: Observed value
+        @param values: Label values, in the order of the label names
+        @return: None
+        """
+        # Counts are stored per bucket, cumulated when rendered
+        VALUES.add((self.name + "_bucket", values + (bisect.bisect_left(self.buckets, value),)), 1)
+        VALUES.add((self.name + "_sum", values), value)
+        VALUES.add((self.name + "_count", values), 1)
+
+    def render(self, totals):
+        """
+        @param totals: Samples of every metric, from VALUES.totals
+        @return: Lines of the text format
+        @rtype: list
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, count in sorted((key[1], value) for key, value in totals.items()
+                                    if key[0] == self.name + "_count"):
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + ("+Inf",)):
+                cumulative += totals.get((self.name + "_bucket", values + (i,)), 0)
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), values + (bound,))} "
+                             f"{format_value(cumulative)}")
+            labels = format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {float(totals.get((self.name + '_sum', values), 0))}")
+            lines.append(f"{self.name}_count{labels} {format_value(count)}")
+        return lines
+
+
+REQUEST_LATENCY = Histogram("wgdashboard_http_request_duration_seconds", "Latency of dashboard requests.",
+                            ("endpoint", "method"))
+SUBPROCESS_CALLS = Counter("wgdashboard_subprocess_calls_total", "Commands executed by the dashboard.",
+                           ("command",))
+SUBPROCESS_FAILURES = Counter("wgdashboard_subprocess_failures_total", "Commands that exited with an error.",
+                              ("command",))
+SUBPROCESS_SECONDS = Counter("wgdashboard_subprocess_seconds_total", "Seconds spent waiting for commands.",
+                             ("command",))
+COLLECT_FAILURES = Counter("wgdashboard_collect_failures_total",
+                           "Collections of an interface that failed during a scrape.", ("interface",))
+REGISTRY = [REQUEST_LATENCY, SUBPROCESS_CALLS, SUBPROCESS_FAILURES, SUBPROCESS_SECONDS, COLLECT_FAILURES]
+
+
+def check_output(command, **kwargs):
+    """
+    subprocess.check_output, counted per command
+    @param command: Argument list, e.g. ["wg", "show", "wg0", "dump"]
+    @param kwargs: Arguments of subprocess.check_output
+    @return: bytes
+    """
+    name = " ".join(command[:2])
+    tic = time.perf_counter()
+    try:
+        with tracing.span("subprocess"):
+            return subprocess.check_output(command, **kwargs)
+    except (OSError, subprocess.CalledProcessError):
+        SUBPROCESS_FAILURES.inc(name)
+        raise
+    finally:
+        SUBPROCESS_CALLS.inc(name)
+        SUBPROCESS_SECONDS.inc(name, amount=time.perf_counter() - tic)
+
+
+class SnapshotMetrics:
+    """
+    Render the WireGuard metrics of collector snapshots. The text of each interface is
+    kept until its next snapshot, so scrapes between two collections only join strings.
+    """
+
+    def __init__(self):
+        self.rendered = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def render_interface(snapshot):
+        """
+        @param snapshot: collector.Snapshot
+        @return: Dictionary of metric name to lines of samples
+        @rtype: dict
+        """
+        interface = escape_label(snapshot.config_name)
+        samples = {"wireguard_interface_up": [f'wireguard_interface_up{{interface="{interface}"}} '
+                                              f'{0 if snapshot.dump is None else 1}'],
+                   "wireguard_collect_duration_seconds": [
+                       f'wireguard_collect_duration_seconds{{interface="{interface}"}} {snapshot.duration:.6f}'],
+                   "wireguard_collect_timestamp_seconds": [
+                       f'wireguard_collect_timestamp_seconds{{interface="{interface}"}} {snapshot.time:.3f}']}
+        if snapshot.dump is None:
+            return samples
+        rx = []
+        tx = []
+        handshake = []
+        age = []
+        online = []
+        total_rx = 0
+        total_tx = 0
+        online_peers = 0
+        for peer in snapshot.dump.peers:
+            labels = f'{{interface="{interface}",public_key="{peer.public_key}"}}'
+            rx.append(f"wireguard_peer_receive_bytes_total{labels} {peer.transfer_rx}")
+            tx.append(f"wireguard_peer_sent_bytes_total{labels} {peer.transfer_tx}")
+            handshake.append(f"wireguard_peer_latest_handshake_seconds{labels} {peer.latest_handshake}")
+            if peer.latest_handshake > 0:
+                peer_age = max(0.0, snapshot.time - peer.latest_handshake)
+                age.append(f"wireguard_peer_handshake_age_seconds{labels} {peer_age:.0f}")
+                is_online = peer_age < ONLINE_HANDSHAKE
+            else:
+                is_online = False
+            online.append(f"wireguard_peer_online{labels} {1 if is_online else 0}")
+            total_rx += peer.transfer_rx
+            total_tx += peer.transfer_tx
+            online_peers += is_online
+        labels = f'{{interface="{interface}"}}'
+        samples.update({
+            "wireguard_peer_receive_bytes_total": rx,
+            "wireguard_peer_sent_bytes_total": tx,
+            "wireguard_peer_latest_handshake_seconds": handshake,
+            "wireguard_peer_handshake_age_seconds": age,
+            "wireguard_peer_online": online,
+            "wireguard_interface_peers": [f"wireguard_interface_peers{labels} {len(snapshot.dump.peers)}"],
+            "wireguard_interface_online_peers": [f"wireguard_interface_online_peers{labels} {online_peers}"],
+            "wireguard_interface_receive_bytes_total": [
+                f"wireguard_interface_receive_bytes_total{labels} {total_rx}"],
+            "wireguard_interface_sent_bytes_total": [f"wireguard_interface_sent_bytes_total{labels} {total_tx}"]
+        })
+        return samples
+
+    def render(self, snapshots):
+        """
+        Render the WireGuard metrics of every interface
+        @param snapshots: List of collector.Snapshot
+        @return: Lines of the text format
+        @rtype: list
+        """
+        interfaces = []
+        with self.lock:
+            for snapshot in snapshots:
+                rendered = self.rendered.get(snapshot.config_name)
+                if rendered is None or rendered[0] is not snapshot:
+                    rendered = self.rendered[snapshot.config_name] = (snapshot, self.render_interface(snapshot))
+                interfaces.append(rendered[1])
+            names = set(snapshot.config_name for snapshot in snapshots)
+            for config_name in list(self.rendered):
+                if config_name not in names:
+                    del self.rendered[config_name]
+        lines = []
+        for name, documentation, metric_type in SNAPSHOT_METRICS:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for samples in interfaces:
+                lines.extend(samples.get(name, ()))
+        return lines
+
+
+SNAPSHOT_METRICS = (
+    ("wireguard_interface_up", "Whether the interface is running.", "gauge"),
+    ("wireguard_interface_peers", "Number of peers of the interface.", "gauge"),
+    ("wireguard_interface_online_peers", "Number of peers with a handshake in the last 2 minutes.", "gauge"),
+    ("wireguard_interface_receive_bytes_total", "Bytes received from all peers since they were added.", "counter"),
+    ("wireguard_interface_sent_bytes_total", "Bytes sent to all peers since they were added.", "counter"),
+    ("wireguard_collect_duration_seconds", "Seconds the last collection of the interface took.", "gauge"),
+    ("wireguard_collect_timestamp_seconds", "Epoch of the last collection of the interface.", "gauge"),
+    ("wireguard_peer_receive_bytes_total", "Bytes received from the peer.", "counter"),
+    ("wireguard_peer_sent_bytes_total", "Bytes sent to the peer.", "counter"),
+    ("wireguard_peer_latest_handshake_seconds", "Epoch of the latest handshake, 0 if none.", "gauge"),
+    ("wireguard_peer_handshake_age_seconds", "Seconds between the latest handshake and the collection.", "gauge"),
+    ("wireguard_peer_online", "Whether the peer had a handshake in the last 2 minutes.", "gauge")
+)
+
+
+def render_registry():
+    """
+    @return: Lines of the text format of the dashboard's own metrics
+    @rtype: list
+    """
+    totals = VALUES.totals()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render(totals))
+    return lines
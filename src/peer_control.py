@@ -0,0 +1,364 @@
+"""
+< WGDashboard > - Peer control backends
+Under Apache-2.0 License
+
+Apply peer additions, changes and removals to a WireGuard interface, either through
+the kernel generic netlink API, the `wg` command line tool, or in memory for testing.
+"""
+
+import base64
+import ipaddress
+import os
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+
+from metrics import check_output
+
+
+class PeerControlError(Exception):
+    """
+    Raised when the kernel or the wg tool refused a change, the message is shown to the user
+    """
+
+
+class PeerChange:
+    """
+    One change of a peer, all omitted settings are left untouched
+    """
+    __slots__ = ("public_key", "allowed_ips", "preshared_key", "remove")
+
+    def __init__(self, public_key, allowed_ips=None, preshared_key=None, remove=False):
+        """
+        @param public_key: Public key of the peer, the peer is created if it does not exist
+        @param allowed_ips: List or comma separated string of CIDRs replacing the current ones
+        @param preshared_key: Preshared key, empty string to clear it
+        @param remove: Remove the peer from the interface
+        """
+        self.public_key = public_key
+        if isinstance(allowed_ips, str):
+            allowed_ips = [i.strip() for i in allowed_ips.split(",") if len(i.strip()) > 0]
+        self.allowed_ips = allowed_ips
+        self.preshared_key = preshared_key
+        self.remove = remove
+
+
+class PeerControl:
+    """
+    Base class of peer control backends
+    """
+    name = ""
+
+    def apply(self, config_name, changes):
+        """
+        Apply a batch of peer changes to an interface
+        @param config_name: Name of WG interface
+        @param changes: List of PeerChange
+        @return: None
+        """
+        raise NotImplementedError
+
+    def save(self, config_name):
+        """
+        Write the running interface state back to its configuration file
+        @param config_name: Name of WG interface
+        @return: None
+        """
+        try:
+            check_output(["wg-quick", "save", config_name], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as exc:
+            raise PeerControlError(exc.output.decode("UTF-8").strip())
+
+
+class WgCliControl(PeerControl):
+    """
+    Apply changes with one `wg set` call per batch. Preshared keys go through
+    private temporary files, since wg only reads them from a file.
+    """
+    name = "cli"
+
+    def apply(self, config_name, changes):
+        if len(changes) == 0:
+            return
+        with tempfile.TemporaryDirectory(prefix="wgd-") as tmp_dir:
+            command = ["wg", "set", config_name]
+            for i, change in enumerate(changes):
+                command += ["peer", change.public_key]
+                if change.remove:
+                    command.append("remove")
+                    continue
+                if change.preshared_key is not None:
+                    psk_file = os.path.join(tmp_dir, f"{i}.psk")
+                    with open(os.open(psk_file, os.O_WRONLY | os.O_CREAT, 0o600), "w") as f:
+                        f.write(change.preshared_key)
+                    command += ["preshared-key", psk_file]
+                if change.allowed_ips is not None:
+                    command += ["allowed-ips", ",".join(change.allowed_ips)]
+            try:
+                check_output(command, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as exc:
+                raise PeerControlError(exc.output.decode("UTF-8").strip())
+
+
+class FakeControl(PeerControl):
+    """
+    Keep the peers of every interface in memory, for tests and benchmarks
+    """
+    name = "fake"
+
+    def __init__(self):
+        self.interfaces = {}
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def apply(self, config_name, changes):
+        with self.lock:
+            peers = self.interfaces.setdefault(config_name, {})
+            for change in changes:
+                if change.remove:
+                    peers.pop(change.public_key, None)
+                    continue
+                peer = peers.setdefault(change.public_key, {"allowed_ips": [], "preshared_key": ""})
+                if change.allowed_ips is not None:
+                    # Like the kernel, keep networks with their prefix length and host bits cleared
+                    try:
+                        peer["allowed_ips"] = [ipaddress.ip_network(i, strict=False).with_prefixlen
+                                               for i in change.allowed_ips]
+                    except ValueError as exc:
+                        raise PeerControlError(str(exc))
+                if change.preshared_key is not None:
+                    peer["preshared_key"] = change.preshared_key
+            self.batches += 1
+
+    def save(self, config_name):
+        pass
+
+
+# Netlink and generic netlink constants, see linux/netlink.h and linux/genetlink.h
+NETLINK_GENERIC = 16
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+NLA_F_NESTED = 0x8000
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+# WireGuard generic netlink API, see linux/wireguard.h
+WG_GENL_NAME = "wireguard"
+WG_GENL_VERSION = 1
+WG_CMD_SET_DEVICE = 1
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_FLAGS = 3
+WGPEER_A_ALLOWEDIPS = 9
+WGPEER_F_REMOVE_ME = 0x1
+WGPEER_F_REPLACE_ALLOWEDIPS = 0x2
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+# Attribute lengths are 16 bits, so the peers of one message are kept well below 64KiB
+NETLINK_PEERS_SIZE = 32768
+# Several messages are sent in one datagram, below the default socket send buffer
+NETLINK_DATAGRAM_SIZE = 131072
+
+
+def nl_attr(attr_type, payload):
+    """
+    Encode a netlink attribute, padded to 4 bytes
+    @param attr_type: Attribute type
+    @param payload: Attribute payload
+    @return: bytes
+    """
+    length = 4 + len(payload)
+    return struct.pack("=HH", length, attr_type) + payload + b"\0" * (-length & 3)
+
+
+def nl_parse_attrs(data):
+    """
+    Decode a sequence of netlink attributes
+    @param data: Attributes
+    @return: Dictionary of attribute type to payload
+    @rtype: dict
+    """
+    attrs = {}
+    offset = 0
+    while offset + 4 <= len(data):
+        length, attr_type = struct.unpack_from("=HH", data, offset)
+        if length < 4:
+            break
+        attrs[attr_type & ~NLA_F_NESTED] = data[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+
+def encode_peer(change):
+    """
+    Encode a PeerChange as the attributes of one WGDEVICE_A_PEERS entry
+    @param change: PeerChange
+    @return: bytes
+    """
+    try:
+        public_key = base64.b64decode(change.public_key, validate=True)
+    except ValueError:
+        public_key = b""
+    if len(public_key) != 32:
+        raise PeerControlError(f"Key is not the correct length or format: `{change.public_key}'")
+    attrs = nl_attr(WGPEER_A_PUBLIC_KEY, public_key)
+    if change.remove:
+        return attrs + nl_attr(WGPEER_A_FLAGS, struct.pack("=I", WGPEER_F_REMOVE_ME))
+    if change.preshared_key is not None:
+        try:
+            preshared_key = base64.b64decode(change.preshared_key, validate=True) \
+                if len(change.preshared_key) > 0 else b"\0" * 32
+        except ValueError:
+            preshared_key = b""
+        if len(preshared_key) != 32:
+            raise PeerControlError("Preshared key is not the correct length or format")
+        attrs += nl_attr(WGPEER_A_PRESHARED_KEY, preshared_key)
+    if change.allowed_ips is not None:
+        attrs += nl_attr(WGPEER_A_FLAGS, struct.pack("=I", WGPEER_F_REPLACE_ALLOWEDIPS))
+        allowed_ips = b""
+        for i, allowed_ip in enumerate(change.allowed_ips):
+            try:
+                network = ipaddress.ip_network(allowed_ip, strict=False)
+            except ValueError:
+                raise PeerControlError(f"Unable to parse IP address: `{allowed_ip}'")
+            family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+            allowed_ips += nl_attr(NLA_F_NESTED | i,
+                                   nl_attr(WGALLOWEDIP_A_FAMILY, struct.pack("=H", family)) +
+                                   nl_attr(WGALLOWEDIP_A_IPADDR, network.network_address.packed) +
+                                   nl_attr(WGALLOWEDIP_A_CIDR_MASK, struct.pack("=B", network.prefixlen)))
+        attrs += nl_attr(NLA_F_NESTED | WGPEER_A_ALLOWEDIPS, allowed_ips)
+    return attrs
+
+
+class NetlinkControl(PeerControl):
+    """
+    Apply changes through the WireGuard generic netlink family. A batch is split into
+    as few WG_CMD_SET_DEVICE messages as the attribute size allows, and the messages
+    are sent together so a large batch costs a handful of syscalls and no fork.
+    """
+    name = "netlink"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+        self.sock.bind((0, 0))
+        self.seq = 0
+        try:
+            self.family_id = self.resolve_family()
+        except PeerControlError:
+            self.sock.close()
+            raise
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xffffffff
+        return self.seq
+
+    def message(self, msg_type, flags, cmd, version, attrs):
+        """
+        Encode a generic netlink message
+        @return: Tuple of (sequence number, bytes)
+        @rtype: tuple
+        """
+        seq = self.next_seq()
+        payload = struct.pack("=BBH", cmd, version, 0) + attrs
+        return seq, struct.pack("=IHHII", 16 + len(payload), msg_type, flags, seq, 0) + payload
+
+    def receive(self, pending):
+        """
+        Read replies until every pending sequence number was acknowledged
+        @param pending: Set of sequence numbers waiting for an ack
+        @return: List of payloads of the non-error replies
+        @rtype: list
+        """
+        replies = []
+        error = None
+        while len(pending) > 0:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msg_type, _, seq, _ = struct.unpack_from("=IHHII", data, offset)
+                if length < 16:
+                    break
+                if msg_type == NLMSG_ERROR:
+                    err = struct.unpack_from("=i", data, offset + 16)[0]
+                    pending.discard(seq)
+                    if err != 0 and error is None:
+                        error = os.strerror(-err)
+                elif msg_type != NLMSG_DONE:
+                    replies.append(data[offset + 20:offset + length])
+                offset += (length + 3) & ~3
+        if error is not None:
+            raise PeerControlError(error)
+        return replies
+
+    def resolve_family(self):
+        """
+        Get the generic netlink family ID of WireGuard
+        @return: int
+        """
+        seq, msg = self.message(GENL_ID_CTRL, NLM_F_REQUEST | NLM_F_ACK, CTRL_CMD_GETFAMILY, 1,
+                                nl_attr(CTRL_ATTR_FAMILY_NAME, WG_GENL_NAME.encode() + b"\0"))
+        with self.lock:
+            self.sock.send(msg)
+            replies = self.receive({seq})
+        for reply in replies:
+            attrs = nl_parse_attrs(reply)
+            if CTRL_ATTR_FAMILY_ID in attrs:
+                return struct.unpack("=H", attrs[CTRL_ATTR_FAMILY_ID][:2])[0]
+        raise PeerControlError("WireGuard generic netlink family not found")
+
+    def apply(self, config_name, changes):
+        if len(changes) == 0:
+            return
+        ifname = nl_attr(WGDEVICE_A_IFNAME, config_name.encode() + b"\0")
+        chunks = []
+        peers = b""
+        count = 0
+        for change in changes:
+            peer = encode_peer(change)
+            if len(peers) + len(peer) > NETLINK_PEERS_SIZE and len(peers) > 0:
+                chunks.append(peers)
+                peers = b""
+                count = 0
+            peers += nl_attr(NLA_F_NESTED | count, peer)
+            count += 1
+        chunks.append(peers)
+        with self.lock:
+            pending = set()
+            datagram = b""
+            for chunk in chunks:
+                seq, msg = self.message(self.family_id, NLM_F_REQUEST | NLM_F_ACK, WG_CMD_SET_DEVICE,
+                                        WG_GENL_VERSION, ifname + nl_attr(NLA_F_NESTED | WGDEVICE_A_PEERS, chunk))
+                if len(datagram) + len(msg) > NETLINK_DATAGRAM_SIZE and len(datagram) > 0:
+                    self.sock.send(datagram)
+                    datagram = b""
+                pending.add(seq)
+                datagram += msg
+            self.sock.send(datagram)
+            self.receive(pending)
+
+
+def get_peer_control(name="auto"):
+    """
+    Create a peer control backend
+    @param name: "netlink", "cli", "fake" or "auto" for netlink with the wg tool as fallback
+    @return: PeerControl
+    """
+    if name == "fake":
+        return FakeControl()
+    if name == "cli":
+        return WgCliControl()
+    try:
+        return NetlinkControl()
+    except (OSError, AttributeError, PeerControlError):
+        if name == "netlink":
+            raise
+        return WgCliControl()
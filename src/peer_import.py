@@ -0,0 +1,243 @@
+"""
+< WGDashboard > - Bulk peer import
+Under Apache-2.0 License
+
+Peers are read one record at a time from CSV, JSON Lines, a JSON array or a directory of
+client configuration files, validated and applied in batches, and summarized in a report.
+
+    python3 peer_import.py wg0 peers.csv
+    python3 peer_import.py wg0 /path/to/client/confs --dry-run
+"""
+
+import argparse
+import configparser
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+from peer_control import PeerControlError
+from validation import PEER_FIELDS
+
+# Peers validated and applied together, one kernel update, configuration save and transaction each
+IMPORT_BATCH_SIZE = 1000
+# Errors listed in the report, the others are only counted
+IMPORT_REPORT_ERRORS = 1000
+IMPORT_FORMATS = ("csv", "jsonl", "json", "conf")
+
+# Accepted spellings of the record fields, lowercase, e.g. the keys of a client configuration
+FIELD_ALIASES = {field.lower(): field for field, _ in PEER_FIELDS}
+FIELD_ALIASES.update({
+    "name": "name",
+    "publickey": "public_key",
+    "privatekey": "private_key",
+    "presharedkey": "preshared_key",
+    "allowed_ip": "allowed_ips",
+    "allowedips": "allowed_ips",
+    "address": "allowed_ips",
+    "keepalive": "keep_alive",
+    "persistentkeepalive": "keep_alive",
+    "endpoint_allowed_ips": "endpoint_allowed_ip"
+})
+
+
+def normalize(record):
+    """
+    Rename the fields of a record to the ones of validation.PEER_FIELDS, dropping unknown ones
+    @param record: Dictionary read from a file
+    @return: dict
+    """
+    normalized = {}
+    for key, value in record.items():
+        field = FIELD_ALIASES.get(str(key).strip().lower())
+        if field is not None and value is not None:
+            normalized[field] = str(value).strip()
+    return normalized
+
+
+def read_csv(stream):
+    """
+    @param stream: Text stream of a CSV file with a header row
+    @return: Iterator of records
+    """
+    for row in csv.DictReader(stream):
+        yield normalize(row)
+
+
+def read_json(stream):
+    """
+    @param stream: Text stream of JSON Lines, or of a JSON array of objects
+    @return: Iterator of records
+    """
+    first = stream.read(1)
+    while first.isspace():
+        first = stream.read(1)
+    if first == "[":
+        # An array has to be read whole, JSON Lines is read line by line
+        for record in json.loads(first + stream.read()):
+            yield normalize(record)
+        return
+    for line in itertools.chain([first + stream.readline()], stream):
+        if len(line.strip()) > 0:
+            yield normalize(json.loads(line))
+
+
+def read_conf(text, name):
+    """
+    Read a client configuration, as downloaded from the dashboard
+    @param text: Content of the configuration file
+    @param name: Name of the peer, e.g. the file name
+    @return: Record, without public key, it is derived from the private key
+    @rtype: dict
+    """
+    conf = configparser.ConfigParser(strict=False)
+    conf.read_string(text)
+    interface = conf["Interface"] if conf.has_section("Interface") else {}
+    peer = conf["Peer"] if conf.has_section("Peer") else {}
+    record = {"name": name,
+              "private_key": interface.get("privatekey", ""),
+              "allowed_ips": interface.get("address", ""),
+              "DNS": interface.get("dns", ""),
+              "MTU": interface.get("mtu", ""),
+              "endpoint_allowed_ip": peer.get("allowedips", ""),
+              "keep_alive": peer.get("persistentkeepalive", ""),
+              "preshared_key": peer.get("presharedkey", "")}
+    return {k: v.strip() for k, v in record.items()}
+
+
+def read_conf_dir(path):
+    """
+    @param path: Directory of client configuration files
+    @return: Iterator of records, named after their file
+    """
+    for file in sorted(os.listdir(path)):
+        if file.endswith(".conf"):
+            with open(os.path.join(path, file), encoding="utf-8") as f:
+                yield read_conf(f.read(), file[:-len(".conf")])
+
+
+def detect_format(name):
+    """
+    @param name: File name or path
+    @return: Format of IMPORT_FORMATS, None if unknown
+    """
+    if os.path.isdir(name):
+        return "conf"
+    extension = os.path.splitext(name)[1].lower().lstrip(".")
+    if extension == "ndjson":
+        return "jsonl"
+    return extension if extension in IMPORT_FORMATS else None
+
+
+def read_records(stream, file_format, name=""):
+    """
+    @param stream: Text stream
+    @param file_format: Format of IMPORT_FORMATS
+    @param name: Name of a single client configuration
+    @return: Iterator of records
+    """
+    if file_format == "csv":
+        return read_csv(stream)
+    if file_format == "conf":
+        return iter([read_conf(stream.read(), name)])
+    return read_json(stream)
+
+
+def import_peers(records, validate, apply, public_key=None, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+    """
+    Validate and apply peer records batch by batch, each batch is checked against the
+    peers applied before it
+    @param records: Iterable of records with the fields of validation.PEER_FIELDS
+    @param validate: Function taking a list of records and the row number of the first one,
+                     and returning validation errors
+    @param apply: Function taking a list of valid records and adding them
+    @param public_key: Function deriving the public key of a private key, for records without one
+    @param batch_size: Number of records per batch
+    @param dry_run: Only validate
+    @return: Report of the import
+    @rtype: dict
+    """
+    tic = time.perf_counter()
+    report = {"status": True, "total": 0, "valid": 0, "imported": 0, "failed": 0, "errors": [], "batches": 0}
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if len(batch) == 0:
+            break
+        offset = report["total"]
+        errors = []
+        for row, record in enumerate(batch):
+            if len(record.get("public_key", "")) == 0 and len(record.get("private_key", "")) > 0 \
+                    and public_key is not None:
+                try:
+                    record["public_key"] = public_key(record["private_key"])
+                except PeerControlError as exc:
+                    errors.append({"row": row, "field": "private_key", "msg": str(exc)})
+        derive_failed = set(e["row"] for e in errors)
+        errors += [e for e in validate(batch, offset) if e["row"] not in derive_failed]
+        failed = set(e["row"] for e in errors)
+        valid = [r for row, r in enumerate(batch) if row not in failed]
+        if len(valid) > 0 and not dry_run:
+            try:
+                apply(valid)
+            except PeerControlError as exc:
+                # WireGuard refused the batch as a whole
+                errors += [{"row": row, "field": "", "msg": str(exc)}
+                           for row in range(len(batch)) if row not in failed]
+                failed = set(range(len(batch)))
+        report["total"] += len(batch)
+        report["failed"] += len(failed)
+        report["valid"] += len(batch) - len(failed)
+        report["imported"] += 0 if dry_run else len(batch) - len(failed)
+        report["batches"] += 1
+        for error in sorted(errors, key=lambda e: e["row"]):
+            if len(report["errors"]) < IMPORT_REPORT_ERRORS:
+                report["errors"].append(dict(error, row=offset + error["row"]))
+    report["seconds"] = round(time.perf_counter() - tic, 3)
+    return report
+
+
+def main():
+    """
+    Import peers from the command line into a running configuration
+    @return: Exit status
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(description="Import peers into a WireGuard configuration of the dashboard.")
+    parser.add_argument("config_name", help="configuration name, e.g. wg0")
+    parser.add_argument("path", help="CSV, JSON Lines or JSON file, or a directory of client configuration files")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="format of the file, by default from its extension")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="peers applied together")
+    parser.add_argument("--dry-run", action="store_true", help="only validate the peers")
+    args = parser.parse_args()
+    file_format = args.format or detect_format(args.path)
+    if file_format is None:
+        parser.error("unknown file format, use --format")
+
+    # Imported here, the dashboard imports this module
+    import dashboard
+    from flask import g
+    dashboard.load_settings()
+    with dashboard.app.app_context():
+        g.db = dashboard.connect_db()
+        g.cur = g.db.cursor()
+        try:
+            if file_format == "conf" and os.path.isdir(args.path):
+                report = dashboard.run_import(args.config_name, read_conf_dir(args.path), args.batch_size,
+                                              args.dry_run)
+            else:
+                with open(args.path, encoding="utf-8-sig", newline="") as f:
+                    records = read_records(f, file_format, os.path.splitext(os.path.basename(args.path))[0])
+                    report = dashboard.run_import(args.config_name, records, args.batch_size, args.dry_run)
+            g.db.commit()
+        finally:
+            g.db.close()
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    return 0 if report["status"] and report.get("failed", 0) == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,470 @@
+"""
+< WGDashboard > - In-memory peer indexes
+Under Apache-2.0 License
+"""
+
+import bisect
+import ipaddress
+import threading
+import time
+
+# Seconds a target index is served before it is rebuilt, endpoints roam between refreshes
+TARGET_INDEX_TTL = 10
+
+
+def split_tunnel_ips(allowed_ip):
+    """
+    Get the addresses of a peer's allowed IPs without their prefix length
+    @param allowed_ip: Comma separated allowed IPs, e.g. "10.0.0.2/32, fd00::2/128"
+    @return: list
+    """
+    ips = []
+    for i in str(allowed_ip).split(","):
+        address, slash, _ = i.strip().partition("/")
+        if slash:
+            ips.append(address)
+    return ips
+
+
+def split_endpoint_host(endpoint):
+    """
+    Get the host part of a peer's endpoint
+    @param endpoint: Endpoint as shown by wg, e.g. "1.2.3.4:51820" or "[2001:db8::1]:51820"
+    @return: Host, or None when the peer has no endpoint
+    @rtype: str, None
+    """
+    host, colon, port = str(endpoint).rpartition(":")
+    if not colon or not port.isdigit():
+        return None
+    return host.strip("[]")
+
+
+class CachedIndex:
+    """
+    Per configuration cache of an index built from peer rows, rebuilt when the
+    configuration version changes or after a TTL.
+    """
+
+    def __init__(self, ttl=TARGET_INDEX_TTL):
+        """
+        @param ttl: Seconds an index is served before it is rebuilt
+        """
+        self.ttl = ttl
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self, config_name):
+        """
+        Drop the index of a configuration after its peers changed
+        @param config_name: Configuration name
+        @return: None
+        """
+        with self.lock:
+            self.indexes.pop(config_name, None)
+
+    def get(self, config_name, version, load_rows):
+        """
+        Get the index of a configuration, building it if missing, expired or outdated
+        @param config_name: Configuration name
+        @param version: Anything that changes when the peers change, e.g. configuration file mtime
+        @param load_rows: Function returning rows of (id, name, allowed_ip, endpoint)
+        @return: Index returned by build()
+        """
+        with self.lock:
+            index = self.indexes.get(config_name)
+        if index is not None and index[0] == version and time.time() - index[1] < self.ttl:
+            return index[2]
+        built = self.build(load_rows())
+        with self.lock:
+            self.indexes[config_name] = (version, time.time(), built)
+        return built
+
+    @staticmethod
+    def build(rows):
+        """
+        Build the index from peer rows
+        @param rows: Iterable of (id, name, allowed_ip, endpoint)
+        """
+        raise NotImplementedError
+
+
+class PeerTargetIndex(CachedIndex):
+    """
+    Cached list of network test targets (tunnel IPs and endpoint host) of every peer,
+    with a sorted term list for prefix and type-ahead search.
+    """
+
+    @staticmethod
+    def build(rows):
+        """
+        Build targets and search terms from peer rows
+        @param rows: Iterable of (id, name, allowed_ip, endpoint)
+        @return: Tuple of (targets, terms)
+        @rtype: tuple
+        """
+        targets = []
+        terms = []
+        for peer_id, name, allowed_ip, endpoint in sorted(rows, key=lambda r: (r[1] or "", r[0])):
+            position = len(targets)
+            target = {"id": peer_id, "name": name or "", "ips": split_tunnel_ips(allowed_ip),
+                      "endpoint": split_endpoint_host(endpoint)}
+            targets.append(target)
+            terms.append((peer_id.lower(), position))
+            for word in target["name"].lower().split():
+                terms.append((word, position))
+            if len(target["name"]) > 0:
+                terms.append((target["name"].lower(), position))
+            for ip in target["ips"]:
+                terms.append((ip.lower(), position))
+            if target["endpoint"] is not None:
+                terms.append((target["endpoint"].lower(), position))
+        return targets, sorted(terms)
+
+    def search(self, config_name, version, load_rows, query, limit):
+        """
+        Find targets having a term starting with the query
+        @param config_name: Configuration name
+        @param version: Anything that changes when the peers change, e.g. configuration file mtime
+        @param load_rows: Function returning rows of (id, name, allowed_ip, endpoint)
+        @param query: Prefix typed by the user, empty for all targets
+        @param limit: Maximum number of targets to return
+        @return: list
+        """
+        targets, terms = self.get(config_name, version, load_rows)
+        query = query.strip().lower()
+        if len(query) == 0:
+            return targets[:limit]
+        found = set()
+        i = bisect.bisect_left(terms, (query,))
+        while i < len(terms) and terms[i][0].startswith(query):
+            found.add(terms[i][1])
+            i += 1
+        return [targets[i] for i in sorted(found)[:limit]]
+
+
+class PeerSearchIndex(CachedIndex):
+    """
+    Substring search over name, public key, tunnel IPs and endpoint of every peer.
+    The searchable text of all peers is kept lowercase in one string, so a query is a
+    few str.find() calls over it instead of a LIKE scan of the peer table.
+    """
+
+    @staticmethod
+    def build(rows):
+        """
+        Build the searchable text and the offset of every peer in it
+        @param rows: Iterable of (id, name, allowed_ip, endpoint)
+        @return: Tuple of (ids, offsets, text)
+        @rtype: tuple
+        """
+        ids = []
+        offsets = []
+        parts = []
+        length = 0
+        for peer_id, name, allowed_ip, endpoint in rows:
+            # Fields are separated by characters a query can not contain, so matches stay within one field
+            part = "\0".join((peer_id, name or "", " ".join(split_tunnel_ips(allowed_ip)),
+                                str(endpoint or ""))).lower() + "\n"
+            ids.append(peer_id)
+            offsets.append(length)
+            parts.append(part)
+            length += len(part)
+        return ids, offsets, "".join(parts)
+
+    def search(self, config_name, version, load_rows, query, limit=None):
+        """
+        Find peers having the query in their name, public key, tunnel IPs or endpoint
+        @param config_name: Configuration name
+        @param version: Anything that changes when the peers change, e.g. configuration file mtime
+        @param load_rows: Function returning rows of (id, name, allowed_ip, endpoint)
+        @param query: Text typed by the user
+        @param limit: Maximum number of peers to return, None for all
+        @return: IDs of the matching peers, in table order
+        @rtype: list
+        """
+        ids, offsets, text = self.get(config_name, version, load_rows)
+        query = query.strip().lower().replace("\0", "").replace("\n", "")
+        if len(query) == 0:
+            return ids[:limit]
+        found = []
+        i = text.find(query)
+        while i != -1 and (limit is None or len(found) < limit):
+            position = bisect.bisect_right(offsets, i) - 1
+            found.append(ids[position])
+            if position + 1 == len(offsets):
+                break
+            # Skip the rest of this peer, it only needs to match once
+            i = text.find(query, offsets[position + 1])
+        return found
+
+
+# Seconds an allowed IP index is served before it is rebuilt, it is also kept up to date by the changes
+ALLOWED_IP_INDEX_TTL = 300
+
+
+def parse_networks(allowed_ip):
+    """
+    Parse comma separated allowed IPs, skipping empty, "(None)" and invalid entries
+    @param allowed_ip: e.g. "10.0.0.2/32, fd00::2/128"
+    @return: list of ipaddress.IPv4Network and ipaddress.IPv6Network
+    """
+    networks = []
+    for i in str(allowed_ip or "").split(","):
+        i = i.strip()
+        if len(i) == 0 or i == "(None)":
+            continue
+        try:
+            networks.append(ipaddress.ip_network(i, strict=False))
+        except ValueError:
+            continue
+    return networks
+
+
+class PrefixTrie:
+    """
+    Binary trie of the allowed IP prefixes of one configuration, one root per IP version.
+    A node is a list of [zero child, one child, owners]; the owners of a prefix are the
+    peers claiming it. Queries walk at most the prefix length, plus the subtree for the
+    prefixes contained in a network.
+    """
+
+    def __init__(self):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.peers = {}
+
+    @staticmethod
+    def bits(network):
+        """
+        @param network: ipaddress network
+        @return: Bits of the network address from the most significant one, prefix length long
+        """
+        address = int(network.network_address)
+        width = network.max_prefixlen
+        return ((address >> (width - 1 - i)) & 1 for i in range(network.prefixlen))
+
+    def insert(self, network, owner):
+        """
+        @param network: ipaddress network
+        @param owner: Peer ID claiming the network
+        @return: None
+        """
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        shift = network.max_prefixlen
+        for _ in range(network.prefixlen):
+            shift -= 1
+            bit = (address >> shift) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, None]
+            node = child
+        if node[2] is None:
+            node[2] = {}
+        node[2][owner] = network
+        self.peers.setdefault(owner, []).append(network)
+
+    def remove(self, owner):
+        """
+        Remove every prefix of a peer
+        @param owner: Peer ID
+        @return: None
+        """
+        for network in self.peers.pop(owner, []):
+            path = [self.roots[network.version]]
+            for bit in self.bits(network):
+                path.append(path[-1][bit])
+                if path[-1] is None:
+                    break
+            else:
+                node = path[-1]
+                if node[2] is not None:
+                    node[2].pop(owner, None)
+                    if len(node[2]) == 0:
+                        node[2] = None
+                # Drop the nodes left without prefix nor children
+                for parent, bit, child in zip(reversed(path[:-1]), reversed(list(self.bits(network))),
+                                              reversed(path[1:])):
+                    if child[0] is None and child[1] is None and child[2] is None:
+                        parent[bit] = None
+                    else:
+                        break
+
+    def containing(self, network):
+        """
+        @param network: ipaddress network
+        @return: List of (network, peer ID) of the prefixes containing network or equal to it,
+                 most specific last
+        """
+        found = []
+        node = self.roots[network.version]
+        if node[2] is not None:
+            found.extend((n, owner) for owner, n in node[2].items())
+        address = int(network.network_address)
+        shift = network.max_prefixlen
+        for _ in range(network.prefixlen):
+            shift -= 1
+            node = node[(address >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found.extend((n, owner) for owner, n in node[2].items())
+        return found
+
+    def contained(self, network):
+        """
+        @param network: ipaddress network
+        @return: List of (network, peer ID) of the prefixes strictly inside network
+        """
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        shift = network.max_prefixlen
+        for _ in range(network.prefixlen):
+            shift -= 1
+            node = node[(address >> shift) & 1]
+            if node is None:
+                return []
+        found = []
+        stack = [node[0], node[1]]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if node[2] is not None:
+                found.extend((n, owner) for owner, n in node[2].items())
+            stack.append(node[0])
+            stack.append(node[1])
+        return found
+
+    def overlapping(self, network):
+        """
+        @param network: ipaddress network
+        @return: List of (network, peer ID) of the prefixes sharing at least one address with network
+        """
+        return self.containing(network) + self.contained(network)
+
+    def first_overlap(self, network):
+        """
+        Find one prefix sharing an address with network, walking the path of network once
+        @param network: ipaddress network
+        @return: Tuple of (network, peer ID), None if no prefix overlaps network
+        @rtype: tuple, None
+        """
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        shift = network.max_prefixlen
+        for _ in range(network.prefixlen):
+            if node[2] is not None:
+                break
+            shift -= 1
+            node = node[(address >> shift) & 1]
+            if node is None:
+                return None
+        # A prefix containing network, or the first prefix inside it
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if node[2] is not None:
+                owner, other = next(iter(node[2].items()))
+                return other, owner
+            stack.append(node[1])
+            stack.append(node[0])
+        return None
+
+    def owner(self, address):
+        """
+        Longest prefix match of an address, the peer WireGuard routes it to
+        @param address: ipaddress address
+        @return: Tuple of (network, peer ID), None if no prefix contains the address
+        @rtype: tuple, None
+        """
+        found = self.containing(ipaddress.ip_network(address))
+        return found[-1] if len(found) > 0 else None
+
+
+class AllowedIPIndex(CachedIndex):
+    """
+    Prefix trie of the allowed IPs of every peer, to find overlapping or duplicate
+    allowed IPs without scanning the peer table. Changes made by this process update
+    the trie in place, changes made elsewhere are seen through the configuration version.
+    """
+
+    def __init__(self, ttl=ALLOWED_IP_INDEX_TTL):
+        super().__init__(ttl)
+
+    @staticmethod
+    def build(rows):
+        """
+        Build the trie from peer rows
+        @param rows: Iterable of (id, name, allowed_ip, endpoint)
+        @return: PrefixTrie
+        """
+        trie = PrefixTrie()
+        for peer_id, _, allowed_ip, _ in rows:
+            for network in parse_networks(allowed_ip):
+                trie.insert(network, peer_id)
+        return trie
+
+    def update(self, config_name, version, new_version, changes):
+        """
+        Apply peer changes to the trie of a configuration, if it was built from the
+        version they were made on, otherwise drop it
+        @param config_name: Configuration name
+        @param version: Configuration version before the changes
+        @param new_version: Configuration version after the changes
+        @param changes: Iterable of (peer ID, allowed IPs), None allowed IPs for a removed peer
+        @return: None
+        """
+        with self.lock:
+            index = self.indexes.get(config_name)
+            if index is None or index[0] != version:
+                self.indexes.pop(config_name, None)
+                return
+            trie = index[2]
+            for peer_id, allowed_ip in changes:
+                trie.remove(peer_id)
+                for network in parse_networks(allowed_ip):
+                    trie.insert(network, peer_id)
+            self.indexes[config_name] = (new_version, index[1], trie)
+
+    def conflicts(self, config_name, version, load_rows, allowed_ip, exclude=None):
+        """
+        Find the allowed IPs of other peers overlapping the given ones
+        @param config_name: Configuration name
+        @param version: Anything that changes when the peers change, e.g. configuration file mtime
+        @param load_rows: Function returning rows of (id, name, allowed_ip, endpoint)
+        @param allowed_ip: Comma separated allowed IPs to check, or a list of ipaddress networks
+        @param exclude: Peer ID whose own allowed IPs are not conflicts
+        @return: List of (requested network, conflicting network, peer ID)
+        """
+        trie = self.get(config_name, version, load_rows)
+        networks = parse_networks(allowed_ip) if isinstance(allowed_ip, str) else allowed_ip
+        found = []
+        with self.lock:
+            for network in networks:
+                if exclude is None:
+                    # Only the first conflict of each network is needed
+                    first = trie.first_overlap(network)
+                    if first is not None:
+                        found.append((network, first[0], first[1]))
+                    continue
+                for other, peer_id in trie.overlapping(network):
+                    if peer_id != exclude:
+                        found.append((network, other, peer_id))
+        return found
+
+    def lookup(self, config_name, version, load_rows, network):
+        """
+        Describe how a network relates to the allowed IPs of the peers
+        @param config_name: Configuration name
+        @param version: Anything that changes when the peers change, e.g. configuration file mtime
+        @param load_rows: Function returning rows of (id, name, allowed_ip, endpoint)
+        @param network: ipaddress network, a single address for an owner lookup
+        @return: Tuple of (owner, containing, contained), owner being the longest prefix match
+                 of the network address or None
+        @rtype: tuple
+        """
+        trie = self.get(config_name, version, load_rows)
+        with self.lock:
+            return trie.owner(network.network_address), trie.containing(network), trie.contained(network)
@@ -0,0 +1,151 @@
+"""
+< WGDashboard > - Peer data quota and expiry enforcement
+Under Apache-2.0 License
+
+Policies are checked on each collection of an interface against the snapshot already in
+memory: quotas are turned into thresholds on the WireGuard transfer counters, and expiry
+times are kept in a heap, so a pass only compares counters and looks at the next deadline.
+"""
+
+import heapq
+import threading
+import time
+
+from peer_control import PeerControlError
+
+# Peers suspended together, one WireGuard update and configuration save each
+POLICY_BATCH_SIZE = 1000
+GIGABYTE = 1024 ** 3
+
+
+class PeerPolicies:
+    """
+    Policies of the peers of one configuration, as thresholds and deadlines
+    """
+
+    __slots__ = ("thresholds", "counters", "deadlines")
+
+    def __init__(self, rows):
+        """
+        @param rows: Rows of (id, data_limit, expire_at, cumu_data), data in GB, expire_at in epoch
+        """
+        # Transfer counter total, in bytes, at which a peer reaches its quota
+        self.thresholds = {}
+        # Last (receive, sent) counters of the peers with a quota, to notice resets
+        self.counters = {}
+        self.deadlines = []
+        for peer_id, data_limit, expire_at, cumu_data in rows:
+            if data_limit is not None:
+                self.thresholds[peer_id] = (data_limit - (cumu_data or 0)) * GIGABYTE
+            if expire_at is not None:
+                self.deadlines.append((expire_at, peer_id))
+        heapq.heapify(self.deadlines)
+
+    def over_quota(self, dump):
+        """
+        @param dump: datasource.InterfaceDump of the configuration
+        @return: IDs of the peers whose transfer reached their quota
+        @rtype: list
+        """
+        over = []
+        if len(self.thresholds) == 0:
+            return over
+        for peer in dump.peers:
+            threshold = self.thresholds.get(peer.public_key)
+            if threshold is None:
+                continue
+            last = self.counters.get(peer.public_key)
+            if last is not None and (peer.transfer_rx < last[0] or peer.transfer_tx < last[1]):
+                # The counters restarted, the last ones were added to the cumulative data
+                threshold -= last[0] + last[1]
+                self.thresholds[peer.public_key] = threshold
+            self.counters[peer.public_key] = (peer.transfer_rx, peer.transfer_tx)
+            if peer.transfer_rx + peer.transfer_tx >= threshold:
+                over.append(peer.public_key)
+        return over
+
+    def expired(self, now):
+        """
+        @param now: Current epoch
+        @return: IDs of the peers whose expiry time passed, removed from the heap
+        @rtype: list
+        """
+        expired = []
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            expired.append(heapq.heappop(self.deadlines)[1])
+        return expired
+
+
+class PolicyEngine:
+    """
+    Suspend the peers over their data quota or past their expiry time. The policies of a
+    configuration are loaded on its first evaluation and again when their version changed,
+    whichever worker process changed them.
+    """
+
+    def __init__(self, load, suspend, version, batch_size=POLICY_BATCH_SIZE):
+        """
+        @param load: Function taking a configuration name and returning the rows of its
+                     policies, (id, data_limit, expire_at, cumu_data)
+        @param suspend: Function taking a configuration name and a list of peer IDs, suspending them
+        @param version: Function taking a configuration name and returning the version of its
+                        policies, stored with them so every process sees the changes
+        @param batch_size: Number of peers suspended together
+        """
+        self.load = load
+        self.suspend = suspend
+        self.version = version
+        self.batch_size = batch_size
+        self.policies = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self, config_name):
+        """
+        Reload the policies of a configuration on its next evaluation, whatever their version.
+        Changes made by any process are found through the version instead.
+        @param config_name: Configuration name
+        @return: None
+        """
+        with self.lock:
+            self.policies.pop(config_name, None)
+
+    def evaluate(self, config_name, dump, now=None):
+        """
+        Check the policies of a configuration against a fresh snapshot and suspend the
+        peers breaking them
+        @param config_name: Configuration name
+        @param dump: datasource.InterfaceDump the database was just updated from
+        @param now: Current epoch
+        @return: IDs of the peers suspended
+        @rtype: list
+        """
+        if dump is None:
+            return []
+        version = self.version(config_name)
+        with self.lock:
+            cached = self.policies.get(config_name)
+        if cached is not None and cached[0] == version:
+            policies = cached[1]
+        else:
+            policies = PeerPolicies(self.load(config_name))
+            with self.lock:
+                self.policies[config_name] = (version, policies)
+        due = policies.over_quota(dump) + policies.expired(time.time() if now is None else now)
+        if len(due) == 0:
+            return []
+        due = list(dict.fromkeys(due))
+        suspended = []
+        for i in range(0, len(due), self.batch_size):
+            batch = due[i:i + self.batch_size]
+            try:
+                self.suspend(config_name, batch)
+            except PeerControlError as exc:
+                print(f"Failed to suspend {len(batch)} peers of {config_name}: {exc}")
+                # Popped deadlines and counters are rebuilt, the peers are tried again next time
+                self.invalidate(config_name)
+                break
+            suspended += batch
+        for peer_id in suspended:
+            policies.thresholds.pop(peer_id, None)
+            policies.counters.pop(peer_id, None)
+        return suspended
@@ -0,0 +1,99 @@
+"""
+< WGDashboard > - Per-peer throughput rates
+Under Apache-2.0 License
+
+Rates are moving averages of the transfer counters between consecutive snapshots, one per
+window, decayed like the load average so a peer costs a fixed amount of memory whatever the
+window. They are measured by the process collecting the interface and stored with its
+snapshot, with the heaviest peers of each window, so every worker reads the same rates and
+reading them does not sort the peers again.
+"""
+
+import heapq
+import math
+
+# Averaging windows, by name, in seconds
+RATE_WINDOWS = {"10s": 10, "1m": 60, "5m": 300}
+# Number of heaviest peers kept per window
+TOP_PEERS = 100
+
+
+class InterfaceRates:
+    """
+    Average rates of the peers of one snapshot, and its heaviest peers
+    """
+
+    __slots__ = ("averages", "top")
+
+    def __init__(self, averages, top):
+        """
+        @param averages: Sequence in the order of the peers of the snapshot, of the receive and
+                         sent bytes per second of each window, None until the second snapshot of a peer
+        @param top: Window name to list of (public key, receive, sent) by decreasing total rate
+        """
+        self.averages = averages
+        self.top = top
+
+    def heaviest(self, window, limit):
+        """
+        @param window: Name of RATE_WINDOWS
+        @param limit: Maximum number of peers, up to the number kept per window
+        @return: List of (public key, receive, sent) in bytes per second by decreasing total
+        @rtype: list
+        """
+        return self.top[window][:limit]
+
+
+def measure(previous, snapshot, top_peers=TOP_PEERS):
+    """
+    Update the rates of the previous snapshot of an interface with a new one
+    @param previous: collector.Snapshot the interface had before, None for its first
+    @param snapshot: New collector.Snapshot
+    @param top_peers: Number of heaviest peers kept per window
+    @return: InterfaceRates of the new snapshot, None when the interface is stopped
+    """
+    if snapshot.dump is None:
+        return None
+    last = {}
+    elapsed = 0
+    if previous is not None and previous.dump is not None:
+        elapsed = snapshot.time - previous.time
+        averages = previous.rates.averages if previous.rates is not None else None
+        for i, peer in enumerate(previous.dump.peers):
+            last[peer.public_key] = (peer.transfer_rx, peer.transfer_tx,
+                                     averages[i] if averages is not None else None)
+    windows = list(RATE_WINDOWS.values())
+    # Weight of the new sample in each average
+    weights = [1 - math.exp(-elapsed / window) for window in windows] if elapsed > 0 else []
+    keys = []
+    averages = []
+    for peer in snapshot.dump.peers:
+        keys.append(peer.public_key)
+        state = last.get(peer.public_key)
+        if state is None:
+            # First sample of the peer, rates start from the next snapshot
+            averages.append(None)
+            continue
+        if elapsed <= 0:
+            # Not newer than the previous snapshot, nothing to average
+            averages.append(state[2])
+            continue
+        # Counters restart from zero with the interface
+        rx = (peer.transfer_rx - state[0] if peer.transfer_rx >= state[0] else peer.transfer_rx) / elapsed
+        tx = (peer.transfer_tx - state[1] if peer.transfer_tx >= state[1] else peer.transfer_tx) / elapsed
+        if state[2] is None:
+            # Every average starts from the first rate instead of ramping up from zero
+            averages.append((rx, tx) * len(windows))
+            continue
+        average = []
+        for i, weight in enumerate(weights):
+            average.append(state[2][2 * i] + weight * (rx - state[2][2 * i]))
+            average.append(state[2][2 * i + 1] + weight * (tx - state[2][2 * i + 1]))
+        averages.append(tuple(average))
+    measured = [item for item in zip(keys, averages) if item[1] is not None]
+    top = {}
+    for i, name in enumerate(RATE_WINDOWS):
+        rx, tx = 2 * i, 2 * i + 1
+        heaviest = heapq.nlargest(top_peers, measured, key=lambda item: item[1][rx] + item[1][tx])
+        top[name] = [(key, average[rx], average[tx]) for key, average in heaviest if average[rx] + average[tx] > 0]
+    return InterfaceRates(averages, top)
@@ -0,0 +1,158 @@
+"""
+< WGDashboard > - Reconciliation of configuration peers with the database
+Under Apache-2.0 License
+"""
+
+import os
+import threading
+
+from peer_model import PEER_COLUMNS, PEER_SELECT, PEER_INSERT, COLUMN_INDEX
+
+
+class ReconcilePlan:
+    """
+    Set based difference between the peers of a configuration file, the kernel and the database.
+    """
+
+    __slots__ = ("add", "remove", "allowed_ip", "invalid", "kernel_missing", "kernel_extra")
+
+    def __init__(self, add, remove, allowed_ip, invalid, kernel_missing, kernel_extra):
+        """
+        @param add: Configuration peers (dict of the [Peer] section) missing from the database
+        @param remove: IDs in the database no longer in the configuration
+        @param allowed_ip: List of (allowed_ip, id) of existing rows whose allowed IPs changed
+        @param invalid: Number of [Peer] sections without a public key
+        @param kernel_missing: IDs in the configuration but not in the running interface
+        @param kernel_extra: IDs in the running interface but not in the configuration
+        """
+        self.add = add
+        self.remove = remove
+        self.allowed_ip = allowed_ip
+        self.invalid = invalid
+        self.kernel_missing = kernel_missing
+        self.kernel_extra = kernel_extra
+
+    def empty(self):
+        """
+        @return: True when the database already matches the configuration
+        @rtype: bool
+        """
+        return len(self.add) == 0 and len(self.remove) == 0 and len(self.allowed_ip) == 0
+
+
+def plan(conf_peers, db_peers, kernel_keys=None):
+    """
+    Compute what has to change in the database for it to match the configuration file
+    @param conf_peers: List of [Peer] section dicts, as returned by read_conf_file
+    @param db_peers: Dictionary of database ID to allowed_ip
+    @param kernel_keys: Public keys of the running interface, None when it is stopped
+    @return: ReconcilePlan
+    """
+    conf = {}
+    invalid = 0
+    for peer in conf_peers:
+        if "PublicKey" in peer:
+            conf[peer["PublicKey"]] = peer
+        else:
+            invalid += 1
+    add = [peer for key, peer in conf.items() if key not in db_peers]
+    remove = [key for key in db_peers if key not in conf]
+    allowed_ip = [(peer.get("AllowedIPs", "(None)"), key) for key, peer in conf.items()
+                  if key in db_peers and db_peers[key] != peer.get("AllowedIPs", "(None)")]
+    kernel_missing = []
+    kernel_extra = []
+    if kernel_keys is not None:
+        kernel_keys = set(kernel_keys)
+        kernel_missing = [key for key in conf if key not in kernel_keys]
+        kernel_extra = [key for key in kernel_keys if key not in conf]
+    return ReconcilePlan(add, remove, allowed_ip, invalid, kernel_missing, kernel_extra)
+
+
+def new_row(peer, template):
+    """
+    @param peer: [Peer] section dict of the configuration file
+    @param template: Column values of new peers, in the order of peer_model.PEER_COLUMNS
+    @return: Row of the peer table for the peer
+    @rtype: tuple
+    """
+    row = list(template)
+    row[COLUMN_INDEX["id"]] = peer["PublicKey"]
+    row[COLUMN_INDEX["allowed_ip"]] = peer.get("AllowedIPs", "(None)")
+    row[COLUMN_INDEX["preshared_key"]] = peer.get("PresharedKey", "")
+    return tuple(row)
+
+
+class Reconciler:
+    """
+    Keep the peer table of every configuration in line with its configuration file, running
+    the diff only when the file changed or the table no longer has the rows it was left with.
+    """
+
+    def __init__(self):
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self, config_name):
+        """
+        Force the next reconcile of a configuration
+        @param config_name: Configuration name
+        @return: None
+        """
+        with self.lock:
+            self.versions.pop(config_name, None)
+
+    @staticmethod
+    def conf_version(conf_location):
+        """
+        @param conf_location: Path of the configuration file
+        @return: Tuple of (mtime in ns, size)
+        @rtype: tuple
+        """
+        stat = os.stat(conf_location)
+        return stat.st_mtime_ns, stat.st_size
+
+    def reconcile(self, cur, config_name, conf_location, read_conf, kernel_keys, defaults):
+        """
+        Apply the difference between the configuration file and the database as one batch
+        @param cur: sqlite3.Cursor
+        @param config_name: Configuration name, also the table name
+        @param conf_location: Path of the configuration file
+        @param read_conf: Function returning the parsed configuration, as read_conf_file does
+        @param kernel_keys: Function returning the public keys of the running interface, None if stopped
+                            or not known, then only the configuration file and the database are compared
+        @param defaults: Column values of new peers, except id, allowed_ip and preshared_key
+        @return: ReconcilePlan that was applied, None when nothing changed since the last run
+        @rtype: ReconcilePlan, None
+        """
+        version = self.conf_version(conf_location)
+        count = cur.execute("SELECT COUNT(*) FROM " + config_name).fetchone()[0]
+        with self.lock:
+            last = self.versions.get(config_name)
+        if last == (version, count):
+            return None
+        db_peers = dict(cur.execute("SELECT id, allowed_ip FROM " + config_name).fetchall())
+        result = plan(read_conf()["Peers"], db_peers, kernel_keys())
+        if result.invalid > 0:
+            print(f"Trying to parse {result.invalid} peer(s) that don't have a public key...")
+        if len(result.kernel_missing) > 0 or len(result.kernel_extra) > 0:
+            print(f"{config_name}: {len(result.kernel_missing)} peer(s) not loaded in WireGuard, "
+                  f"{len(result.kernel_extra)} peer(s) not saved in the configuration file")
+        if not result.empty():
+            template = [defaults.get(name) for name in PEER_COLUMNS]
+            # A savepoint keeps the batch atomic inside the transaction of the caller, committed with it
+            cur.execute("SAVEPOINT reconcile")
+            try:
+                cur.executemany(
+                    f"INSERT INTO {config_name} ({PEER_SELECT}) VALUES ({PEER_INSERT})",
+                    (new_row(peer, template) for peer in result.add))
+                cur.executemany("DELETE FROM " + config_name + " WHERE id = ?", ((key,) for key in result.remove))
+                cur.executemany("UPDATE " + config_name + " SET allowed_ip = ? WHERE id = ?", result.allowed_ip)
+            except Exception:
+                cur.execute("ROLLBACK TO reconcile")
+                cur.execute("RELEASE reconcile")
+                raise
+            cur.execute("RELEASE reconcile")
+            count += len(result.add) - len(result.remove)
+        with self.lock:
+            self.versions[config_name] = (version, count)
+        return result
@@ -0,0 +1,80 @@
+"""
+< WGDashboard > - Request coalescing
+Under Apache-2.0 License
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+
+# Seconds a result is shared with identical requests arriving after it was computed
+COALESCE_WINDOW = 1.0
+
+
+class SingleFlight:
+    """
+    Run one computation per key at a time: concurrent callers with the same key wait for
+    the call in flight and share its result, and callers arriving within the freshness
+    window after it finished reuse it, so the load does not grow with the number of viewers.
+    Invalidating a configuration starts a new generation of its keys: calls started before
+    are neither joined nor their results shared afterwards.
+    """
+
+    def __init__(self):
+        self.running = {}
+        self.results = {}
+        # Configuration name to the number of times it was invalidated
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, window=COALESCE_WINDOW):
+        """
+        @param key: Hashable identity of the computation
+        @param function: Function computing the result, called without arguments
+        @param window: Seconds a finished result is still shared
+        @return: Result of function, possibly computed for another caller
+        """
+        now = time.monotonic()
+        with self.lock:
+            for k in [k for k, (finished, _) in self.results.items() if now - finished > window]:
+                del self.results[k]
+            shared = self.results.get(key)
+            if shared is not None:
+                return shared[1]
+            generation = self.generations.get(key[0], 0)
+            running = self.running.get(key)
+            owner = running is None or running[0] != generation
+            if owner:
+                future = Future()
+                self.running[key] = (generation, future)
+            else:
+                future = running[1]
+        if not owner:
+            return future.result()
+        try:
+            result = function()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            with self.lock:
+                # Computed from data that changed since it started
+                if window > 0 and self.generations.get(key[0], 0) == generation:
+                    self.results[key] = (time.monotonic(), result)
+            return result
+        finally:
+            with self.lock:
+                if self.running.get(key, (None, None))[1] is future:
+                    del self.running[key]
+
+    def invalidate(self, config_name):
+        """
+        Stop sharing the results of a configuration, finished or in flight
+        @param config_name: Configuration name, first item of the keys
+        @return: None
+        """
+        with self.lock:
+            self.generations[config_name] = self.generations.get(config_name, 0) + 1
+            for key in [k for k in self.results if k[0] == config_name]:
+                del self.results[key]
@@ -0,0 +1,257 @@
+"""
+< WGDashboard > - Snapshot store shared by all worker processes
+Under Apache-2.0 License
+
+The collecting process writes every interface snapshot to a compact binary file, which
+the other workers map read-only, so they neither collect nor parse the interface again.
+A file is replaced atomically, a reader keeps the mapping of the version it opened.
+
+File layout, little endian:
+    header   magic "WGDS", format, sequence, collected_at, duration, running, peer count,
+             interface public key and listen port (offset and length in the string area),
+             number of heaviest peers
+    peers    one fixed size record per peer: latest_handshake, transfer_rx, transfer_tx,
+             keepalive, then offset and length of public key, endpoint and allowed IPs
+    rates    receive and sent rate of each window per peer, in the order of the peers, NaN
+             until the second snapshot of the peer
+    top      one record per heaviest peer: window, offset and length of its public key,
+             receive and sent rate
+    strings  UTF-8 text referenced by the records
+"""
+
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from collector import Snapshot
+from datasource import InterfaceDump, PeerDump
+from rates import InterfaceRates, RATE_WINDOWS
+
+SNAPSHOT_MAGIC = b"WGDS"
+SNAPSHOT_FORMAT = 2
+HEADER = struct.Struct("<4sHxxQddBxxxIIHIHI")
+PEER = struct.Struct("<QQQHIHIHII")
+RATES = struct.Struct("<" + "dd" * len(RATE_WINDOWS))
+TOP = struct.Struct("<BIHdd")
+NO_RATES = (math.nan,) * (2 * len(RATE_WINDOWS))
+
+
+class MappedPeers:
+    """
+    Read-only sequence of the peers of a mapped snapshot, a PeerDump is only built when accessed
+    """
+
+    __slots__ = ("buffer", "count", "strings")
+
+    def __init__(self, buffer, count, strings):
+        self.buffer = buffer
+        self.count = count
+        self.strings = strings
+
+    def __len__(self):
+        return self.count
+
+    def text(self, offset, length):
+        return bytes(self.buffer[self.strings + offset:self.strings + offset + length]).decode("utf-8")
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        (latest_handshake, transfer_rx, transfer_tx, keepalive, key_offset, key_length, endpoint_offset,
+         endpoint_length, allowed_offset, allowed_length) = PEER.unpack_from(self.buffer, HEADER.size + i * PEER.size)
+        return PeerDump(self.text(key_offset, key_length), "", self.text(endpoint_offset, endpoint_length),
+                        self.text(allowed_offset, allowed_length), latest_handshake, transfer_rx, transfer_tx,
+                        keepalive)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+
+class MappedRates:
+    """
+    Read-only sequence of the average rates of the peers of a mapped snapshot
+    """
+
+    __slots__ = ("buffer", "count", "start")
+
+    def __init__(self, buffer, count, start):
+        self.buffer = buffer
+        self.count = count
+        self.start = start
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        averages = RATES.unpack_from(self.buffer, self.start + i * RATES.size)
+        return None if math.isnan(averages[0]) else averages
+
+
+def encode(snapshot, sequence):
+    """
+    Serialize a snapshot
+    @param snapshot: collector.Snapshot
+    @param sequence: Number increased on every write of the interface
+    @return: bytes
+    """
+    strings = bytearray()
+
+    def add(text):
+        data = str(text).encode("utf-8")
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    dump = snapshot.dump
+    peers = dump.peers if dump is not None else []
+    interface_key = add(dump.public_key if dump is not None else "")
+    listen_port = add(dump.listen_port if dump is not None else "")
+    records = bytearray(PEER.size * len(peers))
+    for i, peer in enumerate(peers):
+        PEER.pack_into(records, i * PEER.size, peer.latest_handshake, peer.transfer_rx, peer.transfer_tx,
+                       peer.keepalive, *add(peer.public_key), *add(peer.endpoint), *add(peer.allowed_ips))
+    rates = bytearray(RATES.size * len(peers))
+    top = bytearray()
+    if snapshot.rates is not None:
+        for i, averages in enumerate(snapshot.rates.averages):
+            RATES.pack_into(rates, i * RATES.size, *(averages if averages is not None else NO_RATES))
+        for window, name in enumerate(RATE_WINDOWS):
+            for key, rx, tx in snapshot.rates.top[name]:
+                top += TOP.pack(window, *add(key), rx, tx)
+    else:
+        for i in range(len(peers)):
+            RATES.pack_into(rates, i * RATES.size, *NO_RATES)
+    header = HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, sequence, snapshot.time, snapshot.duration,
+                         1 if dump is not None else 0, len(peers), *interface_key, *listen_port, len(top) // TOP.size)
+    return header + bytes(records) + bytes(rates) + bytes(top) + bytes(strings)
+
+
+def decode(config_name, buffer):
+    """
+    Read a snapshot without copying its peers
+    @param config_name: Configuration name
+    @param buffer: mmap or bytes of a snapshot file
+    @return: Tuple of (sequence, collector.Snapshot)
+    @rtype: tuple
+    """
+    (magic, file_format, sequence, collected_at, duration, running, count, key_offset, key_length, port_offset,
+     port_length, top_count) = HEADER.unpack_from(buffer, 0)
+    if magic != SNAPSHOT_MAGIC or file_format != SNAPSHOT_FORMAT:
+        raise ValueError(f"{config_name} snapshot has an unknown format")
+    rates_start = HEADER.size + count * PEER.size
+    top_start = rates_start + count * RATES.size
+    peers = MappedPeers(buffer, count, top_start + top_count * TOP.size)
+    dump = None
+    rates = None
+    if running:
+        dump = InterfaceDump(peers.text(key_offset, key_length), peers.text(port_offset, port_length), peers)
+        names = list(RATE_WINDOWS)
+        top = {name: [] for name in names}
+        for i in range(top_count):
+            window, offset, length, rx, tx = TOP.unpack_from(buffer, top_start + i * TOP.size)
+            top[names[window]].append((peers.text(offset, length), rx, tx))
+        rates = InterfaceRates(MappedRates(buffer, count, rates_start), top)
+    return sequence, Snapshot(config_name, collected_at, duration, dump, rates)
+
+
+class SnapshotStore:
+    """
+    Directory of snapshot files, one per interface, plus the marks of the interfaces
+    being viewed in any worker, so the collecting process can prioritize them.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Directory of the snapshot files
+        """
+        self.path = path
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.sequences = {}
+        self.mapped = {}
+        self.lock = threading.Lock()
+
+    def file(self, config_name, extension):
+        return os.path.join(self.path, f"{config_name}.{extension}")
+
+    def write(self, snapshot):
+        """
+        Publish the snapshot of an interface to every worker
+        @param snapshot: collector.Snapshot
+        @return: None
+        """
+        with self.lock:
+            sequence = self.sequences.get(snapshot.config_name, int(time.time() * 1000)) + 1
+            self.sequences[snapshot.config_name] = sequence
+        data = encode(snapshot, sequence)
+        target = self.file(snapshot.config_name, "snap")
+        temp = f"{target}.{os.getpid()}.{threading.get_ident()}"
+        with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(data)
+        os.replace(temp, target)
+
+    def read(self, config_name):
+        """
+        Get the latest published snapshot of an interface, the same object is returned until it changes
+        @param config_name: Configuration name
+        @return: collector.Snapshot, None if none was published
+        """
+        target = self.file(config_name, "snap")
+        try:
+            stat = os.stat(target)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            mapped = self.mapped.get(config_name)
+        if mapped is not None and mapped[0] == key:
+            return mapped[1]
+        try:
+            with open(target, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _, snapshot = decode(config_name, buffer)
+        except (OSError, ValueError, struct.error) as exc:
+            print(f"Failed to read the {config_name} snapshot: {exc}")
+            return None
+        with self.lock:
+            # The previous mapping is released once no snapshot refers to it
+            self.mapped[config_name] = (key, snapshot)
+        return snapshot
+
+    def mark_viewed(self, config_name, interval):
+        """
+        Record that a page of an interface is open, at most once a second per interface
+        @param config_name: Configuration name
+        @param interval: Seconds between two refreshes of the page
+        @return: None
+        """
+        target = self.file(config_name, "view")
+        try:
+            if time.time() - os.stat(target).st_mtime < 1:
+                return
+        except FileNotFoundError:
+            pass
+        with open(target, "w", encoding="utf-8") as f:
+            f.write(str(interval))
+
+    def viewed(self, config_name):
+        """
+        @param config_name: Configuration name
+        @return: Tuple of (epoch of the last view, page refresh interval), None if never viewed
+        @rtype: tuple, None
+        """
+        target = self.file(config_name, "view")
+        try:
+            with open(target, encoding="utf-8") as f:
+                return os.fstat(f.fileno()).st_mtime, float(f.read() or 0)
+        except (OSError, ValueError):
+            return None
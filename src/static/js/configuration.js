@@ -79,58 +79,219 @@
         document.querySelectorAll(".info h6").forEach(ele => ele.classList.remove("info_loading"));
     }
 
+    /**
+     * Virtualized peer list, only the rows around the viewport are in the DOM.
+     * Rendered rows are kept by peer ID and only rebuilt when what they display changed.
+     */
+    const PEER_LIST_BUFFER_ROWS = 4;
+    const PEER_LIST_FIRST_RENDER = 12;
+    let peerList = {
+        peers: [],
+        conf_name: "",
+        time: 0,
+        display_mode: "grid",
+        nodes: new Map(),
+        row_height: 0,
+        frame: null
+    };
+
+    /**
+     * Time since the latest handshake, like "0:01:23"
+     * @param epoch Latest handshake, 0 if the peer never connected
+     * @param now Epoch the peers were collected at
+     * @returns {string}
+     */
+    function humanizeHandshake(epoch, now) {
+        if (!epoch) return "(None)";
+        let seconds = Math.max(0, Math.floor(now - epoch));
+        let days = Math.floor(seconds / 86400);
+        seconds %= 86400;
+        let clock = Math.floor(seconds / 3600) + ":" + String(Math.floor(seconds % 3600 / 60)).padStart(2, "0") +
+            ":" + String(seconds % 60).padStart(2, "0");
+        return days > 0 ? days + (days === 1 ? " day, " : " days, ") + clock : clock;
+    }
+
+    /**
+     * Build the HTML of one peer
+     * @param peer
+     * @returns {string}
+     */
+    function peerHTML(peer) {
+        let total_r = 0;
+        let total_s = 0;
+        total_r += peer.cumu_receive;
+        total_s += peer.cumu_sent;
+        let display_mode = peerList.display_mode === "list" ? "col-12" : "col-sm-6 col-lg-4";
+        let spliter = '<div class="w-100"></div>';
+        let peer_name =
+            '<div class="col-sm display" style="display: flex; align-items: center; margin-bottom: 0.2rem">' +
+                '<h5 style="margin: 0; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;">'+ (peer.name === "" ? "Untitled" : peer.name) +'</h5>' +
+                '<h6 style="text-transform: uppercase; margin: 0; margin-left: auto !important;"><span class="dot dot-'+peer.status+'" style="margin-left: auto !important;" data-toggle="tooltip" data-placement="left" title="'+(peer.status === "running" ? "Peer Connected" : "Peer Disconnected")+'"></span></h6>' +
+            '</div>';
+        let peer_transfer = '<div class="col-12 peer_data_group" style="text-align: right; display: flex; margin-bottom: 0.5rem"><p class="text-primary" style="text-transform: uppercase; margin-bottom: 0; margin-right: 1rem"><small><i class="bi bi-arrow-down-right"></i> '+ roundN(peer.total_receive + total_r, 4) +' GB</small></p> <p class="text-success" style="text-transform: uppercase; margin-bottom: 0"><small><i class="bi bi-arrow-up-right"></i> '+ roundN(peer.total_sent + total_s, 4) +' GB</small></p> </div>';
+        let peer_key = '<div class="col-sm"><small class="text-muted" style="display: flex"><strong>PEER</strong><strong style="margin-left: auto!important; opacity: 0; transition: 0.2s ease-in-out" class="text-primary">CLICK TO COPY</strong></small> <h6><samp class="ml-auto key">'+peer.id+'</samp></h6></div>';
+        let peer_allowed_ip = '<div class="col-sm"><small class="text-muted"><strong>ALLOWED IP</strong></small><h6 style="text-transform: uppercase;">'+peer.allowed_ip+'</h6></div>';
+        let peer_latest_handshake = '<div class="col-sm"> <small class="text-muted"><strong>LATEST HANDSHAKE</strong></small> <h6 style="text-transform: uppercase;">'+humanizeHandshake(peer.latest_handshake, peerList.time)+'</h6> </div>';
+        let peer_endpoint = '<div class="col-sm"><small class="text-muted"><strong>END POINT</strong></small><h6 style="text-transform: uppercase;">'+peer.endpoint+'</h6></div>';
+        let peer_control = '<div class="col-sm"><hr><div class="button-group" style="display:flex"><button type="button" class="btn btn-outline-primary btn-setting-peer btn-control" id="'+peer.id+'" data-toggle="modal"><i class="bi bi-gear-fill" data-toggle="tooltip" data-placement="bottom" title="Peer Settings"></i></button> <button type="button" class="btn btn-outline-danger btn-delete-peer btn-control" id="'+peer.id+'" data-toggle="modal"><i class="bi bi-x-circle-fill" data-toggle="tooltip" data-placement="bottom" title="Delete Peer"></i></button>';
+        if (peer.private_key !== ""){
+            peer_control += '<div class="share_peer_btn_group" style="margin-left: auto !important; display: inline"><button type="button" class="btn btn-outline-success btn-qrcode-peer btn-control" data-imgsrc="/qrcode/'+peerList.conf_name+'?id='+encodeURIComponent(peer.id)+'"><svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" style="width: 19px;" fill="#28a745"><path d="M3 11h8V3H3v8zm2-6h4v4H5V5zM3 21h8v-8H3v8zm2-6h4v4H5v-4zM13 3v8h8V3h-8zm6 6h-4V5h4v4zM13 13h2v2h-2zM15 15h2v2h-2zM13 17h2v2h-2zM17 17h2v2h-2zM19 19h2v2h-2zM15 19h2v2h-2zM17 13h2v2h-2zM19 15h2v2h-2z"/></svg></button><a href="/download/'+peerList.conf_name+'?id='+encodeURIComponent(peer.id)+'" class="btn btn-outline-info btn-download-peer btn-control"><i class="bi bi-download"></i></a></div>';
+        }
+        peer_control += '</div>';
+        return '<div class="'+display_mode+'" data-id="'+peer.id+'">' +
+                    '<div class="card mb-3 card-'+peer.status+'">' +
+                        '<div class="card-body">' +
+                         '<div class="row">' +
+                            peer_name +
+                            spliter +
+                            peer_transfer +
+                            peer_key +
+                            peer_allowed_ip +
+                            peer_latest_handshake +
+                            spliter +
+                            peer_endpoint +
+                            spliter +
+                            peer_control +
+                        '</div>' +
+                    '</div>' +
+                    '</div>' +
+                '</div></div>';
+    }
+
+    /**
+     * Get the DOM node of a peer, reusing the rendered one if nothing it displays changed
+     * @param peer
+     * @returns {Element}
+     */
+    function peerNode(peer) {
+        let html = peerHTML(peer);
+        let node = peerList.nodes.get(peer.id);
+        if (node !== undefined && node.html === html){
+            return node.element;
+        }
+        if (node !== undefined){
+            $(node.element).find("[data-toggle='tooltip']").tooltip("dispose");
+        }
+        let template = document.createElement("template");
+        template.innerHTML = html;
+        let element = template.content.firstElementChild;
+        $(element).find("[data-toggle='tooltip']").tooltip();
+        peerList.nodes.set(peer.id, {html: html, element: element});
+        return element;
+    }
+
+    /**
+     * Number of peers per row, following the Bootstrap breakpoints of the peer columns
+     * @returns {number}
+     */
+    function peerColumns() {
+        if (peerList.display_mode === "list") return 1;
+        if (window.innerWidth >= 992) return 3;
+        if (window.innerWidth >= 576) return 2;
+        return 1;
+    }
+
+    /**
+     * Spacer standing for the rows that are not rendered
+     * @param height
+     * @returns {Element}
+     */
+    function peerSpacer(height) {
+        let spacer = document.createElement("div");
+        spacer.className = "col-12 peer_list_spacer";
+        spacer.style.height = height + "px";
+        return spacer;
+    }
+
+    /**
+     * Render the peers around the viewport
+     */
+    function renderPeerWindow() {
+        peerList.frame = null;
+        let $peer_list = document.querySelector(".peer_list");
+        let total = peerList.peers.length;
+        if (total === 0) return;
+        let columns = peerColumns();
+        let rows = Math.ceil(total / columns);
+        let first_row = 0;
+        let last_row = Math.min(rows, Math.ceil(PEER_LIST_FIRST_RENDER / columns)) - 1;
+        if (peerList.row_height > 0){
+            let list_top = $peer_list.getBoundingClientRect().top;
+            first_row = Math.max(0, Math.floor(-list_top / peerList.row_height) - PEER_LIST_BUFFER_ROWS);
+            last_row = Math.min(rows - 1, Math.ceil((window.innerHeight - list_top) / peerList.row_height) + PEER_LIST_BUFFER_ROWS);
+            first_row = Math.min(first_row, last_row);
+        }
+        let first = first_row * columns;
+        let last = Math.min(total - 1, (last_row + 1) * columns - 1);
+        let fragment = document.createDocumentFragment();
+        let visible = new Set();
+        fragment.appendChild(peerSpacer(first_row * peerList.row_height));
+        for (let i = first; i <= last; i++){
+            fragment.appendChild(peerNode(peerList.peers[i]));
+            visible.add(peerList.peers[i].id);
+        }
+        fragment.appendChild(peerSpacer((rows - last_row - 1) * peerList.row_height));
+        peerList.nodes.forEach(function(node, id){
+            if (!visible.has(id)){
+                $(node.element).find("[data-toggle='tooltip']").tooltip("dispose");
+                peerList.nodes.delete(id);
+            }
+        });
+        $peer_list.textContent = "";
+        $peer_list.appendChild(fragment);
+        if (peerList.row_height === 0){
+            let height = 0;
+            $peer_list.querySelectorAll(":scope > [data-id]").forEach(ele => height = Math.max(height, ele.offsetHeight));
+            if (height > 0){
+                peerList.row_height = height;
+                renderPeerWindow();
+            }
+        }
+    }
+
+    /**
+     * Schedule a render of the peer list on the next frame
+     */
+    function schedulePeerWindow() {
+        if (peerList.frame === null){
+            peerList.frame = window.requestAnimationFrame(renderPeerWindow);
+        }
+    }
+
+    /**
+     * Change how peers are displayed
+     * @param display_mode
+     */
+    function setPeerDisplayMode(display_mode) {
+        peerList.display_mode = display_mode;
+        peerList.row_height = 0;
+        renderPeerWindow();
+    }
+
+    window.addEventListener("scroll", schedulePeerWindow, {passive: true});
+    window.addEventListener("resize", function(){
+        peerList.row_height = 0;
+        schedulePeerWindow();
+    });
+
     /**
      * Parse all responded information onto the peers list
      * @param response
      */
     function configurationPeers(response) {
-        let result = "";
+        peerList.peers = response.peer_data;
+        peerList.conf_name = response.name;
+        peerList.time = response.time;
+        if (response.peer_display_mode !== peerList.display_mode){
+            peerList.display_mode = response.peer_display_mode;
+            peerList.row_height = 0;
+        }
         if (response.peer_data.length === 0){
+            peerList.nodes.forEach(node => $(node.element).find("[data-toggle='tooltip']").tooltip("dispose"));
+            peerList.nodes.clear();
             document.querySelector(".peer_list").innerHTML = `<div class="col-12" style="text-align: center; margin-top: 1.5rem"><h3 class="text-muted">Oops! No peers found ‘︿’</h3></div>`;
         }else{
-            let display_mode = response.peer_display_mode === "list" ? "col-12" : "col-sm-6 col-lg-4";
-            response.peer_data.forEach(function(peer){
-                let total_r = 0;
-                let total_s = 0;
-                total_r += peer.cumu_receive;
-                total_s += peer.cumu_sent;
-                let spliter = '<div class="w-100"></div>';
-                let peer_name =
-                    '<div class="col-sm display" style="display: flex; align-items: center; margin-bottom: 0.2rem">' +
-                        '<h5 style="margin: 0; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;">'+ (peer.name === "" ? "Untitled" : peer.name) +'</h5>' +
-                        '<h6 style="text-transform: uppercase; margin: 0; margin-left: auto !important;"><span class="dot dot-'+peer.status+'" style="margin-left: auto !important;" data-toggle="tooltip" data-placement="left" title="Peer Connected"></span></h6>' +
-                    '</div>';
-                let peer_transfer = '<div class="col-12 peer_data_group" style="text-align: right; display: flex; margin-bottom: 0.5rem"><p class="text-primary" style="text-transform: uppercase; margin-bottom: 0; margin-right: 1rem"><small><i class="bi bi-arrow-down-right"></i> '+ roundN(peer.total_receive + total_r, 4) +' GB</small></p> <p class="text-success" style="text-transform: uppercase; margin-bottom: 0"><small><i class="bi bi-arrow-up-right"></i> '+ roundN(peer.total_sent + total_s, 4) +' GB</small></p> </div>';
-                let peer_key = '<div class="col-sm"><small class="text-muted" style="display: flex"><strong>PEER</strong><strong style="margin-left: auto!important; opacity: 0; transition: 0.2s ease-in-out" class="text-primary">CLICK TO COPY</strong></small> <h6><samp class="ml-auto key">'+peer.id+'</samp></h6></div>';
-                let peer_allowed_ip = '<div class="col-sm"><small class="text-muted"><strong>ALLOWED IP</strong></small><h6 style="text-transform: uppercase;">'+peer.allowed_ip+'</h6></div>';
-                let peer_latest_handshake = '<div class="col-sm"> <small class="text-muted"><strong>LATEST HANDSHAKE</strong></small> <h6 style="text-transform: uppercase;">'+peer.latest_handshake+'</h6> </div>';
-                let peer_endpoint = '<div class="col-sm"><small class="text-muted"><strong>END POINT</strong></small><h6 style="text-transform: uppercase;">'+peer.endpoint+'</h6></div>';
-                let peer_control = '<div class="col-sm"><hr><div class="button-group" style="display:flex"><button type="button" class="btn btn-outline-primary btn-setting-peer btn-control" id="'+peer.id+'" data-toggle="modal"><i class="bi bi-gear-fill" data-toggle="tooltip" data-placement="bottom" title="Peer Settings"></i></button> <button type="button" class="btn btn-outline-danger btn-delete-peer btn-control" id="'+peer.id+'" data-toggle="modal"><i class="bi bi-x-circle-fill" data-toggle="tooltip" data-placement="bottom" title="Delete Peer"></i></button>';
-                if (peer.private_key !== ""){
-                    peer_control += '<div class="share_peer_btn_group" style="margin-left: auto !important; display: inline"><button type="button" class="btn btn-outline-success btn-qrcode-peer btn-control" data-imgsrc="/qrcode/'+response.name+'?id='+encodeURIComponent(peer.id)+'"><svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" style="width: 19px;" fill="#28a745"><path d="M3 11h8V3H3v8zm2-6h4v4H5V5zM3 21h8v-8H3v8zm2-6h4v4H5v-4zM13 3v8h8V3h-8zm6 6h-4V5h4v4zM13 13h2v2h-2zM15 15h2v2h-2zM13 17h2v2h-2zM17 17h2v2h-2zM19 19h2v2h-2zM15 19h2v2h-2zM17 13h2v2h-2zM19 15h2v2h-2z"/></svg></button><a href="/download/'+response.name+'?id='+encodeURIComponent(peer.id)+'" class="btn btn-outline-info btn-download-peer btn-control"><i class="bi bi-download"></i></a></div>';
-                }
-                peer_control += '</div>';
-                let html = '<div class="'+display_mode+'" data-id="'+peer.id+'">' +
-                                '<div class="card mb-3 card-'+peer.status+'">' +
-                                    '<div class="card-body">' +
-                                     '<div class="row">' +
-                                        peer_name +
-                                        spliter +
-                                        peer_transfer +
-                                        peer_key +
-                                        peer_allowed_ip +
-                                        peer_latest_handshake +
-                                        spliter +
-                                        peer_endpoint +
-                                        spliter +
-                                        peer_control +
-                                    '</div>' +
-                                '</div>' +
-                                '</div>' +
-                            '</div></div>';
-                result += html;
-            });
-            document.querySelector(".peer_list").innerHTML = result;
+            renderPeerWindow();
             if (response.dashboard_refresh_interval !== configuration_timeout){
                 configuration_timeout = response.dashboard_refresh_interval;
                 removeConfigurationInterval();
@@ -354,9 +515,6 @@
             configurationAlert(response);
             configurationHeader(response);
             configurationPeers(response);
-            $(".dot.dot-running").attr("title","Peer Connected").tooltip();
-            $(".dot.dot-stopped").attr("title","Peer Disconnected").tooltip();
-            $("i[data-toggle='tooltip']").tooltip();
             endProgressBar();
             let d2 = new Date();
             let seconds = (d2 - d1);
@@ -506,6 +664,7 @@
         settingModal: () => { return settingModal; },
 
         loadPeers: (searchString) => { loadPeers(searchString); },
+        setPeerDisplayMode: (display_mode) => { setPeerDisplayMode(display_mode); },
         addPeersByBulk: () => { addPeersByBulk(); },
         deletePeers: (config, peers_ids) => { deletePeers(config, peers_ids); },
 
@@ -1072,15 +1231,10 @@ $body.on("click", ".display_mode", function(){
         url: "/switch_display_mode/"+$(this).data("display-mode"),
         success: function (res){
            if (res === "true"){
+                window.configurations.setPeerDisplayMode(display_mode);
                 if (display_mode === "list"){
-                Array($(".peer_list").children()).forEach(function(child){
-                    $(child).removeClass().addClass("col-12");
-                });
                 window.configurations.showToast("Displaying as List");
             }else{
-               Array($(".peer_list").children()).forEach(function(child){
-                    $(child).removeClass().addClass("col-sm-6 col-lg-4");
-               });
                window.configurations.showToast("Displaying as Grids");
             }
            }
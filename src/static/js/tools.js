@@ -6,18 +6,44 @@ $(".ip_dropdown").on("change",function (){
     $(".modal.show .btn").removeAttr("disabled");
 });
 
-$(".conf_dropdown").on("change", function (){
-    $(".modal.show .ip_dropdown").html('<option value="none" selected="selected" disabled>Loading...');
+function escapeHTML(text){
+    return $("<div>").text(text).html();
+}
+
+function loadPingTargets(modal){
+    let config = modal.find(".conf_dropdown option:selected").val();
+    if (config === undefined || config === "none") return;
+    modal.find(".ip_dropdown").html('<option value="none" selected="selected" disabled>Loading...');
     $.ajax({
         url: "/get_ping_ip",
-        method: "POST",
-        data: "config=" + $(this).children("option:selected").val(),
+        method: "GET",
+        data: {"config": config, "search": modal.find(".ip_search").val(), "limit": 500},
         success: function (res){
-            $(".modal.show .ip_dropdown").html("");
-            $(".modal.show .ip_dropdown").append('<option value="none" selected="selected" disabled>Choose an IP');
-            $(".modal.show .ip_dropdown").append(res);
+            let html = ['<option value="none" selected="selected" disabled>Choose an IP'];
+            res.targets.forEach(function (target){
+                html.push('<optgroup label="' + escapeHTML(target.name + ' - ' + target.id) + '">');
+                target.ips.forEach(function (ip){
+                    html.push('<option value="' + escapeHTML(ip) + '">' + escapeHTML(ip) + '</option>');
+                });
+                if (target.endpoint !== null){
+                    html.push('<option value="' + escapeHTML(target.endpoint) + '">' + escapeHTML(target.endpoint) + '</option>');
+                }
+                html.push('</optgroup>');
+            });
+            modal.find(".ip_dropdown").html(html.join(""));
         }
     });
+}
+
+$(".conf_dropdown").on("change", function (){
+    loadPingTargets($(this).parents(".modal"));
+});
+
+let pingTargetsTimeout;
+$(".ip_search").on("keyup", function (){
+    let modal = $(this).parents(".modal");
+    clearTimeout(pingTargetsTimeout);
+    pingTargetsTimeout = setTimeout(function (){ loadPingTargets(modal); }, 300);
 });
 // Ping Tools
 $(".send_ping").on("click", function (){
@@ -48,20 +74,53 @@ $(".send_ping").on("click", function (){
 });
 
 // Traceroute Tools
+function renderTracerouteHops(hops){
+    $(".traceroute_result tbody").html("");
+    hops.forEach((ele) =>
+        $(".traceroute_result tbody").append('<tr><th scope="row">'+ele.hop+'</th><td>'+ele.ip+'</td><td>'+ele.avg_rtt+'</td><td>'+ele.min_rtt+'</td><td>'+ele.max_rtt+'</td></tr>'));
+}
+
+function finishTraceroute(){
+    $(".send_traceroute").removeAttr("disabled").html("Traceroute");
+    $("#traceroute_modal .form-control").removeAttr("disabled");
+}
+
+function pollTraceroute(job_id){
+    $.ajax({
+        url: "/traceroute_ip/" + job_id,
+        method: "GET",
+        success: function (res){
+            renderTracerouteHops(res.hops);
+            if (res.status === "running"){
+                setTimeout(function (){ pollTraceroute(job_id); }, 500);
+            }else{
+                if (res.status === "failed"){
+                    $(".traceroute_result tbody").append('<tr><td colspan="5" class="text-danger">'+res.msg+'</td></tr>');
+                }
+                finishTraceroute();
+            }
+        },
+        error: finishTraceroute
+    });
+}
+
 $(".send_traceroute").on("click", function (){
     $(this).attr("disabled","disabled");
     $(this).html("Tracing...");
     $("#traceroute_modal .form-control").attr("disabled","disabled");
+    $(".traceroute_result tbody").html("");
     $.ajax({
         url: "/traceroute_ip",
         method: "POST",
         data: "ip=" + $(':selected', $("#traceroute_modal .ip_dropdown")).val(),
         success: function (res){
-            $(".traceroute_result tbody").html("");
-            res.forEach((ele) =>
-                $(".traceroute_result tbody").append('<tr><th scope="row">'+ele.hop+'</th><td>'+ele.ip+'</td><td>'+ele.avg_rtt+'</td><td>'+ele.min_rtt+'</td><td>'+ele.max_rtt+'</td></tr>'));
-            $(".send_traceroute").removeAttr("disabled").html("Traceroute");
-            $("#traceroute_modal .form-control").removeAttr("disabled");
-        }
+            if (res.status){
+                pollTraceroute(res.job_id);
+            }else{
+                $(".traceroute_result tbody").html('<tr><td colspan="5" class="text-danger">'+res.msg+'</td></tr>');
+                finishTraceroute();
+            }
+        },
+        error: finishTraceroute
     });
-});
\ No newline at end of file
+});
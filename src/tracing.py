@@ -0,0 +1,279 @@
+"""
+< WGDashboard > - Request tracing and sampling profiler
+Under Apache-2.0 License
+
+Spans time the phases of a request (database, commands, file parsing, rendering), which
+are sent back as a Server-Timing header and kept per endpoint for the /stats page.
+"""
+
+import collections
+import functools
+import sqlite3
+import sys
+import threading
+import time
+
+# Requests kept per endpoint for the rolling statistics
+STATS_WINDOW = 500
+# Seconds between two samples of the profiler
+PROFILER_INTERVAL = 0.01
+
+local = threading.local()
+
+
+def begin():
+    """
+    Start tracing the request of the current thread
+    @return: None
+    """
+    local.phases = {}
+    # Phases a previous request of the thread left open are not nested in this one
+    local.open = set()
+    local.start = time.perf_counter()
+
+
+def end():
+    """
+    Stop tracing the request of the current thread
+    @return: Tuple of (total seconds, dictionary of phase to seconds), None if it was not traced
+    @rtype: tuple, None
+    """
+    phases = getattr(local, "phases", None)
+    if phases is None:
+        return None
+    local.phases = None
+    return time.perf_counter() - local.start, phases
+
+
+class span:
+    """
+    Time a block and add it to a phase of the current request, nested spans of the
+    same phase are only counted once. Outside of a traced request it costs one attribute lookup.
+
+        with tracing.span("db"):
+            ...
+    """
+
+    __slots__ = ("phase", "start", "nested")
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        phases = getattr(local, "phases", None)
+        self.nested = phases is None or self.phase in getattr(local, "open", ())
+        if not self.nested:
+            if not hasattr(local, "open"):
+                local.open = set()
+            local.open.add(self.phase)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.nested:
+            local.open.discard(self.phase)
+            phases = getattr(local, "phases", None)
+            if phases is not None:
+                phases[self.phase] = phases.get(self.phase, 0) + time.perf_counter() - self.start
+        return False
+
+
+def traced(phase):
+    """
+    Decorator timing every call of a function as a phase
+    @param phase: Phase name, e.g. "parse"
+    @return: Decorator
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor timing its statements and fetches as the "db" phase
+    """
+
+    def execute(self, *args):
+        with span("db"):
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with span("db"):
+            return super().executemany(*args)
+
+    def executescript(self, *args):
+        with span("db"):
+            return super().executescript(*args)
+
+    def fetchone(self):
+        with span("db"):
+            return super().fetchone()
+
+    def fetchall(self):
+        with span("db"):
+            return super().fetchall()
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection handing out TracedCursor, use as sqlite3.connect(..., factory=TracedConnection)
+    """
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+    def commit(self):
+        with span("db"):
+            return super().commit()
+
+
+def server_timing(total, phases):
+    """
+    Format a Server-Timing header
+    @param total: Seconds the request took
+    @param phases: Dictionary of phase to seconds
+    @return: str
+    """
+    entries = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in sorted(phases.items())]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+class EndpointStats:
+    """
+    Rolling window of the latest requests of every endpoint
+    """
+
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, total, phases):
+        """
+        @param endpoint: Flask endpoint name
+        @param total: Seconds the request took
+        @param phases: Dictionary of phase to seconds
+        @return: None
+        """
+        with self.lock:
+            requests = self.requests.get(endpoint)
+            if requests is None:
+                requests = self.requests[endpoint] = collections.deque(maxlen=self.window)
+            requests.append((total, phases))
+
+    def summary(self):
+        """
+        @return: List of dictionaries with count, mean, p50, p95, max and mean of every phase in ms,
+                 slowest endpoints first
+        @rtype: list
+        """
+        with self.lock:
+            requests = {endpoint: list(items) for endpoint, items in self.requests.items()}
+        result = []
+        for endpoint, items in requests.items():
+            totals = sorted(i[0] for i in items)
+            phases = {}
+            for _, request_phases in items:
+                for phase, seconds in request_phases.items():
+                    phases[phase] = phases.get(phase, 0) + seconds
+            result.append({
+                "endpoint": endpoint,
+                "count": len(totals),
+                "mean_ms": round(sum(totals) / len(totals) * 1000, 2),
+                "p50_ms": round(totals[len(totals) // 2] * 1000, 2),
+                "p95_ms": round(totals[min(len(totals) - 1, int(len(totals) * 0.95))] * 1000, 2),
+                "max_ms": round(totals[-1] * 1000, 2),
+                "phases_ms": {phase: round(seconds / len(totals) * 1000, 2) for phase, seconds in sorted(phases.items())}
+            })
+        return sorted(result, key=lambda r: r["mean_ms"] * r["count"], reverse=True)
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of every thread of the process at a fixed interval and count them in
+    the collapsed format of flamegraph.pl and speedscope ("frame;frame;frame count").
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started_at = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def running(self):
+        """
+        @return: bool
+        """
+        return self.thread is not None
+
+    def start(self):
+        """
+        Start sampling, clearing the previous samples
+        @return: None
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stacks.clear()
+            self.samples = 0
+            self.started_at = time.time()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.loop, name="wgd-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, the samples are kept until the next start
+        @return: None
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.stopping.set()
+            thread.join()
+
+    def loop(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                with self.lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+            with self.lock:
+                self.samples += 1
+
+    def collapsed(self):
+        """
+        @return: Stacks in the collapsed format, one "stack count" per line
+        @rtype: str
+        """
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
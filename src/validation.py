@@ -0,0 +1,196 @@
+"""
+< WGDashboard > - Validation of peer settings
+Under Apache-2.0 License
+
+Addresses are checked with the ipaddress module, the other formats with patterns compiled
+once. validate_peers checks a whole batch of peer records, each distinct value once.
+"""
+
+import ipaddress
+import re
+
+from peer_index import PrefixTrie
+
+# Base64 of 32 bytes, the last character only carries 4 bits
+KEY_PATTERN = re.compile(r"[A-Za-z0-9+/]{42}[AEIMQUYcgkosw048]=")
+HOSTNAME_PATTERN = re.compile(r"(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z]{0,61}[a-z]", re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r"[0-9]+")
+
+# Settings of a peer record, with the message of an invalid value
+PEER_FIELDS = (
+    ("public_key", "Public key is not a WireGuard key."),
+    ("allowed_ips", "Allowed IPs format is incorrect."),
+    ("endpoint_allowed_ip", "Endpoint Allowed IPs format is incorrect."),
+    ("DNS", "DNS format is incorrect."),
+    ("MTU", "MTU format is not correct."),
+    ("keep_alive", "Persistent Keepalive format is not correct."),
+    ("private_key", "Private key is not a WireGuard key."),
+    ("preshared_key", "Pre-shared key is not a WireGuard key.")
+)
+
+
+def is_ip(text):
+    """
+    @param text: e.g. "10.0.0.1" or "fd00::1"
+    @return: Whether text is an IPv4 or IPv6 address
+    @rtype: bool
+    """
+    try:
+        ipaddress.ip_address(text)
+        return True
+    except ValueError:
+        return False
+
+
+def is_network(text):
+    """
+    @param text: e.g. "10.0.0.1/32", the prefix length is required
+    @return: Whether text is an IPv4 or IPv6 network, host bits allowed
+    @rtype: bool
+    """
+    if "/" not in text:
+        return False
+    try:
+        ipaddress.ip_network(text, strict=False)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_allowed_ips(text):
+    """
+    @param text: Comma separated networks, spaces are ignored
+    @return: list of ipaddress networks, None if an entry is not a network
+    """
+    networks = []
+    for i in text.replace(" ", "").split(","):
+        if "/" not in i:
+            return None
+        try:
+            networks.append(ipaddress.ip_network(i, strict=False))
+        except ValueError:
+            return None
+    return networks
+
+
+def is_allowed_ips(text):
+    """
+    @param text: Comma separated networks, spaces are ignored
+    @return: Whether every entry is a network
+    @rtype: bool
+    """
+    return parse_allowed_ips(text) is not None
+
+
+def is_host(text):
+    """
+    @param text: e.g. "vpn.example.com" or "1.2.3.4"
+    @return: Whether text is an IP address or a domain name
+    @rtype: bool
+    """
+    return is_ip(text) or HOSTNAME_PATTERN.fullmatch(text) is not None
+
+
+def is_dns(text):
+    """
+    @param text: Comma separated DNS servers, spaces are ignored
+    @return: Whether every entry is an IP address or a domain name
+    @rtype: bool
+    """
+    return all(is_host(i) for i in text.replace(" ", "").split(","))
+
+
+def is_key(text):
+    """
+    @param text: Public, private or pre-shared key
+    @return: Whether text is the base64 of a 32 bytes key
+    @rtype: bool
+    """
+    return KEY_PATTERN.fullmatch(text) is not None
+
+
+def is_number(text):
+    """
+    @param text: e.g. MTU or persistent keepalive
+    @return: Whether text is a non-negative integer
+    @rtype: bool
+    """
+    return NUMBER_PATTERN.fullmatch(text) is not None
+
+
+VALIDATORS = {
+    "public_key": is_key,
+    "allowed_ips": is_allowed_ips,
+    "endpoint_allowed_ip": is_allowed_ips,
+    "DNS": is_dns,
+    "MTU": is_number,
+    "keep_alive": is_number,
+    "private_key": is_key,
+    "preshared_key": is_key
+}
+REQUIRED_FIELDS = ("public_key", "allowed_ips")
+
+
+def validate_peers(records, existing_keys=(), conflict=None, first_row=0):
+    """
+    Validate a batch of peer records, e.g. an import. Empty optional settings are not
+    checked, the caller fills them with the defaults.
+    @param records: List of dictionaries with the keys of PEER_FIELDS and "name", as strings
+    @param existing_keys: Public keys of the peers already on the interface
+    @param conflict: Function taking a list of ipaddress networks and returning why they
+                     overlap an existing peer, or None
+    @param first_row: Row number of the first record, e.g. the records of the batches before
+                      it, used where a message refers to another row
+    @return: Errors, each a dictionary of row (index in records), field and msg, by row
+    @rtype: list
+    """
+    errors = []
+    # Records of a batch mostly share their DNS, MTU, ... so each distinct value is checked once
+    checked = {field: {} for field, _ in PEER_FIELDS}
+    keys = {}
+    batch = PrefixTrie()
+    for row, record in enumerate(records):
+        failed = False
+        for field, message in PEER_FIELDS:
+            value = record.get(field)
+            value = "" if value is None else str(value).strip()
+            if len(value) == 0:
+                if field in REQUIRED_FIELDS:
+                    errors.append({"row": row, "field": field, "msg": f"{field} is required."})
+                    failed = True
+                continue
+            if field == "allowed_ips":
+                # Parsed once for the format and the overlap checks
+                networks = parse_allowed_ips(value)
+                valid = networks is not None
+            else:
+                valid = checked[field].get(value)
+                if valid is None:
+                    valid = checked[field][value] = VALIDATORS[field](value)
+            if not valid:
+                errors.append({"row": row, "field": field, "msg": message})
+                failed = True
+        if failed:
+            continue
+        public_key = str(record["public_key"]).strip()
+        if public_key in existing_keys:
+            errors.append({"row": row, "field": "public_key", "msg": "Public key already exist."})
+            continue
+        if public_key in keys:
+            errors.append({"row": row, "field": "public_key", "msg": f"Public key repeats row {first_row + keys[public_key]}."})
+            continue
+        overlap = None
+        for network in networks:
+            first = batch.first_overlap(network)
+            if first is not None:
+                overlap = f"Allowed IP {network} overlaps {first[0]} of row {first_row + first[1]}."
+                break
+        if overlap is None and conflict is not None:
+            overlap = conflict(networks)
+        if overlap is not None:
+            errors.append({"row": row, "field": "allowed_ips", "msg": overlap})
+            continue
+        keys[public_key] = row
+        for network in networks:
+            batch.insert(network, row)
+    return errors